@@ -0,0 +1,685 @@
+"""
+    Rough throughput numbers for the waiter pipeline against a local,
+    in-process HTTP server. Run as `python bench.py [name ...]`; `replay`
+    takes --cassette, --concurrency and --latency too.
+"""
+from waiter import Waiter, AsyncWaiter, Consumer, JSONConsumer
+from waiter.apis.twitter import Twitter, TwitterConsumer, TWITTER_ENDPOINTS
+from waiter.caches import ResponseCache, SharedCache
+from waiter.cassettes import Cassette, RecordingHttp, ReplayHttp
+from waiter.chefs import LaxRecipeChef
+from waiter.commissary import Commissary, CommissaryConsumer
+from waiter.instruments import Collector
+from waiter.limiters import AdaptiveHttp, AIMDLimit, VegasLimit
+from waiter.consumers import StreamingJSONConsumer, Projection
+from waiter.decoders import get_decoder, available_decoders
+from waiter.specs import load_client
+from waiter.tickets import Brigade
+from waiter.transports import shared_pool, ConnectionPool, StreamingHttp, PooledHttp
+import multiprocessing
+import argparse
+import httplib2
+import tempfile
+import shutil
+import urlparse
+import gc
+import os
+import BaseHTTPServer
+import resource
+import SocketServer
+import socket
+import simplejson
+import threading
+import time
+import sys
+
+class LocalHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    wbufsize = -1
+    body = simplejson.dumps({'id':1, 'screen_name':'isntitvacant'})
+    latency = 0
+
+    def do_GET(self):
+        if self.latency:
+            time.sleep(self.latency)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(self.body)))
+        self.end_headers()
+        self.wfile.write(self.body)
+    do_POST = do_GET
+
+    def log_message(self, *args):
+        pass
+
+class LocalServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+def serve(handler=LocalHandler):
+    server = LocalServer(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+class H2Handler(SocketServer.BaseRequestHandler):
+    """
+        LocalHandler's body and latency, spoken as HTTP/2 with prior knowledge
+        (h2c). Each stream is answered from its own thread, so slow responses
+        overlap the way they would on a real server; what each request looked
+        like goes in the server's `requests`.
+    """
+    body = LocalHandler.body
+    latency = 0
+    max_concurrent_streams = 100
+
+    def handle(self):
+        import h2.config, h2.connection, h2.events, h2.settings
+        self.server.count_connection()
+        self.conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=False, header_encoding=None))
+        self.conn.initiate_connection()
+        self.conn.update_settings({h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS:self.max_concurrent_streams})
+        self.condition = threading.Condition()
+        self.pending = {}
+        self.flush()
+        while True:
+            try:
+                data = self.request.recv(65535)
+            except socket.error:
+                data = ''
+            self.condition.acquire()
+            try:
+                if not data:
+                    self.condition.notifyAll()
+                    return
+                for event in self.conn.receive_data(data):
+                    if isinstance(event, h2.events.RequestReceived):
+                        weight = event.priority_updated.weight if event.priority_updated else None
+                        self.pending[event.stream_id] = (dict(event.headers), [], weight)
+                    elif isinstance(event, h2.events.DataReceived):
+                        self.pending[event.stream_id][1].append(event.data)
+                        self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                    elif isinstance(event, h2.events.StreamEnded):
+                        headers, chunks, weight = self.pending.pop(event.stream_id)
+                        self.server.requests.append((headers, ''.join(chunks), weight))
+                        self.answer(event.stream_id)
+                    elif isinstance(event, h2.events.StreamReset):
+                        self.pending.pop(event.stream_id, None)
+                self.flush()
+                self.condition.notifyAll()
+            finally:
+                self.condition.release()
+
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.request.sendall(data)
+
+    def answer(self, stream_id):
+        def respond():
+            if self.latency:
+                time.sleep(self.latency)
+            self.respond(stream_id)
+        thread = threading.Thread(target=respond)
+        thread.setDaemon(True)
+        thread.start()
+
+    def respond(self, stream_id):
+        body = self.body
+        self.condition.acquire()
+        try:
+            self.conn.send_headers(stream_id, [(':status', '200'), ('content-type', 'application/json'), ('content-length', str(len(body)))])
+            while body:
+                window = min(self.conn.local_flow_control_window(stream_id), self.conn.max_outbound_frame_size)
+                if window <= 0:
+                    self.flush()
+                    self.condition.wait(1)
+                    continue
+                self.conn.send_data(stream_id, body[:window])
+                body = body[window:]
+            self.conn.end_stream(stream_id)
+            self.flush()
+        except Exception:
+            pass
+        finally:
+            self.condition.release()
+
+class H2Server(SocketServer.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    request_queue_size = 1024
+
+    def __init__(self, address, handler):
+        SocketServer.ThreadingTCPServer.__init__(self, address, handler)
+        self._lock = threading.Lock()
+        self.connections = 0
+        self.requests = []
+
+    def count_connection(self):
+        self._lock.acquire()
+        try:
+            self.connections += 1
+        finally:
+            self._lock.release()
+
+def serve_h2(handler=H2Handler):
+    server = H2Server(('127.0.0.1', 0), handler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.setDaemon(True)
+    thread.start()
+    return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+def twitter_user(i):
+    return {
+        'id':10**9 + i, 'id_str':str(10**9 + i), 'screen_name':'user%d' % i, 'name':u'User \u2603 %d' % i,
+        'location':'Lawrence, KS', 'description':'Just setting up my twttr. ' * 3, 'url':None,
+        'protected':False, 'followers_count':i * 7, 'friends_count':i * 3, 'statuses_count':i * 11,
+        'created_at':'Wed Mar 03 19:37:35 +0000 2010', 'favourites_count':0, 'utc_offset':-21600,
+        'time_zone':'Central Time (US & Canada)', 'profile_image_url':'http://a1.twimg.com/profile_images/%d/me_normal.png' % i,
+        'profile_background_color':'C0DEED', 'profile_text_color':'333333', 'verified':False,
+        'geo_enabled':False, 'lang':'en', 'contributors_enabled':False, 'following':None,
+    }
+
+def twitter_timeline(count=200):
+    return [{
+        'id':2 * 10**10 + i, 'id_str':str(2 * 10**10 + i), 'created_at':'Thu Apr 15 20:49:05 +0000 2010',
+        'text':u'@isntitvacant there\'s a hair in my soup! \u2615 http://bit.ly/%d #waiter' % i,
+        'source':'<a href="http://github.com/chrisdickinson/waiter" rel="nofollow">waiter</a>',
+        'truncated':False, 'in_reply_to_status_id':None, 'in_reply_to_user_id':None,
+        'in_reply_to_screen_name':None, 'favorited':False, 'geo':None, 'coordinates':None,
+        'place':None, 'contributors':None, 'user':twitter_user(i),
+    } for i in range(count)]
+
+def report(name, orders, elapsed):
+    print('%-24s %6d orders in %7.3fs -> %9.1f orders/sec' % (name, orders, elapsed, orders / elapsed))
+
+def bench_sync(root, orders=500):
+    waiter = Waiter()
+    start = time.time()
+    for i in range(orders):
+        waiter/root/'users'/'show.json'/{'screen_name':'isntitvacant'}
+    report('sync', orders, time.time() - start)
+
+def bench_async(root, orders=5000, cooks=64):
+    brigade = Brigade(cooks)
+    waiter = AsyncWaiter(brigade=brigade)
+    start = time.time()
+    tickets = [waiter/root/'users'/'show.json'/{'screen_name':'isntitvacant'} for i in range(orders)]
+    for ticket in tickets:
+        ticket.result()
+    report('async (%d cooks)' % cooks, orders, time.time() - start)
+    brigade.shutdown()
+
+def bench_fan_out(root, orders=200, concurrency=32, latency=0.02):
+    class SlowHandler(LocalHandler):
+        pass
+    SlowHandler.latency = latency
+    server, slow_root = serve(SlowHandler)
+    waiter = Waiter()
+    payloads = [{'screen_name':'user%d' % i} for i in range(orders)]
+
+    start = time.time()
+    for payload in payloads:
+        waiter/slow_root/'users'/'show.json'/payload
+    report('loop (%dms latency)' % (latency * 1000), orders, time.time() - start)
+
+    start = time.time()
+    for ticket in waiter.fan_out([slow_root, '/users/show.json'], payloads, concurrency=concurrency):
+        ticket.result()
+    report('fan_out (%d wide)' % concurrency, orders, time.time() - start)
+    server.shutdown()
+
+def bench_pooled(root, orders=500):
+    import httplib2
+    start = time.time()
+    for i in range(orders):
+        Waiter(httplib2.Http())/root/'users'/'show.json'/{'screen_name':'isntitvacant'}
+    report('waiter per order', orders, time.time() - start)
+
+    start = time.time()
+    for i in range(orders):
+        waiter = Waiter()
+        waiter/root/'users'/'show.json'/{'screen_name':'isntitvacant'}
+    report('pooled waiter per order', orders, time.time() - start)
+    print('    pool: %r' % waiter._http.pool_stats())
+
+def _consume_ids(root, streaming, results):
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.time()
+    if streaming:
+        waiter = Waiter(StreamingHttp(), consumer=StreamingJSONConsumer(path=['ids']))
+    else:
+        waiter = Waiter(consumer=JSONConsumer())
+    ids = waiter/root/'followers'/'ids.json'/{}
+    if not streaming:
+        ids = ids['ids']
+    first, count = None, 0
+    for id in ids:
+        if first is None:
+            first = time.time() - start
+        count += 1
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - baseline
+    results.put((first, time.time() - start, count, peak))
+
+def bench_streaming(root, ids=1000000):
+    class IdsHandler(LocalHandler):
+        body = simplejson.dumps({'ids':range(10**9, 10**9 + ids), 'next_cursor':0, 'previous_cursor':0})
+    server, ids_root = serve(IdsHandler)
+    for name, streaming in (('JSONConsumer', False), ('StreamingJSONConsumer', True)):
+        results = multiprocessing.Queue()
+        worker = multiprocessing.Process(target=_consume_ids, args=(ids_root, streaming, results))
+        worker.start()
+        first, elapsed, count, peak = results.get()
+        worker.join()
+        print('%-24s %d ids, first after %.3fs, all after %.3fs, peak rss +%.1fMB' % (name, count, first, elapsed, peak / 1024.0))
+    server.shutdown()
+
+def bench_orders(root, orders=20000):
+    class CannedHttp(object):
+        thread_safe = True
+        canned = ({'status':'200'}, '{}')
+        def request(self, **kwargs):
+            return self.canned
+    twitter = Twitter(CannedHttp(), consumer=Consumer())
+
+    start = time.time()
+    for i in range(orders):
+        twitter/'statuses'/'show.json'/{'id':i}
+    report('waiter/.../{}', orders, time.time() - start)
+
+    show = twitter.prepare('statuses', 'show.json')
+    start = time.time()
+    for i in range(orders):
+        show(id=i)
+    report('prepared order', orders, time.time() - start)
+
+def bench_compression(root, ids=200000, orders=20):
+    import gzip, StringIO
+    plain = simplejson.dumps({'ids':range(10**9, 10**9 + ids), 'next_cursor':0})
+    buffer = StringIO.StringIO()
+    gzipped = gzip.GzipFile(fileobj=buffer, mode='wb')
+    gzipped.write(plain)
+    gzipped.close()
+    class GzipHandler(LocalHandler):
+        def do_GET(self):
+            compressed = 'gzip' in self.headers.get('accept-encoding', '')
+            self.body = buffer.getvalue() if compressed else plain
+            self.send_response(200)
+            if compressed:
+                self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(self.body)))
+            self.end_headers()
+            self.wfile.write(self.body)
+    server, gzip_root = serve(GzipHandler)
+    for name, decompress in (('identity', False), ('gzip', True)):
+        collector = Collector()
+        waiter = Waiter(StreamingHttp(decompress=decompress), consumer=StreamingJSONConsumer(path=['ids']), instruments=collector)
+        order = waiter.prepare(gzip_root, 'followers', 'ids.json')
+        start = time.time()
+        for i in range(orders):
+            for id in order():
+                pass
+        elapsed = time.time() - start
+        stats = collector.snapshot()['endpoints']['followers/ids']
+        decompress = collector.snapshot()['latencies'][('decompress', 'followers/ids')]
+        print('%-10s %4d orders in %6.3fs, %8.1fKB/order on the wire, %6.2fms/order inflating' % (
+            name, orders, elapsed, stats['wire_bytes'] / 1024.0 / orders, decompress['sum'] * 1000 / orders))
+    server.shutdown()
+
+def bench_decoders(root, rounds=50):
+    payloads = [
+        ('home_timeline', simplejson.dumps(twitter_timeline(200))),
+        ('users/show', simplejson.dumps(twitter_user(1))),
+        ('followers/ids', simplejson.dumps({'ids':range(10**9, 10**9 + 5000), 'next_cursor':0})),
+    ]
+    for name in available_decoders():
+        decoder = get_decoder(name)
+        for payload_name, payload in payloads:
+            count = rounds if len(payload) > 10000 else rounds * 100
+            start = time.time()
+            for i in range(count):
+                decoder(payload)
+            elapsed = time.time() - start
+            print('%-20s %-14s %8.1f decodes/sec, %7.1fMB/sec' % (name, payload_name, count / elapsed, count * len(payload) / elapsed / 2**20))
+
+def bench_commissary(root, orders=200, concurrency=16):
+    class CannedHttp(object):
+        thread_safe = True
+        canned = ({'status':'200'}, simplejson.dumps(twitter_timeline(200)))
+        def request(self, **kwargs):
+            response, data = self.canned
+            return httplib2.Response(response), data
+    payloads = [{'count':200, 'page':i} for i in range(orders)]
+    cores = multiprocessing.cpu_count()
+    print('ingesting %d timelines of %.1fKB each, %d wide, on %d cores' % (orders, len(CannedHttp.canned[1]) / 1024.0, concurrency, cores))
+
+    waiter = Waiter(CannedHttp(), consumer=TwitterConsumer())
+    start = time.time()
+    for ticket in waiter.fan_out([root, '/statuses/home_timeline.json'], payloads, concurrency=concurrency):
+        ticket.result()
+    report('in-thread', orders, time.time() - start)
+
+    for processes in sorted(set([1, 2, 4, cores])):
+        commissary = Commissary(processes=processes)
+        waiter = Waiter(CannedHttp(), consumer=CommissaryConsumer(TwitterConsumer(), commissary))
+        start = time.time()
+        for ticket in waiter.fan_out([root, '/statuses/home_timeline.json'], payloads, concurrency=concurrency):
+            ticket.result().result()
+        report('commissary (%d procs)' % processes, orders, time.time() - start)
+        commissary.close()
+
+def _fetch_hot(slow_root, path, resources, orders, offset, results):
+    cache = SharedCache(path) if path else ResponseCache()
+    waiter = Waiter(cache=cache)
+    for i in range(orders):
+        waiter/slow_root/'users'/'show.json'/{'user_id':(offset + i) % resources}
+    stats = cache.stats()
+    results.put((stats['hits'], stats['misses'], stats.get('bytes_saved')))
+
+def bench_shared_cache(root, processes=4, resources=100, orders=400, latency=0.01):
+    class CountingHandler(LocalHandler):
+        served = []
+        def do_GET(self):
+            self.served.append(1)
+            LocalHandler.do_GET(self)
+    CountingHandler.latency = latency
+    CountingHandler.body = simplejson.dumps(twitter_user(1))
+    server, slow_root = serve(CountingHandler)
+    directory = tempfile.mkdtemp(dir='/dev/shm' if os.path.isdir('/dev/shm') else None)
+    for name, path in (('cache per process', None), ('SharedCache', os.path.join(directory, 'cache'))):
+        del CountingHandler.served[:]
+        results = multiprocessing.Queue()
+        workers = [multiprocessing.Process(target=_fetch_hot, args=(slow_root, path, resources, orders, i * resources // processes, results)) for i in range(processes)]
+        start = time.time()
+        for worker in workers:
+            worker.start()
+        stats = [results.get() for worker in workers]
+        for worker in workers:
+            worker.join()
+        elapsed = time.time() - start
+        hits, misses = sum(stat[0] for stat in stats), sum(stat[1] for stat in stats)
+        saved = sum(stat[2] or 0 for stat in stats)
+        report('%s (%d procs)' % (name, processes), processes * orders, elapsed)
+        print('    upstream requests: %d, hit ratio: %.2f, bytes saved: %.1fKB' % (
+            len(CountingHandler.served), float(hits) / (hits + misses), saved / 1024.0))
+    shutil.rmtree(directory)
+    server.shutdown()
+
+def bench_adaptive(root, orders=2000, capacity=16, overload=40, latency=0.01, width=64):
+    class BusyHandler(LocalHandler):
+        lock = threading.Lock()
+        active = [0]
+        refused = []
+        def do_GET(self):
+            self.lock.acquire()
+            self.active[0] += 1
+            active = self.active[0]
+            self.lock.release()
+            try:
+                if active > overload:
+                    self.refused.append(1)
+                    self.send_response(503)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                time.sleep(latency * max(1.0, float(active) / capacity) ** 2)
+                LocalHandler.do_GET(self)
+            finally:
+                self.lock.acquire()
+                self.active[0] -= 1
+                self.lock.release()
+    server, busy_root = serve(BusyHandler)
+    payloads = [{'screen_name':'user%d' % i} for i in range(orders)]
+    print('upstream serves %d at a time in %dms, bogs down past that and refuses past %d' % (capacity, latency * 1000, overload))
+    for name, concurrency, limit in (
+            ('static 4', 4, None),
+            ('static %d' % width, width, None),
+            ('AIMDLimit', width, AIMDLimit(maximum=width)),
+            ('VegasLimit', width, VegasLimit(maximum=width))):
+        del BusyHandler.refused[:]
+        http = PooledHttp(pool=ConnectionPool(max_per_host=width))
+        waiter = Waiter(AdaptiveHttp(http, limit) if limit is not None else http, consumer=Consumer())
+        start = time.time()
+        for ticket in waiter.fan_out([busy_root, '/users/show.json'], payloads, concurrency=concurrency):
+            ticket.result()
+        elapsed = time.time() - start
+        settled = ', limit %d (%d changes)' % (limit.limit, limit.increases + limit.decreases) if limit is not None else ''
+        refused = len(BusyHandler.refused)
+        print('%-24s %6d orders in %7.3fs -> %7.1f served/sec, %4d refused%s' % (
+            name, orders, elapsed, (orders - refused) / elapsed, refused, settled))
+    server.shutdown()
+
+def bench_projection(root, orders=50):
+    class CannedHttp(object):
+        thread_safe = True
+        canned = ({'status':'200'}, simplejson.dumps(twitter_timeline(200)))
+        def request(self, **kwargs):
+            response, data = self.canned
+            return httplib2.Response(response), data
+    twitter = Twitter(CannedHttp())
+    twitter._chef = LaxRecipeChef(root, TWITTER_ENDPOINTS)
+    projection = Projection('id', 'created_at', 'user.screen_name')
+    for name, project in (('whole timelines', False), ('projected timelines', True)):
+        kept = []
+        start = time.time()
+        for i in range(orders):
+            order = twitter/'statuses'/'home_timeline.json'
+            if project:
+                order = order/projection
+            kept.append(order/{'count':200, 'page':i})
+        elapsed = time.time() - start
+        print('%-24s %6d orders in %7.3fs -> %7.1f orders/sec, %8.1fKB kept/timeline' % (
+            name, orders, elapsed, orders / elapsed, deep_size(kept[0]) / 1024.0))
+
+def bench_http2(root, orders=1000, concurrency=32, latency=0.02):
+    try:
+        from waiter.multiplex import MultiplexedHttp
+        MultiplexedHttp()
+    except ImportError:
+        print('http2: needs the h2 package')
+        return
+    class SlowHandler(LocalHandler):
+        pass
+    class SlowH2Handler(H2Handler):
+        pass
+    SlowHandler.latency = SlowH2Handler.latency = latency
+    server, slow_root = serve(SlowHandler)
+    h2_server, h2_root = serve_h2(SlowH2Handler)
+    payloads = [{'screen_name':'user%d' % i} for i in range(orders)]
+
+    pool = ConnectionPool(max_per_host=concurrency)
+    multiplexed = MultiplexedHttp()
+    for name, http, slow_root, connections in (
+            ('HTTP/1.1 pooled', PooledHttp(pool=pool), slow_root, lambda: pool.stats()['misses']),
+            ('HTTP/2 multiplexed', multiplexed, h2_root, lambda: h2_server.connections)):
+        waiter = Waiter(http)
+        start = time.time()
+        for ticket in waiter.fan_out([slow_root, '/users/show.json'], payloads, concurrency=concurrency):
+            ticket.result()
+        elapsed = time.time() - start
+        print('%-30s %6d orders in %7.3fs -> %7.1f orders/sec, %3d connections' % (
+            '%s (%d wide)' % (name, concurrency), orders, elapsed, orders / elapsed, connections()))
+    multiplexed.close()
+    server.shutdown()
+    h2_server.shutdown()
+
+def bench_specs(root, versions=30, loads=50):
+    endpoints = {}
+    for version in range(versions):
+        for endpoint, method in TWITTER_ENDPOINTS.items():
+            endpoints['%d/%s' % (version, endpoint)] = method
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'api.json')
+    handle = open(path, 'wb')
+    handle.write(simplejson.dumps({'name':'Api', 'domain':root, 'endpoints':endpoints,
+        'pagination':{'param':'cursor', 'start':-1, 'next':'next_cursor'}, 'errors':{'statuses':[404], 'key':'error'}}))
+    handle.close()
+    for name, cached in (('spec compiled each load', False), ('spec loaded from artifact', True)):
+        start = time.time()
+        for i in range(loads):
+            if not cached and os.path.exists(path + '.compiled'):
+                os.remove(path + '.compiled')
+            load_client(path)
+        elapsed = time.time() - start
+        print('%-30s %6d loads in %7.3fs -> %7.2fms/load (%d endpoints)' % (name, loads, elapsed, elapsed * 1000 / loads, len(endpoints)))
+    os.remove(path + '.compiled')
+    os.remove(path)
+    os.rmdir(directory)
+
+def deep_size(value, seen=None):
+    seen = seen if seen is not None else set()
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple)):
+        size += sum(deep_size(item, seen) for item in value)
+    return size
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))] if ordered else 0.0
+
+def live_objects():
+    gc.collect()
+    return len(gc.get_objects())
+
+def replay(name, make_order, orders, concurrency):
+    """
+        Serve `orders` orders from `make_order(i)` -- which returns a function
+        that serves one -- across `concurrency` threads, reporting throughput,
+        p50/p99 latency and how many objects each order left behind.
+    """
+    counter = iter(range(orders))
+    lock = threading.Lock()
+    latencies, errors = [], []
+    def work():
+        timings = []
+        while True:
+            lock.acquire()
+            try:
+                i = next(counter, None)
+            finally:
+                lock.release()
+            if i is None:
+                break
+            start = time.time()
+            try:
+                make_order(i)()
+            except Exception as e:
+                errors.append(e)
+                continue
+            timings.append(time.time() - start)
+        lock.acquire()
+        latencies.extend(timings)
+        lock.release()
+
+    baseline = live_objects()
+    threads = [threading.Thread(target=work) for i in range(concurrency)]
+    start = time.time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() - start
+    retained = live_objects() - baseline
+    print('%-24s %6d orders at %3d wide: %9.1f orders/sec, p50 %7.3fms, p99 %7.3fms, %+.2f objects/order' % (
+        name, orders, concurrency, orders / elapsed,
+        percentile(latencies, 0.5) * 1000, percentile(latencies, 0.99) * 1000, float(retained) / orders))
+    if errors:
+        print('    %d orders failed, first with %r' % (len(errors), errors[0]))
+
+def record_session(root, path, users=50):
+    """
+        Record a session of users/show, statuses/home_timeline and
+        followers/ids orders against the local server onto a cassette.
+    """
+    class SessionHandler(LocalHandler):
+        bodies = {
+            '/users/show.json':simplejson.dumps(twitter_user(1)),
+            '/statuses/home_timeline.json':simplejson.dumps(twitter_timeline(50)),
+            '/followers/ids.json':simplejson.dumps({'ids':range(10**9, 10**9 + 5000), 'next_cursor':0}),
+        }
+        def do_GET(self):
+            self.body = self.bodies[self.path.split('?')[0]]
+            LocalHandler.do_GET(self)
+    server, session_root = serve(SessionHandler)
+    cassette = Cassette()
+    waiter = Waiter(RecordingHttp(PooledHttp(), cassette), consumer=Consumer())
+    for i in range(users):
+        waiter/session_root/'users'/'show.json'/{'user_id':i}
+    waiter/session_root/'statuses'/'home_timeline.json'/{'count':50}
+    waiter/session_root/'followers'/'ids.json'/{'cursor':-1}
+    server.shutdown()
+    cassette.save(path)
+
+def bench_replay(root, cassette=None, concurrency=(1, 8, 32), latency=0.005, orders=2000):
+    if cassette is None:
+        cassette = os.path.join(tempfile.mkdtemp(), 'session.jsonl.gz')
+        record_session(root, cassette)
+    tape = Cassette.load(cassette)
+    session_root = '%s://%s' % urlparse.urlparse(tape.interactions[0]['uri'])[:2]
+    users = sum(1 for interaction in tape.interactions if '/users/show' in interaction['uri'])
+    print('replaying %d interactions from %s with %.1fms latency' % (len(tape), cassette, latency * 1000))
+
+    for wide in concurrency:
+        http = ReplayHttp(tape, latency=latency)
+        waiter = Waiter(http)
+        show = waiter.prepare(session_root, 'users', 'show.json')
+        replay('Waiter users/show', lambda i: lambda: show(user_id=i % users), orders, wide)
+
+        twitter = Twitter(http)
+        twitter._chef = LaxRecipeChef(session_root, TWITTER_ENDPOINTS)
+        timeline = twitter.prepare('statuses', 'home_timeline.json')
+        replay('Twitter home_timeline', lambda i: lambda: timeline(count=50), orders // 10, wide)
+
+        streaming = Waiter(http, consumer=StreamingJSONConsumer(path=['ids'], checker=TwitterConsumer()))
+        ids = streaming.prepare(session_root, 'followers', 'ids.json')
+        replay('Streaming followers/ids', lambda i: lambda: sum(1 for id in ids(cursor=-1)), orders // 10, wide)
+
+BENCHMARKS = [
+    ('sync', bench_sync),
+    ('async', bench_async),
+    ('fan_out', bench_fan_out),
+    ('pooled', bench_pooled),
+    ('streaming', bench_streaming),
+    ('decoders', bench_decoders),
+    ('compression', bench_compression),
+    ('orders', bench_orders),
+    ('replay', bench_replay),
+    ('commissary', bench_commissary),
+    ('projection', bench_projection),
+    ('http2', bench_http2),
+    ('specs', bench_specs),
+    ('shared_cache', bench_shared_cache),
+    ('adaptive', bench_adaptive),
+]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark the waiter pipeline.')
+    parser.add_argument('names', nargs='*', help='benchmarks to run (default: all)')
+    parser.add_argument('--cassette', help='replay this cassette rather than recording a fresh one')
+    parser.add_argument('--concurrency', type=int, action='append', help='threads to replay with (repeatable)')
+    parser.add_argument('--latency', type=float, help='milliseconds each replayed response takes')
+    args = parser.parse_args()
+    replay_options = {}
+    if args.cassette:
+        replay_options['cassette'] = args.cassette
+    if args.concurrency:
+        replay_options['concurrency'] = args.concurrency
+    if args.latency is not None:
+        replay_options['latency'] = args.latency / 1000.0
+
+    server, root = serve()
+    for name, benchmark in BENCHMARKS:
+        if not args.names or name in args.names:
+            if name == 'replay':
+                benchmark(root, **replay_options)
+            else:
+                benchmark(root)
+    shared_pool().close()
+    server.shutdown()
+    time.sleep(0.1)
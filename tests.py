@@ -1,13 +1,44 @@
-from waiter import Waiter, Chef, Consumer, JSONConsumer, Menu
+from waiter import Waiter, AsyncWaiter, Order, Chef, Consumer, JSONConsumer, Menu
+from waiter.tickets import Ticket, Brigade, as_completed
+from waiter.caches import ResponseCache, MemoryStore, DiskStore, CacheEntry, SingleFlight, MappedTable, SharedCache
+from waiter.transports import ThreadLocalHttp, ConnectionPool, PooledMixin, PooledHttp, shared_pool
+from waiter.transports import StreamingHttp, ResponseBody
+from waiter.consumers import ItemScanner, StreamingJSONConsumer, Projection, ProjectingConsumer, record_type
+from waiter.decoders import get_decoder, available_decoders, default_decoder
+from waiter.limiters import TokenBucket, RateLimiter, RateLimitedHttp, INTERACTIVE, BACKGROUND
+from waiter.limiters import AIMDLimit, VegasLimit, AdaptiveHttp
+from waiter.retries import RetryPolicy, CircuitBreaker, RetryingHttp, retry_after_seconds
+from waiter.instruments import Instruments, Collector, Histogram
+from waiter.cassettes import Cassette, RecordingHttp, ReplayHttp
+from waiter.compression import compress, decompressor_for, accept_encoding, available_encodings
+from waiter.commissary import Commissary, CommissaryConsumer
+from waiter.writes import WriteQueue, Journal
+from waiter.deadlines import Deadline, DeadlineHttp
+from waiter.multiplex import MultiplexedHttp
+from waiter.uploads import Upload, StreamingBody, MultipartBody, is_upload
+from waiter.chefs import endpoint_of
 from waiter.methods import POST, PUT, DELETE, GET, Method
-from waiter.chefs import LaxRecipeChef
-from waiter.apis.twitter import grab_oauth_library, TwitterMenu, TwitterConsumer, TwitterRecipeChef, Twitter, TWITTER_ENDPOINTS, TwitterException
+from waiter.chefs import LaxRecipeChef, LazyRecipe, RecipeRouter, Route
+from waiter.specs import CompiledSpec, SpecConsumer, compile_spec, load_client
+from waiter import specs
+from waiter.apis.twitter import grab_oauth_library, TwitterMenu, TwitterConsumer, TwitterRecipeChef, Twitter, TWITTER_ENDPOINTS, TWITTER_ROUTER, TwitterException
 import simplejson
 import mox
 import unittest
 import random
 import httplib2
 import urllib
+import threading
+import multiprocessing
+import time
+import traceback
+import sys
+import tempfile
+import socket
+import shutil
+import StringIO
+import cPickle
+import os
 
 class TestOfChef(unittest.TestCase):
     def test_init_sets_correct_fields(self):
@@ -37,6 +68,15 @@ class TestOfChef(unittest.TestCase):
         self.assertEqual(results['uri'], ''.join(random_stack))
         self.assertEqual(results['body'], urllib.urlencode(random_params))
 
+    def test_cook_data_sends_multipart_body_for_files_on_post(self):
+        c = Chef('POST')
+        random_value = str(random.randint(1,100))
+        results = c.cook_data(['random'], {'image':StringIO.StringIO(random_value), 'name':'random'})
+        self.assertTrue(isinstance(results['body'], MultipartBody))
+        self.assertEqual(results['headers']['content-length'], str(len(results['body'])))
+        self.assertTrue(results['headers']['content-type'].startswith('multipart/form-data; boundary='))
+        self.assertTrue(random_value in results['body'].read())
+
     def test_cooks_clears_error_stack(self):
         c = Chef('POST')
         c.errors = [i for i in range(0, random.randint(0,100))]
@@ -74,6 +114,34 @@ class TestOfJSONConsumer(unittest.TestCase):
         random_value_in_json = simplejson.dumps(random_value)
         self.assertEqual(c.handle(random.randint(1,100), random_value_in_json), random_value)
 
+    def test_decoder_can_be_named_or_given(self):
+        import json
+        self.assertEqual(JSONConsumer('json').decoder, json.loads)
+        random_value = random.randint(1,100)
+        c = JSONConsumer(lambda data: random_value)
+        self.assertEqual(c.handle(None, '{}'), random_value)
+        self.assertEqual(JSONConsumer().decoder, default_decoder())
+
+class TestOfDecoders(unittest.TestCase):
+    def test_available_decoders_follow_preference_and_include_stdlib(self):
+        available = available_decoders()
+        self.assertTrue('json' in available)
+        self.assertEqual(default_decoder(), get_decoder(available[0]))
+
+    def test_unknown_or_missing_decoders_raise(self):
+        self.assertRaises(KeyError, get_decoder, 'rand-%d' % random.randint(1,100))
+
+    def test_every_backend_agrees_on_twitter_payloads(self):
+        import bench
+        payloads = [
+            simplejson.dumps(bench.twitter_timeline(random.randint(1,20))),
+            simplejson.dumps(bench.twitter_user(random.randint(1,100))),
+        ]
+        for payload in payloads:
+            expected = simplejson.loads(payload)
+            for name in available_decoders():
+                self.assertEqual(JSONConsumer(name).handle(None, payload), expected)
+
 class TestOfMenu(unittest.TestCase):
     def setUp(self):
         self.mox = mox.Mox()
@@ -132,6 +200,31 @@ class TestOfMenu(unittest.TestCase):
         self.assertEqual(results, random_return)
         self.mox.VerifyAll()
 
+    def test_accept_waiter_dispatches_subclasses(self):
+        class Path(str):
+            pass
+        class Params(dict):
+            pass
+        random_string = 'rand-%d' % random.randint(1,100)
+        waiter = Waiter(ScriptedHttp((FakeResponse(), 'ok')), consumer=Consumer())
+        self.assertTrue(waiter/Path(random_string) is waiter)
+        self.assertEqual(waiter._stack, [random_string])
+        self.assertEqual(waiter/Params(a=1), 'ok')
+
+    def test_handlers_are_resolved_once_per_class(self):
+        built = []
+        class CountingMenu(Menu):
+            @classmethod
+            def build_registry(cls):
+                built.append(cls)
+                return super(CountingMenu, cls).build_registry()
+        waiter = Waiter(menu_class=CountingMenu)
+        for i in range(random.randint(2,10)):
+            waiter/'rand'
+        self.assertEqual(built, [CountingMenu])
+        self.assertEqual(CountingMenu.handler_for(str), 'accept_str')
+        self.assertEqual(CountingMenu.handler_for(int), None)
+
     def test_accept_waiter_raises_typeerror_on_no_dispatch(self):
         random_type = type('Random_%d'%random.randint(1,100), (), {})
         oh = Menu(random_type())
@@ -165,6 +258,12 @@ class TestOfWaiter(unittest.TestCase):
         results = waiter/random_class()
         self.assertEqual(results, random_value)
 
+    def test_div_accepts_pooled_http(self):
+        http = PooledHttp()
+        waiter = Waiter()
+        self.assertTrue(waiter/http is waiter)
+        self.assertTrue(waiter._http is http)
+
     def test_init_automatically_assigns_objects(self):
         random_method = ('GET', 'POST', 'PUT', 'DELETE')[random.randint(0, 3)]
         waiter = Waiter(method=random_method)
@@ -223,6 +322,1410 @@ class TestOfWaiter(unittest.TestCase):
         self.assertRaises(Waiter.Error, waiter.__call__)
         self.mox.VerifyAll()
 
+class TestOfOrder(unittest.TestCase):
+    def twitter(self, *responses):
+        http = ScriptedHttp(*responses)
+        return Twitter(http, consumer=Consumer()), http
+
+    def test_prepare_clears_the_stack_and_cooks_the_prefix_once(self):
+        twitter, http = self.twitter((FakeResponse(), 'one'), (FakeResponse(), 'two'))
+        order = (twitter/"statuses"/"update.json").prepare()
+        self.assertTrue(isinstance(order, Order))
+        self.assertEqual(twitter._stack, [])
+        self.assertEqual((order.uri, order.method), ('https://twitter.com/statuses/update.json', 'POST'))
+        self.assertEqual(order(status='hi'), 'one')
+        self.assertEqual(order/{'status':'there'}, 'two')
+        self.assertEqual([request['body'] for request in http.requests], ['status=hi', 'status=there'])
+
+    def test_prepare_takes_more_of_the_path(self):
+        twitter, http = self.twitter()
+        self.assertEqual(twitter.prepare("users", "show.json").uri, 'https://twitter.com/users/show.json')
+        self.assertEqual((twitter/"users").prepare("show.json").uri, 'https://twitter.com/users/show.json')
+        self.assertEqual(Waiter().prepare("http://a", "b").uri, 'http://a/b')
+
+    def test_orders_are_frozen_and_hashable(self):
+        twitter, http = self.twitter()
+        order = twitter.prepare("users", "show.json")
+        self.assertRaises(AttributeError, setattr, order, 'method', 'POST')
+        self.assertRaises(AttributeError, setattr, order, 'rand', 1)
+        self.assertEqual(order, twitter.prepare("users", "show.json"))
+        self.assertNotEqual(order, twitter.prepare("users", "search.json"))
+        self.assertEqual(len(set([order, twitter.prepare("users", "show.json")])), 1)
+
+    def test_orders_can_be_shared_between_threads(self):
+        orders = random.randint(10,50)
+        twitter, http = self.twitter(*[(FakeResponse(), 'ok')] * orders)
+        order = twitter.prepare("users", "show.json")
+        threads = [threading.Thread(target=order, kwargs={'user_id':i}) for i in range(orders)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(sorted(request['uri'] for request in http.requests),
+            sorted('https://twitter.com/users/show.json?user_id=%d' % i for i in range(orders)))
+
+    def test_orders_are_cooked_by_chefs_with_their_own_cook_data(self):
+        random_value = 'random-%d' % random.randint(1,100)
+        class PickyChef(Chef):
+            def cook_data(self, stack, params):
+                if 'bad' in params:
+                    self.errors = ['bad']
+                cooked_data = super(PickyChef, self).cook_data(stack, params)
+                cooked_data['headers'] = {'x-random':random_value}
+                return cooked_data
+        http = ScriptedHttp((FakeResponse(), 'ok'))
+        order = Waiter(http, chef=PickyChef('GET'), consumer=Consumer()).prepare('http://random.com', 'a')
+        self.assertRaises(Waiter.Error, order, bad=1)
+        self.assertEqual(order(good=1), 'ok')
+        self.assertEqual(http.requests, [{'uri':'http://random.com/a?good=1', 'body':None, 'method':'GET', 'headers':{'x-random':random_value}}])
+        self.assertEqual(Waiter(http).prepare('http://random.com').stack, None)
+
+class TestOfWaiterFanOut(unittest.TestCase):
+    class FakeHttp(object):
+        thread_safe = True
+        def __init__(self):
+            self.requests = []
+        def request(self, **kwargs):
+            self.requests.append(kwargs)
+            if 'bad' in kwargs['uri']:
+                raise Waiter.Error()
+            return (None, kwargs['uri'])
+
+    def test_fan_out_returns_tickets_in_payload_order(self):
+        http = self.FakeHttp()
+        waiter = Waiter(http, consumer=Consumer())
+        payloads = [{'screen_name':'rand-%d'%i} for i in range(random.randint(1,20))]
+        tickets = waiter.fan_out('http://random.com/users/show.json', payloads, concurrency=4)
+        self.assertEqual([ticket.result(1) for ticket in tickets],
+            ['http://random.com/users/show.json?%s' % urllib.urlencode(payload) for payload in payloads])
+        self.assertEqual(len(http.requests), len(payloads))
+
+    def test_fan_out_keeps_failures_separate(self):
+        waiter = Waiter(self.FakeHttp(), consumer=Consumer())
+        tickets = waiter.fan_out(['http://random.com'], [{'a':'good'}, {'a':'bad'}, {'a':'good'}])
+        self.assertEqual(tickets[0].result(1), 'http://random.com?a=good')
+        self.assertRaises(Waiter.Error, tickets[1].result, 1)
+        self.assertEqual(tickets[2].result(1), 'http://random.com?a=good')
+
+    def test_fan_out_fails_tickets_the_chef_rejects(self):
+        class PickyChef(Chef):
+            def cook_data(self, stack, params):
+                if 'bad' in params:
+                    self.errors = ['bad']
+                return super(PickyChef, self).cook_data(stack, params)
+        waiter = Waiter(self.FakeHttp(), chef=PickyChef('GET'), consumer=Consumer())
+        tickets = waiter.fan_out('http://random.com', [{'bad':1}, {'good':1}])
+        self.assertRaises(Waiter.Error, tickets[0].result, 1)
+        self.assertEqual(tickets[1].result(1), 'http://random.com?good=1')
+
+    def test_fan_out_unordered_yields_every_ticket(self):
+        waiter = Waiter(self.FakeHttp(), consumer=Consumer())
+        payloads = [{'i':i} for i in range(random.randint(1,20))]
+        results = [ticket.result() for ticket in waiter.fan_out('http://random.com', payloads, ordered=False)]
+        self.assertEqual(sorted(results), sorted('http://random.com?i=%d' % i for i in range(len(payloads))))
+
+    def test_fan_out_gives_each_thread_a_copy_of_unsafe_http(self):
+        class UnsafeHttp(object):
+            def request(self, **kwargs):
+                return (None, self)
+        http = UnsafeHttp()
+        waiter = Waiter(http, consumer=Consumer())
+        result = waiter.fan_out('http://random.com', [{}], concurrency=1)[0].result(1)
+        self.assertTrue(isinstance(result, UnsafeHttp))
+        self.assertFalse(result is http)
+
+class TestOfWaiterPaginate(unittest.TestCase):
+    class PagedHttp(object):
+        thread_safe = True
+        def __init__(self, pages):
+            self.pages = pages
+            self.requests = []
+            self.requested = threading.Event()
+        def request(self, **kwargs):
+            self.requests.append(kwargs['uri'])
+            self.requested.set()
+            cursor = int(kwargs['uri'].split('cursor=')[1].split('&')[0])
+            index = 0 if cursor == -1 else cursor
+            next_cursor = index + 1 if index + 1 < len(self.pages) else 0
+            return (FakeResponse(), simplejson.dumps({'ids':self.pages[index], 'next_cursor':next_cursor}))
+
+    def random_pages(self):
+        return [[random.randint(1,100) for i in range(random.randint(0,5))] for j in range(random.randint(1,5))]
+
+    def test_paginate_walks_every_page(self):
+        pages = self.random_pages()
+        http = self.PagedHttp(pages)
+        twitter = Twitter(http)
+        results = twitter.paginate('followers/ids.json', {'screen_name':'isntitvacant'})
+        self.assertEqual(http.requests, [])
+        self.assertEqual(list(results), sum(pages, []))
+        self.assertEqual(len(http.requests), len(pages))
+        self.assertTrue(http.requests[0].startswith('https://twitter.com/followers/ids.json?'))
+        self.assertTrue('screen_name=isntitvacant' in http.requests[-1])
+
+    def test_paginate_prefetches_the_next_page(self):
+        http = self.PagedHttp([[1, 2], [3]])
+        results = Twitter(http).paginate('followers/ids.json', prefetch=True)
+        self.assertEqual(results.next(), 1)
+        while len(http.requests) < 2:
+            time.sleep(0.001)
+        self.assertEqual(list(results), [2, 3])
+        self.assertEqual(len(http.requests), 2)
+
+    def test_paginate_is_a_single_page_for_plain_consumers(self):
+        http = ScriptedHttp((FakeResponse(), '[1, 2, 3]'))
+        self.assertEqual(list(Waiter(http).paginate('http://random.com/things.json')), [1, 2, 3])
+        self.assertEqual(http.requests[0]['uri'], 'http://random.com/things.json?')
+
+    def test_paginate_raises_chef_errors(self):
+        class GrumpyChef(Chef):
+            def cook_data(self, stack, params):
+                self.errors = ['grumpy']
+                return super(GrumpyChef, self).cook_data(stack, params)
+        waiter = Waiter(ScriptedHttp(), chef=GrumpyChef('GET'))
+        self.assertRaises(Waiter.Error, list, waiter.paginate('http://random.com'))
+
+class TestOfTicket(unittest.TestCase):
+    def test_result_returns_fulfilled_value(self):
+        random_value = random.randint(1,100)
+        ticket = Ticket()
+        self.assertFalse(ticket.done())
+        ticket.fulfill(random_value)
+        self.assertTrue(ticket.done())
+        self.assertEqual(ticket.result(), random_value)
+        self.assertEqual(ticket.exception(), None)
+
+    def test_result_reraises_failure(self):
+        ticket = Ticket()
+        try:
+            raise Waiter.Error('rand-%d'%random.randint(1,100))
+        except Waiter.Error:
+            ticket.fail()
+        self.assertRaises(Waiter.Error, ticket.result)
+        self.assertTrue(isinstance(ticket.exception(), Waiter.Error))
+
+    def test_result_times_out_if_not_done(self):
+        self.assertRaises(Ticket.Timeout, Ticket().result, 0.01)
+
+    def test_callbacks_fire_on_settle_and_after(self):
+        seen = []
+        ticket = Ticket()
+        ticket.add_done_callback(seen.append)
+        ticket.fulfill(random.randint(1,100))
+        ticket.add_done_callback(seen.append)
+        self.assertEqual(seen, [ticket, ticket])
+
+    def test_failed_builds_a_failed_ticket(self):
+        ticket = Ticket.failed(Waiter.Error())
+        self.assertTrue(ticket.done())
+        self.assertRaises(Waiter.Error, ticket.result)
+
+    def test_as_completed_yields_in_completion_order(self):
+        tickets = [Ticket() for i in range(3)]
+        tickets[2].fulfill(2)
+        results = as_completed(tickets)
+        self.assertTrue(results.next() is tickets[2])
+        tickets[0].fulfill(0)
+        self.assertTrue(results.next() is tickets[0])
+        tickets[1].fulfill(1)
+        self.assertTrue(results.next() is tickets[1])
+
+class TestOfBrigade(unittest.TestCase):
+    def test_submit_runs_function_and_returns_ticket(self):
+        brigade = Brigade(cooks=2)
+        random_value = random.randint(1,100)
+        ticket = brigade.submit(lambda x, y=0: x + y, random_value, y=random_value)
+        self.assertEqual(ticket.result(1), random_value * 2)
+        brigade.shutdown()
+
+    def test_submit_captures_exceptions(self):
+        brigade = Brigade(cooks=1)
+        def boom():
+            raise Waiter.Error()
+        self.assertRaises(Waiter.Error, brigade.submit(boom).result, 1)
+        brigade.shutdown()
+
+    def test_results_raise_with_the_cooks_traceback(self):
+        brigade = Brigade(cooks=1)
+        def boom():
+            raise Waiter.Error()
+        ticket = brigade.submit(boom)
+        try:
+            ticket.result(1)
+        except Waiter.Error:
+            self.assertEqual(traceback.extract_tb(sys.exc_info()[2])[-1][2], 'boom')
+        else:
+            self.fail("result() didn't raise")
+        brigade.shutdown()
+
+class TestOfThreadLocalHttp(unittest.TestCase):
+    def test_each_thread_gets_its_own_http(self):
+        made = []
+        class FakeHttp(object):
+            def __init__(self):
+                made.append(self)
+            def request(self, **kwargs):
+                return self
+        http = ThreadLocalHttp(factory=FakeHttp)
+        first = http.request(uri='a')
+        self.assertTrue(http.request(uri='b') is first)
+        thread = threading.Thread(target=http.request)
+        thread.start()
+        thread.join()
+        self.assertEqual(len(made), 2)
+
+class FakeConnection(object):
+    def __init__(self):
+        self.closed = False
+    def close(self):
+        self.closed = True
+
+class TestOfConnectionPool(unittest.TestCase):
+    def test_checkout_misses_then_hits(self):
+        pool = ConnectionPool()
+        key = 'http:rand-%d' % random.randint(1,100)
+        self.assertEqual(pool.checkout(key), None)
+        conn = FakeConnection()
+        pool.checkin(key, conn)
+        self.assertTrue(pool.checkout(key) is conn)
+        stats = pool.stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['busy']), (1, 1, 1))
+
+    def test_checkout_expires_idle_connections(self):
+        now = [0]
+        pool = ConnectionPool(idle_timeout=10, clock=lambda: now[0])
+        pool.checkout('key')
+        conn = FakeConnection()
+        pool.checkin('key', conn)
+        now[0] = 11
+        self.assertEqual(pool.checkout('key'), None)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.expired, 1)
+
+    def test_checkout_waits_for_a_free_slot(self):
+        pool = ConnectionPool(max_per_host=1)
+        pool.checkout('key')
+        conn = FakeConnection()
+        got = []
+        thread = threading.Thread(target=lambda: got.append(pool.checkout('key')))
+        thread.start()
+        while not pool.waits:
+            thread.join(0.001)
+        self.assertEqual(got, [])
+        pool.checkin('key', conn)
+        thread.join()
+        self.assertEqual(got, [conn])
+
+    def test_discard_closes_and_frees_slot(self):
+        pool = ConnectionPool(max_per_host=1)
+        pool.checkout('key')
+        conn = FakeConnection()
+        pool.discard('key', conn)
+        self.assertTrue(conn.closed)
+        self.assertEqual(pool.stats()['busy'], 0)
+
+    def test_shared_pool_is_process_wide(self):
+        self.assertTrue(shared_pool() is shared_pool())
+        self.assertTrue(PooledHttp()._pool is shared_pool())
+
+class TestOfPooledMixin(unittest.TestCase):
+    class FakeHttp(object):
+        def __init__(self):
+            self.connections = {}
+        def __getstate__(self):
+            return dict(self.__dict__)
+        def __setstate__(self, state):
+            self.__dict__.update(state)
+            self.connections = {}
+        def request(self, uri, method='GET', body=None):
+            conn = self.connections.get('http:random.com')
+            if conn is None:
+                conn = self.connections['http:random.com'] = FakeConnection()
+            if 'bad' in uri:
+                raise Waiter.Error()
+            return (None, conn)
+
+    class PooledFakeHttp(PooledMixin, FakeHttp):
+        pass
+
+    def test_request_reuses_connections_across_instances(self):
+        pool = ConnectionPool()
+        first = self.PooledFakeHttp(pool=pool).request('http://random.com/a')[1]
+        second = self.PooledFakeHttp(pool=pool).request(uri='http://random.com/b')[1]
+        self.assertTrue(first is second)
+        self.assertEqual((pool.hits, pool.misses), (1, 1))
+
+    def test_connections_only_go_to_instances_set_up_the_same(self):
+        pool = ConnectionPool()
+        first = PooledHttp(pool=pool, timeout=5)
+        self.assertEqual(first.pool_key('https', 'random.com'), PooledHttp(pool=pool, timeout=5).pool_key('https', 'random.com'))
+        unchecked = PooledHttp(pool=pool, timeout=5, disable_ssl_certificate_validation=True)
+        certified = PooledHttp(pool=pool, timeout=5)
+        certified.add_certificate('key.pem', 'cert.pem', 'random.com')
+        proxied = PooledHttp(pool=pool, timeout=5, proxy_info=httplib2.ProxyInfo(3, 'proxy', random.randint(1000,2000)))
+        keys = [http.pool_key('https', 'random.com') for http in (first, unchecked, certified, proxied, PooledHttp(pool=pool, ca_certs='ca.pem'))]
+        self.assertEqual(len(set(keys)), len(keys))
+        self.assertEqual(certified.pool_key('https', 'other.com'), first.pool_key('https', 'other.com'))
+
+    def test_request_discards_connection_on_error(self):
+        pool = ConnectionPool()
+        http = self.PooledFakeHttp(pool=pool)
+        self.assertRaises(Waiter.Error, http.request, 'http://random.com/bad')
+        self.assertEqual(pool.stats()['idle'], 0)
+        self.assertEqual(pool.stats()['busy'], 0)
+        self.assertEqual(http.connections, {})
+
+    def test_connections_are_per_thread(self):
+        http = self.PooledFakeHttp(pool=ConnectionPool())
+        http.connections['rand'] = FakeConnection()
+        seen = []
+        thread = threading.Thread(target=lambda: seen.append(dict(http.connections)))
+        thread.start()
+        thread.join()
+        self.assertEqual(seen, [{}])
+
+    def test_copies_share_the_pool(self):
+        import copy
+        pool = ConnectionPool()
+        http = self.PooledFakeHttp(pool=pool)
+        self.assertTrue(copy.copy(http)._pool is pool)
+
+class FakeResponse(dict):
+    def __init__(self, status=200, headers=None):
+        super(FakeResponse, self).__init__(headers or {})
+        self.status = status
+
+class ScriptedHttp(object):
+    thread_safe = True
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+    def request(self, **kwargs):
+        self.requests.append(kwargs)
+        return self.responses.pop(0)
+
+class CountingConsumer(Consumer):
+    def __init__(self):
+        self.handled = 0
+    def handle(self, response, data):
+        self.handled += 1
+        return simplejson.loads(data)
+
+class TestOfMemoryStore(unittest.TestCase):
+    def test_get_returns_what_was_set(self):
+        store = MemoryStore()
+        entry = CacheEntry(random.randint(1,100), 1, 0)
+        store.set('key', entry)
+        self.assertTrue(store.get('key') is entry)
+        self.assertEqual(store.get('other'), None)
+
+    def test_set_evicts_least_recently_used_past_max_bytes(self):
+        store = MemoryStore(max_bytes=10)
+        store.set('a', CacheEntry('a', 4, 0))
+        store.set('b', CacheEntry('b', 4, 0))
+        store.get('a')
+        store.set('c', CacheEntry('c', 4, 0))
+        self.assertEqual(store.get('b'), None)
+        self.assertEqual(store.get('a').parsed, 'a')
+        self.assertEqual(store.bytes, 8)
+        self.assertEqual(store.evictions, 1)
+
+class TestOfDiskStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_entries_survive_a_new_store(self):
+        key = ('GET', 'http://random-%d.com' % random.randint(1,100), None)
+        random_value = {'rand':random.randint(1,100)}
+        DiskStore(self.directory).set(key, CacheEntry(random_value, 1, 10, etag='"x"'))
+        entry = DiskStore(self.directory).get(key)
+        self.assertEqual(entry.parsed, random_value)
+        self.assertEqual(entry.etag, '"x"')
+
+    def test_delete_and_missing(self):
+        store = DiskStore(self.directory)
+        store.set('key', CacheEntry(1, 1, 0))
+        store.delete('key')
+        self.assertEqual(store.get('key'), None)
+        store.delete('key')
+
+class TestOfResponseCache(unittest.TestCase):
+    def setUp(self):
+        self.now = [0]
+        self.cache = ResponseCache(ttls={'users/show':10}, default_ttl=1, clock=lambda: self.now[0])
+        self.consumer = CountingConsumer()
+        self.cooked = {'method':'GET', 'uri':'https://twitter.com/users/show.json?screen_name=a', 'body':None}
+
+    def test_fresh_entries_skip_the_network(self):
+        http = ScriptedHttp((FakeResponse(), '{"id": 1}'))
+        self.assertEqual(self.cache.serve(self.cooked, http, self.consumer), {'id':1})
+        self.now[0] = 9
+        self.assertEqual(self.cache.serve(dict(self.cooked), http, self.consumer), {'id':1})
+        self.assertEqual(len(http.requests), 1)
+        self.assertEqual(self.consumer.handled, 1)
+        self.assertEqual(self.cache.stats(), {'hits':1, 'misses':1, 'revalidations':0})
+
+    def test_ttl_for_uses_endpoint(self):
+        self.assertEqual(self.cache.ttl_for('https://twitter.com/users/show.json?a=b'), 10)
+        self.assertEqual(self.cache.ttl_for('https://twitter.com/trends/current.json'), 1)
+
+    def test_stale_entries_revalidate_and_304_skips_consumer(self):
+        http = ScriptedHttp(
+            (FakeResponse(headers={'etag':'"v1"', 'last-modified':'then'}), '{"id": 1}'),
+            (FakeResponse(304), ''),
+        )
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.now[0] = 11
+        self.assertEqual(self.cache.serve(self.cooked, http, self.consumer), {'id':1})
+        self.assertEqual(http.requests[1]['headers'], {'if-none-match':'"v1"', 'if-modified-since':'then'})
+        self.assertEqual(self.consumer.handled, 1)
+        self.assertEqual(self.cache.revalidations, 1)
+        self.now[0] = 20
+        self.assertEqual(self.cache.serve(self.cooked, http, self.consumer), {'id':1})
+
+    def test_changed_resources_replace_the_entry(self):
+        http = ScriptedHttp((FakeResponse(headers={'etag':'"v1"'}), '{"id": 1}'), (FakeResponse(), '{"id": 2}'))
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.now[0] = 11
+        self.assertEqual(self.cache.serve(self.cooked, http, self.consumer), {'id':2})
+        self.assertEqual(self.cache.store.get(self.cache.key(self.cooked)).parsed, {'id':2})
+
+    def test_only_caches_get(self):
+        self.cooked['method'] = 'POST'
+        http = ScriptedHttp((FakeResponse(), '{"id": 1}'), (FakeResponse(), '{"id": 1}'))
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.assertEqual(len(http.requests), 2)
+        self.assertEqual(len(self.cache.store), 0)
+
+    def test_waiter_serves_through_cache(self):
+        http = ScriptedHttp((FakeResponse(), '{"id": 1}'))
+        waiter = Waiter(http, cache=self.cache)
+        self.assertEqual(waiter/"https://twitter.com/users/show.json"/{'screen_name':'a'}, {'id':1})
+        self.assertEqual(waiter/"https://twitter.com/users/show.json"/{'screen_name':'a'}, {'id':1})
+        self.assertEqual(len(http.requests), 1)
+
+def fill_shared_cache(path, cooked, body):
+    cache = SharedCache(path, slots=64, slot_size=4096)
+    cache.serve(cooked, ScriptedHttp((FakeResponse(headers={'content-type':'application/json'}), body)), CountingConsumer())
+
+class TestOfSharedCache(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'cache')
+        self.now = [1000.0]
+        self.cache = self.shared_cache()
+        self.consumer = CountingConsumer()
+        self.cooked = {'method':'GET', 'uri':'https://twitter.com/users/show.json?screen_name=%d' % random.randint(1,100), 'body':None}
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def shared_cache(self, **options):
+        options = dict({'slots':64, 'slot_size':4096, 'ttls':{'users/show':10}, 'default_ttl':1, 'clock':lambda: self.now[0]}, **options)
+        return SharedCache(self.path, **options)
+
+    def test_processes_share_what_they_fetch(self):
+        body = simplejson.dumps({'id':random.randint(1,100)})
+        worker = multiprocessing.Process(target=fill_shared_cache, args=(self.path, self.cooked, body))
+        worker.start()
+        worker.join()
+        http = ScriptedHttp()
+        cache = SharedCache(self.path, slots=64, slot_size=4096)
+        self.assertEqual(cache.serve(self.cooked, http, self.consumer), simplejson.loads(body))
+        self.assertEqual(http.requests, [])
+        self.assertEqual(cache.stats()['bytes_saved'], len(body))
+
+    def test_consumers_get_the_stored_response(self):
+        class HeaderConsumer(Consumer):
+            def handle(self, response, data):
+                return response.status, response['content-type'], data
+        http = ScriptedHttp((FakeResponse(headers={'content-type':'application/json'}), '{"id": 1}'))
+        self.cache.serve(self.cooked, http, HeaderConsumer())
+        self.assertEqual(self.shared_cache().serve(self.cooked, http, HeaderConsumer()), (200, 'application/json', '{"id": 1}'))
+
+    def test_entries_expire_with_their_ttl(self):
+        http = ScriptedHttp((FakeResponse(), '{"id": 1}'), (FakeResponse(), '{"id": 2}'))
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.now[0] += 9
+        self.assertEqual(self.cache.serve(self.cooked, http, self.consumer), {'id':1})
+        self.now[0] += 2
+        self.assertEqual(self.cache.serve(self.cooked, http, self.consumer), {'id':2})
+        self.assertEqual(len(http.requests), 2)
+
+    def test_only_good_gets_are_kept(self):
+        posted = dict(self.cooked, method='POST')
+        http = ScriptedHttp((FakeResponse(), '{}'), (FakeResponse(), '{}'), (FakeResponse(404), '{}'), (FakeResponse(404), '{}'))
+        self.cache.serve(posted, http, self.consumer)
+        self.cache.serve(posted, http, self.consumer)
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.assertEqual(len(http.requests), 4)
+
+    def test_clock_evicts_what_nobody_has_read(self):
+        table = MappedTable(self.path + '-small', slots=2, slot_size=256, ways=2)
+        table.set('read', '1', 1e12)
+        table.set('unread', '2', 1e12)
+        table.get('read')
+        table.set('new', '3', 1e12)
+        self.assertEqual((table.get('read'), table.get('unread'), table.get('new')), ('1', None, '3'))
+        self.assertEqual(table.evictions, 1)
+
+    def test_oversize_responses_are_not_kept(self):
+        body = simplejson.dumps(['x' * 100] * 100)
+        http = ScriptedHttp((FakeResponse(), body), (FakeResponse(), body))
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.cache.serve(self.cooked, http, self.consumer)
+        self.assertEqual(len(http.requests), 2)
+        self.assertEqual(self.cache.stats()['oversize'], 2)
+
+    def test_torn_slots_read_as_misses(self):
+        table = self.cache.table
+        table.set('key', 'value', 1e12)
+        offset = [offset for offset in table._offsets(table._digest('key')) if table.SLOT.unpack_from(table._map, offset)[4]][0]
+        table._map[offset + table.SLOT.size + 3] = 'X'
+        self.assertEqual(table.get('key'), None)
+
+    def test_mismatched_tables_are_refused(self):
+        self.assertRaises(ValueError, SharedCache, self.path, slots=128, slot_size=4096)
+
+    def test_stats_count_hits_and_bytes_saved(self):
+        http = ScriptedHttp((FakeResponse(), '{"id": 1}'))
+        for i in range(4):
+            self.cache.serve(self.cooked, http, self.consumer)
+        self.assertEqual(self.cache.stats()['hit_ratio'], 0.75)
+        self.assertEqual(self.cache.stats()['bytes_saved'], 3 * len('{"id": 1}'))
+
+    def test_waiter_consults_it_before_the_network(self):
+        http = ScriptedHttp((FakeResponse(), '{"id": 1}'))
+        waiter = Waiter(http, cache=self.cache)
+        self.assertEqual(waiter/'https://twitter.com'/'users'/'show.json'/{'screen_name':'a'}, {'id':1})
+        self.assertEqual(waiter/'https://twitter.com'/'users'/'show.json'/{'screen_name':'a'}, {'id':1})
+        self.assertEqual(len(http.requests), 1)
+
+class TestOfSingleFlight(unittest.TestCase):
+    class GatedHttp(object):
+        thread_safe = True
+        def __init__(self, body='{"id": 1}'):
+            self.gate = threading.Event()
+            self.arrived = threading.Event()
+            self.requests = []
+            self.body = body
+        def request(self, **kwargs):
+            self.requests.append(kwargs)
+            self.arrived.set()
+            self.gate.wait()
+            if self.body is None:
+                raise Waiter.Error()
+            return (FakeResponse(), self.body)
+
+    def spawn(self, fn):
+        results = []
+        def run():
+            try:
+                results.append(fn())
+            except Exception as e:
+                results.append(e)
+        thread = threading.Thread(target=run)
+        thread.start()
+        return thread, results
+
+    def wait_for_followers(self, flight, count):
+        while flight.followers < count:
+            time.sleep(0.001)
+
+    def test_identical_orders_share_one_request(self):
+        flight = SingleFlight()
+        http = self.GatedHttp()
+        consumer = CountingConsumer()
+        cooked = {'method':'GET', 'uri':'http://random.com/users/show.json?a=1', 'body':None}
+        leader, leader_results = self.spawn(lambda: flight.serve(cooked, http, consumer))
+        http.arrived.wait()
+        followers = [self.spawn(lambda: flight.serve(dict(cooked), http, consumer)) for i in range(random.randint(1,10))]
+        self.wait_for_followers(flight, len(followers))
+        http.gate.set()
+        for thread, results in [(leader, leader_results)] + followers:
+            thread.join()
+            self.assertEqual(results, [{'id':1}])
+        self.assertEqual(len(http.requests), 1)
+        self.assertEqual(consumer.handled, 1)
+        self.assertEqual(flight.stats(), {'leaders':1, 'followers':len(followers)})
+
+    def test_followers_share_failures(self):
+        flight = SingleFlight()
+        http = self.GatedHttp(body=None)
+        cooked = {'method':'GET', 'uri':'http://random.com/', 'body':None}
+        leader, leader_results = self.spawn(lambda: flight.serve(cooked, http, Consumer()))
+        http.arrived.wait()
+        follower, follower_results = self.spawn(lambda: flight.serve(cooked, http, Consumer()))
+        self.wait_for_followers(flight, 1)
+        http.gate.set()
+        leader.join()
+        follower.join()
+        self.assertTrue(isinstance(leader_results[0], Waiter.Error))
+        self.assertTrue(follower_results[0] is leader_results[0])
+        self.assertEqual(flight._in_flight, {})
+
+    def test_does_not_coalesce_posts_and_uses_backend(self):
+        calls = []
+        class Backend(object):
+            def serve(self, cooked_data, http, consumer):
+                calls.append(cooked_data)
+                return len(calls)
+        flight = SingleFlight(Backend())
+        cooked = {'method':'POST', 'uri':'http://random.com/statuses/update.json', 'body':'status=hi'}
+        self.assertEqual(flight.serve(cooked, None, None), 1)
+        self.assertEqual(flight.serve(cooked, None, None), 2)
+        self.assertEqual(flight.leaders, 0)
+
+class TestOfItemScanner(unittest.TestCase):
+    def scan_in_pieces(self, document, path):
+        text = simplejson.dumps(document)
+        size = random.randint(1, len(text))
+        scanner = ItemScanner(path)
+        items = []
+        for i in range(0, len(text), size):
+            items.extend(scanner.feed(text[i:i + size]))
+        return scanner, items
+
+    def test_yields_root_array_elements(self):
+        document = [{'a':'b,]\\"}', 'c':[1, {'d':2}]}, 'str\\', 3.5, None, True, [1, 2]]
+        for size in range(1, len(simplejson.dumps(document)) + 1):
+            scanner = ItemScanner()
+            text = simplejson.dumps(document)
+            items = []
+            for i in range(0, len(text), size):
+                items.extend(scanner.feed(text[i:i + size]))
+            self.assertEqual(items, document)
+
+    def test_yields_array_at_path_and_collects_extras(self):
+        ids = [random.randint(1,100) for i in range(random.randint(0,50))]
+        scanner, items = self.scan_in_pieces({'ids':ids, 'next_cursor':5, 'other':{'ids':[0]}, 'error':'x'}, ['ids'])
+        self.assertEqual(items, ids)
+        self.assertEqual(scanner.extras, {'next_cursor':5, 'error':'x'})
+
+    def test_follows_nested_paths(self):
+        scanner, items = self.scan_in_pieces({'a':{'b':[10, 'x', {'y':[]}]}, 'b':[1]}, ['a', 'b'])
+        self.assertEqual(items, [10, 'x', {'y':[]}])
+
+    def test_yields_nothing_when_path_is_missing(self):
+        scanner, items = self.scan_in_pieces({'error':'Not authorized'}, ['ids'])
+        self.assertEqual(items, [])
+        self.assertEqual(scanner.extras, {'error':'Not authorized'})
+
+class TestOfStreamingJSONConsumer(unittest.TestCase):
+    def test_handle_returns_generator_over_items(self):
+        ids = [random.randint(1,100) for i in range(random.randint(1,50))]
+        consumer = StreamingJSONConsumer(path=['ids'], chunk_size=random.randint(1,10))
+        results = consumer.handle(FakeResponse(), simplejson.dumps({'ids':ids}))
+        self.assertEqual(list(results), ids)
+
+    def test_handle_reads_file_likes_and_iterables(self):
+        import StringIO
+        consumer = StreamingJSONConsumer(chunk_size=2)
+        self.assertEqual(list(consumer.handle(FakeResponse(), StringIO.StringIO('[1, 2, 3]'))), [1, 2, 3])
+        self.assertEqual(list(consumer.handle(FakeResponse(), iter(['[1, ', '2]']))), [1, 2])
+
+    def test_checker_runs_twitter_error_handling(self):
+        consumer = StreamingJSONConsumer(path=['ids'], checker=TwitterConsumer())
+        self.assertRaises(TwitterException, consumer.handle, FakeResponse(503), '')
+        results = consumer.handle(FakeResponse(), '{"error": "Not authorized"}')
+        self.assertRaises(TwitterException, list, results)
+
+class TestOfProjection(unittest.TestCase):
+    def test_record_type_is_made_once_per_fields(self):
+        record = record_type(('id', 'user.screen_name'))
+        self.assertTrue(record is record_type(['id', 'user.screen_name']))
+        self.assertEqual(record._fields, ('id', 'user_screen_name'))
+        random_value = random.randint(1,100)
+        self.assertEqual(cPickle.loads(cPickle.dumps(record(random_value, 'x'), 2)), (random_value, 'x'))
+        self.assertTrue(isinstance(cPickle.loads(cPickle.dumps(record(random_value, 'x'), 2)), record))
+
+    def test_project_picks_out_fields(self):
+        random_value = random.randint(1,100)
+        projection = Projection('id', 'user.screen_name', 'user.missing', 'missing.deeper')
+        record = projection.project({'id':random_value, 'text':'random', 'user':{'screen_name':'isntitvacant'}, 'missing':1})
+        self.assertEqual(record, (random_value, 'isntitvacant', None, None))
+        self.assertEqual((record.id, record.user_screen_name), (random_value, 'isntitvacant'))
+        self.assertTrue(isinstance(record, tuple))
+        self.assertEqual(record.__class__.__slots__, ())
+
+    def test_project_lists_and_streams(self):
+        items = [{'id':random.randint(1,100), 'text':'random'} for i in range(random.randint(1,10))]
+        projection = Projection('id')
+        self.assertEqual(projection.project(items), [(item['id'],) for item in items])
+        projected = projection.project(item for item in items)
+        self.assertFalse(isinstance(projected, list))
+        self.assertEqual(list(projected), [(item['id'],) for item in items])
+        random_value = random.randint(1,100)
+        self.assertEqual(projection.project(random_value), random_value)
+
+    def test_project_within_keeps_the_envelope(self):
+        random_value = random.randint(1,100)
+        page = {'users':[{'id':random_value, 'name':'random'}], 'next_cursor':random_value}
+        projected = Projection('id', within='users').project(page)
+        self.assertEqual(projected, {'users':[(random_value,)], 'next_cursor':random_value})
+        self.assertEqual(page['users'], [{'id':random_value, 'name':'random'}])
+        self.assertRaises(TypeError, Projection, 'id', random=random_value)
+
+    def test_dividing_by_a_projection_projects_that_order(self):
+        random_value = random.randint(1,100)
+        body = simplejson.dumps([{'id':random_value, 'text':'random'}])
+        http = ScriptedHttp((FakeResponse(200), body), (FakeResponse(200), body))
+        waiter = Waiter(http)
+        self.assertEqual(waiter/'random'/Projection('id')/{}, [(random_value,)])
+        self.assertEqual((waiter._stack, waiter._consumer.__class__), ([], JSONConsumer))
+        self.assertEqual(waiter/'random'/{}, [{'id':random_value, 'text':'random'}])
+
+    def test_prepared_orders_keep_their_projection(self):
+        random_value = random.randint(1,100)
+        http = ScriptedHttp(*[(FakeResponse(200), '[{"id": %d}]' % i) for i in range(3)])
+        order = (Waiter(http)/'random'/Projection('id')).prepare()
+        self.assertEqual([order(page=i) for i in range(3)], [[(i,)] for i in range(3)])
+
+    def test_consumer_projects_streams_and_pages_through_its_consumer(self):
+        ids = [random.randint(1,100) for i in range(random.randint(1,10))]
+        consumer = ProjectingConsumer(StreamingJSONConsumer(chunk_size=3), ('id',))
+        self.assertEqual(list(consumer.handle(FakeResponse(), simplejson.dumps([{'id':id} for id in ids]))), [(id,) for id in ids])
+        consumer = ProjectingConsumer(TwitterConsumer(), Projection('id', within='users'))
+        page = consumer.handle(FakeResponse(), simplejson.dumps({'users':[{'id':id} for id in ids], 'next_cursor':7}))
+        self.assertEqual(consumer.next_page(page), ([(id,) for id in ids], {'cursor':7}))
+
+class TestOfResponseBody(unittest.TestCase):
+    class FakeHTTPResponse(object):
+        def __init__(self, body, will_close=False):
+            import StringIO
+            self.body = StringIO.StringIO(body)
+            self.will_close = will_close
+        def read(self, size=-1):
+            return self.body.read(size) if size else self.body.read()
+
+    def test_iterating_to_the_end_releases_for_reuse(self):
+        released = []
+        body = ResponseBody(self.FakeHTTPResponse('abcdef'), released.append, chunk_size=4)
+        self.assertEqual(list(body), ['abcd', 'ef'])
+        self.assertEqual(released, [True])
+        self.assertEqual(body.bytes_read, 6)
+
+    def test_close_before_the_end_throws_the_connection_out(self):
+        released = []
+        body = ResponseBody(self.FakeHTTPResponse('abcdef'), released.append)
+        body.read(1)
+        body.close()
+        body.close()
+        self.assertEqual(released, [False])
+        self.assertEqual(body.read(), '')
+
+    def test_will_close_connections_are_not_reused(self):
+        released = []
+        ResponseBody(self.FakeHTTPResponse('abc', will_close=True), released.append).read()
+        self.assertEqual(released, [False])
+
+class TestOfCompression(unittest.TestCase):
+    def feed(self, decompressor, data, size):
+        return ''.join(decompressor.decompress(data[i:i + size]) for i in range(0, len(data), size)) + decompressor.flush()
+
+    def test_decompressors_inflate_a_chunk_at_a_time(self):
+        import zlib
+        random_body = simplejson.dumps(range(random.randint(100,1000)))
+        raw = zlib.compressobj(6, zlib.DEFLATED, -zlib.MAX_WBITS)
+        for encoding, data in (
+                ('gzip', compress(random_body, 'gzip')),
+                ('deflate', compress(random_body, 'deflate')),
+                ('deflate', raw.compress(random_body) + raw.flush())):
+            decompressor = decompressor_for(encoding.upper())
+            self.assertEqual(self.feed(decompressor, data, random.randint(2,50)), random_body)
+            self.assertEqual((decompressor.bytes_in, decompressor.bytes_out), (len(data), len(random_body)))
+
+    def test_unknown_encodings_are_left_alone(self):
+        self.assertEqual(decompressor_for(None), None)
+        self.assertEqual(decompressor_for('identity'), None)
+        self.assertRaises(ValueError, compress, 'abc', 'rand-%d' % random.randint(1,100))
+
+    def test_accept_encoding_offers_what_is_available(self):
+        self.assertEqual(accept_encoding(), ', '.join(available_encodings()))
+        self.assertTrue(accept_encoding().startswith('gzip, deflate'))
+
+    def test_response_body_inflates_as_it_streams(self):
+        random_body = simplejson.dumps({'ids':range(random.randint(100,1000))})
+        compressed = compress(random_body)
+        released, finished = [], []
+        body = ResponseBody(TestOfResponseBody.FakeHTTPResponse(compressed), released.append,
+            chunk_size=random.randint(1,64), decompressor=decompressor_for('gzip'))
+        body.add_done_callback(finished.append)
+        self.assertEqual(''.join(body), random_body)
+        self.assertEqual((body.bytes_read, body.bytes_decoded), (len(compressed), len(random_body)))
+        self.assertEqual((released, finished), ([True], [body]))
+
+    def test_chef_compresses_post_bodies(self):
+        import gzip, StringIO
+        chef = Chef('POST', body_encoding='gzip')
+        cooked = chef.cook_data(['http://a/b'], {'status':'hi'})
+        self.assertEqual(gzip.GzipFile(fileobj=StringIO.StringIO(cooked['body'])).read(), 'status=hi')
+        self.assertEqual(cooked['headers']['content-encoding'], 'gzip')
+        self.assertFalse('headers' in Chef('GET', body_encoding='gzip').cook_data(['http://a'], {'a':1}))
+
+class TestOfStreamingHttp(unittest.TestCase):
+    def fake_connection_type(self, made, fail=()):
+        test = self
+        class FakeHTTPConnection(FakeConnection):
+            def __init__(self, authority, timeout=None):
+                super(FakeHTTPConnection, self).__init__()
+                self.authority = authority
+                made.append(self)
+            def request(self, method, request_uri, body, headers):
+                if self in fail:
+                    import httplib
+                    raise httplib.BadStatusLine('')
+                self.sent = (method, request_uri, body, headers)
+            def getresponse(self):
+                response = TestOfResponseBody.FakeHTTPResponse('[1, 2]')
+                response.status, response.reason = 200, 'OK'
+                response.getheaders = lambda: [('Content-Type', 'application/json')]
+                return response
+        return FakeHTTPConnection
+
+    def test_request_streams_body_and_reuses_connection(self):
+        made = []
+        http = StreamingHttp(pool=ConnectionPool())
+        http.connection_types = {'http':self.fake_connection_type(made)}
+        response, body = http.request('http://random.com/followers/ids.json?a=b')
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response['content-type'], 'application/json')
+        self.assertEqual(made[0].sent[:2], ('GET', '/followers/ids.json?a=b'))
+        self.assertEqual(list(StreamingJSONConsumer().handle(response, body)), [1, 2])
+        http.request('http://random.com/followers/ids.json')[1].read()
+        self.assertEqual(len(made), 1)
+        self.assertEqual(http.pool_stats()['hits'], 1)
+
+    def test_request_asks_for_compression_and_inflates(self):
+        made = []
+        http = StreamingHttp(pool=ConnectionPool())
+        FakeHTTPConnection = self.fake_connection_type(made)
+        class GzipConnection(FakeHTTPConnection):
+            def getresponse(self):
+                response = TestOfResponseBody.FakeHTTPResponse(compress('[1, 2, 3]'))
+                response.status, response.reason = 200, 'OK'
+                response.getheaders = lambda: [('Content-Encoding', 'gzip')]
+                return response
+        http.connection_types = {'http':GzipConnection}
+        response, body = http.request('http://random.com/followers/ids.json')
+        self.assertEqual(made[0].sent[3]['accept-encoding'], accept_encoding())
+        self.assertEqual((response.get('content-encoding'), response['-content-encoding']), (None, 'gzip'))
+        self.assertEqual(list(StreamingJSONConsumer().handle(response, body)), [1, 2, 3])
+
+    def test_request_sends_request_bodies_a_chunk_at_a_time(self):
+        made = []
+        http = StreamingHttp(pool=ConnectionPool())
+        FakeHTTPConnection = self.fake_connection_type(made)
+        class PuttingConnection(FakeHTTPConnection):
+            def putrequest(self, method, request_uri, **kwargs):
+                self.put, self.headers, self.chunks = (method, request_uri), {}, []
+            def putheader(self, name, value):
+                self.headers[name] = value
+            def endheaders(self):
+                pass
+            def send(self, chunk):
+                self.chunks.append(str(chunk))
+        http.connection_types = {'http':PuttingConnection}
+        random_chunks = [str(random.randint(1,100)) for i in range(random.randint(1,10))]
+        body = StreamingBody(iter(random_chunks))
+        http.request('http://random.com/upload', method='POST', body=body)[1].read()
+        self.assertEqual(made[0].put, ('POST', '/upload'))
+        self.assertEqual(made[0].headers['transfer-encoding'], 'chunked')
+        self.assertEqual(len(made[0].chunks), len(random_chunks) * 3 + 1)
+        self.assertEqual(''.join(made[0].chunks[1::3]), ''.join(random_chunks))
+
+    def test_request_retries_stale_pooled_connections(self):
+        made, stale = [], []
+        pool = ConnectionPool()
+        http = StreamingHttp(pool=pool)
+        http.connection_types = {'http':self.fake_connection_type(made, fail=stale)}
+        self.assertEqual(http.request('http://random.com/')[1].read(), '[1, 2]')
+        stale.append(made[0])
+        response, body = http.request('http://random.com/')
+        self.assertEqual(response.status, 200)
+        self.assertTrue(made[0].closed)
+        self.assertEqual(len(made), 2)
+
+    def test_request_raises_for_fresh_connections(self):
+        made = []
+        http = StreamingHttp(pool=ConnectionPool())
+        http.connection_types = {'http':self.fake_connection_type(made, fail=made)}
+        import httplib
+        self.assertRaises(httplib.BadStatusLine, http.request, 'http://random.com/')
+        self.assertEqual(http.pool_stats()['busy'], 0)
+
+class TestOfUploads(unittest.TestCase):
+    def setUp(self):
+        self.data = ''.join([chr(random.randint(0, 255)) for i in range(random.randint(100, 1000))])
+        handle, self.path = tempfile.mkstemp(suffix='.png')
+        os.write(handle, self.data)
+        os.close(handle)
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_upload_maps_files_and_slices_them(self):
+        upload = Upload(open(self.path, 'rb'), chunk_size=64)
+        self.assertEqual((upload.filename, upload.content_type), (os.path.basename(self.path), 'image/png'))
+        self.assertEqual(upload.length, len(self.data))
+        sent = []
+        for chunk in upload.chunks():
+            self.assertTrue(isinstance(chunk, buffer) and len(chunk) <= 64)
+            sent.append(str(chunk))
+        self.assertEqual(''.join(sent), self.data)
+
+    def test_upload_reads_file_likes_that_cant_be_mapped(self):
+        source = StringIO.StringIO(self.data)
+        upload = Upload(source, chunk_size=64)
+        self.assertEqual((upload.filename, upload.content_type), (None, 'application/octet-stream'))
+        self.assertEqual(upload.length, len(self.data))
+        self.assertEqual(''.join(upload.chunks()), self.data)
+        self.assertEqual(''.join(upload.chunks()), self.data)
+
+    def test_upload_of_a_generator_has_no_length(self):
+        upload = Upload(chunk for chunk in [self.data])
+        self.assertEqual(upload.length, None)
+        self.assertEqual(''.join(upload.chunks()), self.data)
+
+    def test_is_upload(self):
+        self.assertTrue(is_upload(Upload(self.path)))
+        self.assertTrue(is_upload(StringIO.StringIO()))
+        self.assertTrue(is_upload(chunk for chunk in []))
+        self.assertFalse(is_upload(self.path))
+        self.assertFalse(is_upload(random.randint(1,100)))
+
+    def test_multipart_length_matches_what_it_sends(self):
+        random_value = random.randint(1,100)
+        body = MultipartBody({'image':Upload(self.path), 'random':random_value, 'name':u'caf\xe9'})
+        sent = ''.join(str(chunk) for chunk in body.chunks())
+        self.assertEqual(len(body), len(sent))
+        self.assertEqual(body.headers(), {'content-type':body.content_type, 'content-length':str(len(sent))})
+        self.assertTrue(sent.endswith('--%s--\r\n' % body.boundary))
+        self.assertTrue(('filename="%s"\r\nContent-Type: image/png\r\n\r\n%s\r\n' % (os.path.basename(self.path), self.data)) in sent)
+        self.assertTrue(('name="random"\r\n\r\n%d\r\n' % random_value) in sent)
+        self.assertTrue('caf\xc3\xa9' in sent)
+
+    def test_body_reads_like_a_file(self):
+        body = MultipartBody({'image':open(self.path, 'rb')})
+        sent = ''.join(str(chunk) for chunk in body.chunks())
+        size = random.randint(1, 100)
+        pieces, piece = [], body.read(size)
+        while piece:
+            self.assertTrue(len(piece) <= size)
+            pieces.append(piece)
+            piece = body.read(size)
+        self.assertEqual(''.join(pieces), sent)
+        body.rewind()
+        self.assertEqual(body.read(), sent)
+
+    def test_unknown_lengths_go_chunked(self):
+        body = StreamingBody(chunk for chunk in ['ab', '', 'cde'])
+        self.assertEqual(body.headers()['transfer-encoding'], 'chunked')
+        self.assertRaises(TypeError, len, body)
+        self.assertEqual(body.read(), '2\r\nab\r\n3\r\ncde\r\n0\r\n\r\n')
+
+class PickyConsumer(JSONConsumer):
+    def handle(self, response, data):
+        parsed = super(PickyConsumer, self).handle(response, data)
+        if 'error' in parsed:
+            raise TwitterException(parsed['error'])
+        return parsed, response.status
+
+class DawdlingConsumer(Consumer):
+    def handle(self, response, data):
+        time.sleep(0.5)
+        return data
+
+class TestOfCommissary(unittest.TestCase):
+    def setUp(self):
+        self.commissary = Commissary(processes=1, slots=1, slot_size=1024)
+
+    def tearDown(self):
+        self.commissary.close()
+
+    def test_submit_decodes_bodies_through_shared_memory(self):
+        random_value = [random.randint(1,100) for i in range(random.randint(1,10))]
+        tickets = [self.commissary.submit(PickyConsumer(), FakeResponse(200), simplejson.dumps({'ids':random_value})) for i in range(3)]
+        self.assertEqual([ticket.result(5) for ticket in tickets], [({'ids':random_value}, 200)] * 3)
+        self.assertEqual(self.commissary.stats(), {'shared':3, 'pickled':0, 'free_slots':1})
+
+    def test_submit_pickles_bodies_too_big_for_a_slot(self):
+        random_value = range(random.randint(1000, 2000))
+        ticket = self.commissary.submit(PickyConsumer(), FakeResponse(200), simplejson.dumps({'ids':random_value}))
+        self.assertEqual(ticket.result(5), ({'ids':random_value}, 200))
+        self.assertEqual(self.commissary.stats()['pickled'], 1)
+
+    def test_submitting_starts_no_threads(self):
+        random_value = range(random.randint(1000, 2000))
+        threads = threading.activeCount()
+        tickets = [self.commissary.submit(PickyConsumer(), FakeResponse(200), simplejson.dumps({'ids':random_value})) for i in range(20)]
+        self.assertEqual(threading.activeCount(), threads)
+        self.assertEqual([ticket.result(5) for ticket in tickets], [({'ids':random_value}, 200)] * 20)
+
+    def test_checks_run_in_the_worker(self):
+        random_value = 'random-error-%d' % random.randint(1,100)
+        ticket = self.commissary.submit(PickyConsumer(), FakeResponse(200), simplejson.dumps({'error':random_value}))
+        self.assertTrue(isinstance(ticket.exception(5), TwitterException))
+        self.assertRaises(TwitterException, ticket.result)
+        self.assertEqual(self.commissary.stats()['free_slots'], 1)
+
+    def test_results_that_cant_come_back_fail_and_free_their_slot(self):
+        random_value = [random.randint(1,100) for i in range(random.randint(1,10))]
+        ticket = self.commissary.submit(StreamingJSONConsumer(path=['ids']), FakeResponse(200), simplejson.dumps({'ids':random_value}))
+        self.assertTrue(isinstance(ticket.exception(5), Commissary.Error))
+        ticket = self.commissary.submit(PickyConsumer(), FakeResponse(200), simplejson.dumps({'ids':random_value}))
+        self.assertEqual(ticket.result(5), ({'ids':random_value}, 200))
+        self.assertEqual(self.commissary.stats()['free_slots'], 1)
+
+    def test_consumers_that_cant_be_sent_fail(self):
+        consumer = PickyConsumer()
+        consumer.check = lambda parsed: parsed
+        self.assertTrue(isinstance(self.commissary.submit(consumer, FakeResponse(200), '{}').exception(5), Commissary.Error))
+        self.assertEqual(self.commissary.stats()['free_slots'], 1)
+
+    def test_bodies_not_handled_in_time_fail(self):
+        commissary = Commissary(processes=1, slots=1, slot_size=1024, timeout=0.05)
+        try:
+            self.assertTrue(isinstance(commissary.submit(DawdlingConsumer(), FakeResponse(200), '{}').exception(5), Commissary.Error))
+            self.assertEqual(commissary.stats()['free_slots'], 1)
+        finally:
+            commissary.close()
+
+    def test_consumer_handles_small_bodies_in_process(self):
+        consumer = CommissaryConsumer(PickyConsumer(), self.commissary, threshold=100)
+        self.assertEqual(consumer.handle(FakeResponse(200), '{"a": 1}').result(), ({'a':1}, 200))
+        self.assertRaises(TwitterException, consumer.handle(FakeResponse(200), '{"error": 1}').result)
+        self.assertEqual(consumer.handle(FakeResponse(200), '{"a": "%s"}' % ('x' * 100)).result(5), ({'a':'x' * 100}, 200))
+        self.assertEqual(self.commissary.stats()['shared'], 1)
+
+    def test_consumer_pages_once_the_page_is_in(self):
+        consumer = CommissaryConsumer(Consumer(), self.commissary)
+        random_value = random.randint(1,100)
+        self.assertEqual(consumer.first_page({'random':random_value}), {'random':random_value})
+        self.assertEqual(consumer.next_page(consumer.handle(FakeResponse(200), [random_value])), ([random_value], None))
+
+class TestOfDeadline(unittest.TestCase):
+    def test_check_raises_once_expired_or_cancelled(self):
+        clock = FakeClock()
+        random_value = random.randint(1,100)
+        deadline = Deadline(random_value, clock=clock)
+        deadline.check()
+        self.assertEqual((deadline.remaining(), deadline.timeout(), deadline.timeout(1)), (random_value, random_value, 1))
+        clock.sleep(random_value)
+        self.assertTrue(deadline.stopped())
+        self.assertRaises(Deadline.Exceeded, deadline.check)
+        token = Deadline()
+        self.assertEqual((token.remaining(), token.timeout(random_value)), (None, random_value))
+        token.cancel()
+        self.assertRaises(Deadline.Cancelled, token.check)
+        self.assertFalse(issubclass(Deadline.Exceeded, Waiter.Error))
+
+    def test_cancel_runs_aborts_until_forgotten(self):
+        aborted = []
+        deadline = Deadline()
+        forget = deadline.on_abort(lambda: aborted.append(1))
+        deadline.on_abort(lambda: aborted.append(2))
+        forget()
+        deadline.cancel()
+        deadline.on_abort(lambda: aborted.append(3))
+        self.assertEqual(aborted, [2, 3])
+
+    def test_alarm_aborts_when_time_runs_out(self):
+        aborted = threading.Event()
+        Deadline(0.01).on_abort(aborted.set)
+        self.assertTrue(aborted.wait(1) or aborted.isSet())
+
+    def test_waiter_deadline_covers_the_request(self):
+        class SlowHttp(ScriptedHttp):
+            def request(self, **kwargs):
+                time.sleep(0.05)
+                return super(SlowHttp, self).request(**kwargs)
+        waiter = Waiter(SlowHttp((FakeResponse(200), '{}'), (FakeResponse(200), '{}')), deadline=0.01)
+        self.assertRaises(Deadline.Exceeded, waiter.__call__)
+        waiter._deadline = 1
+        self.assertEqual(waiter/'random'/{}, {})
+
+    def test_waiter_deadline_covers_the_consumer(self):
+        class SlowConsumer(Consumer):
+            def handle(self, response, data):
+                time.sleep(0.05)
+                return data
+        waiter = Waiter(ScriptedHttp((FakeResponse(200), '{}')), consumer=SlowConsumer(), deadline=0.01)
+        self.assertRaises(Deadline.Exceeded, waiter.__call__)
+
+    def test_dividing_by_a_deadline_holds_that_order_to_it(self):
+        random_value = random.randint(1,100)
+        class DeadlineTakingHttp(ScriptedHttp):
+            takes_deadlines = True
+        http = DeadlineTakingHttp((FakeResponse(200), '[%d]' % random_value))
+        waiter = Waiter(http)
+        deadline = Deadline(random_value)
+        self.assertEqual(waiter/'random'/deadline/{}, [random_value])
+        self.assertTrue(http.requests[0]['deadline'] is deadline)
+        self.assertEqual((waiter._stack, waiter._deadline), ([], None))
+
+        token = Deadline()
+        token.cancel()
+        self.assertRaises(Deadline.Cancelled, (waiter/'random'/token).__call__)
+        self.assertEqual(len(http.requests), 1)
+
+    def test_deadline_http_only_passes_deadlines_to_transports_that_take_them(self):
+        http = ScriptedHttp((FakeResponse(200), '{}'))
+        DeadlineHttp(http, Deadline(1)).request('http://random.com/')
+        self.assertFalse('deadline' in http.requests[0])
+
+    def test_streamed_items_are_held_to_the_deadline(self):
+        clock = FakeClock()
+        deadline = Deadline(1, clock=clock)
+        http = ScriptedHttp((FakeResponse(200), '[1, 2, 3]'))
+        waiter = Waiter(http, consumer=StreamingJSONConsumer())
+        items = waiter/'random'/deadline/{}
+        self.assertEqual(next(items), 1)
+        clock.sleep(1)
+        self.assertRaises(Deadline.Exceeded, next, items)
+
+class TestOfDeadlinesOnTheWire(unittest.TestCase):
+    def setUp(self):
+        import bench
+        class StallingHandler(bench.LocalHandler):
+            latency = 2
+        self.server, self.root = bench.serve(StallingHandler)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def assertAbortsWithin(self, http, seconds, deadline):
+        started = time.time()
+        order = Waiter(http, deadline=deadline)/self.root
+        self.assertRaises(Deadline.Exceeded, order.__call__)
+        self.assertTrue(time.time() - started < seconds)
+        self.assertEqual(http.pool_stats()['busy'], 0)
+
+    def test_pooled_http_gives_up_and_throws_its_connection_away(self):
+        self.assertAbortsWithin(PooledHttp(pool=ConnectionPool()), 1, 0.1)
+
+    def test_streaming_http_gives_up_and_throws_its_connection_away(self):
+        self.assertAbortsWithin(StreamingHttp(pool=ConnectionPool()), 1, 0.1)
+
+    def test_cancel_aborts_orders_in_flight(self):
+        token = Deadline()
+        http = PooledHttp(pool=ConnectionPool())
+        order = Waiter(http)/self.root/token
+        threading.Timer(0.1, token.cancel).start()
+        started = time.time()
+        self.assertRaises(Deadline.Cancelled, order.__call__)
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(http.pool_stats()['busy'], 0)
+
+class TestOfPoolingOnTheWire(unittest.TestCase):
+    def setUp(self):
+        import bench
+        class Handler(bench.LocalHandler):
+            def do_GET(self):
+                if self.path == '/redirect':
+                    self.send_response(302)
+                    self.send_header('Location', '/')
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                if self.path.startswith('/missing'):
+                    self.send_response(404)
+                    self.send_header('Content-Length', '2')
+                    self.end_headers()
+                    self.wfile.write('{}')
+                    return
+                if self.path.startswith('/many'):
+                    body = simplejson.dumps(range(20000))
+                    self.send_response(200)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                    return
+                bench.LocalHandler.do_GET(self)
+        self.server, self.root = bench.serve(Handler)
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_redirects_reuse_the_connection_theyre_on(self):
+        pool = ConnectionPool(max_per_host=1)
+        http = PooledHttp(pool=pool, timeout=5)
+        for i in range(2):
+            response, data = http.request(self.root + '/redirect')
+            self.assertEqual((response.status, simplejson.loads(data)['id']), (200, 1))
+        stats = pool.stats()
+        self.assertEqual((stats['busy'], stats['idle'], stats['misses'], stats['waits']), (0, 1, 1, 0))
+
+    def test_refused_streams_give_their_connection_back(self):
+        pool = ConnectionPool(max_per_host=2)
+        waiter = Waiter(StreamingHttp(pool=pool, timeout=5), consumer=StreamingJSONConsumer(checker=TwitterConsumer()))
+        for i in range(3):
+            self.assertRaises(TwitterException, (waiter/self.root/'missing').__call__)
+        self.assertEqual(pool.stats()['busy'], 0)
+
+    def test_abandoned_streams_give_their_connection_back(self):
+        pool = ConnectionPool(max_per_host=2)
+        waiter = Waiter(StreamingHttp(pool=pool, timeout=5), consumer=StreamingJSONConsumer(chunk_size=1024))
+        for i in range(3):
+            items = waiter/self.root/'many'/{}
+            self.assertEqual(next(items), 0)
+            del items
+        unread = waiter/self.root/'many'/{}
+        del unread
+        self.assertEqual(pool.stats()['busy'], 0)
+
+    def test_adaptive_slots_come_back_with_refused_and_abandoned_streams(self):
+        limit = AIMDLimit(initial=1)
+        http = AdaptiveHttp(StreamingHttp(pool=ConnectionPool(), timeout=5), limit)
+        refusing = Waiter(http, consumer=StreamingJSONConsumer(checker=TwitterConsumer()))
+        self.assertRaises(TwitterException, (refusing/self.root/'missing').__call__)
+        self.assertEqual(limit.in_flight, 0)
+        items = Waiter(http, consumer=StreamingJSONConsumer(chunk_size=1024))/self.root/'many'/{}
+        self.assertEqual(next(items), 0)
+        del items
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_bodies_are_closed_when_the_consumer_raises(self):
+        class RefusingConsumer(Consumer):
+            def handle(self, response, data):
+                raise Waiter.Error()
+        pool = ConnectionPool(max_per_host=1)
+        waiter = Waiter(StreamingHttp(pool=pool, timeout=5), consumer=RefusingConsumer(), cache=ResponseCache())
+        for i in range(2):
+            self.assertRaises(Waiter.Error, (waiter/self.root/'many').__call__)
+        self.assertEqual(pool.stats()['busy'], 0)
+
+def has_h2():
+    try:
+        import h2.connection
+    except ImportError:
+        return False
+    return True
+
+@unittest.skipUnless(has_h2(), 'needs the h2 package')
+class TestOfMultiplexedHttp(unittest.TestCase):
+    def serve(self, **attrs):
+        import bench
+        class Handler(bench.H2Handler):
+            pass
+        for name, value in attrs.items():
+            setattr(Handler, name, value)
+        self.server, self.root = bench.serve_h2(Handler)
+        self.http = MultiplexedHttp(**self.options)
+        return self.server
+
+    options = {}
+
+    def tearDown(self):
+        self.http.close()
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_concurrent_orders_share_one_connection(self):
+        self.serve(latency=0.1)
+        waiter = Waiter(self.http)
+        payloads = [{'screen_name':'user%d' % i} for i in range(random.randint(10, 20))]
+        started = time.time()
+        results = [ticket.result() for ticket in waiter.fan_out([self.root, '/users/show.json'], payloads, concurrency=len(payloads))]
+        self.assertTrue(time.time() - started < 0.1 * len(payloads) / 2)
+        self.assertEqual(results, [{'id':1, 'screen_name':'isntitvacant'}] * len(payloads))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(self.http.stats()['streams'], len(payloads))
+        paths = sorted(headers[':path'] for headers, body, weight in self.server.requests)
+        self.assertEqual(paths, sorted('/users/show.json?screen_name=%s' % payload['screen_name'] for payload in payloads))
+
+    def test_opens_another_connection_when_streams_run_out(self):
+        self.serve(latency=0.1, max_concurrent_streams=2)
+        waiter = Waiter(self.http)
+        payloads = [{'screen_name':'user%d' % i} for i in range(6)]
+        for ticket in waiter.fan_out([self.root, '/users/show.json'], payloads, concurrency=6):
+            ticket.result()
+        self.assertEqual(self.server.connections, 3)
+        self.assertEqual(self.http.stats()['opened'], 3)
+
+    def test_streams_carry_their_endpoints_weight(self):
+        weight = random.randint(1, 256)
+        self.options = {'weight':weight, 'weights':{'statuses/update':256}}
+        self.serve()
+        self.http.request(self.root + '/users/show.json')
+        self.http.request(self.root + '/statuses/update.json', method='POST', body='status=hi')
+        self.assertEqual([request[2] for request in self.server.requests], [weight, 256])
+
+    def test_bodies_bigger_than_the_window_wait_for_window_updates(self):
+        body = ''.join(chr(random.randint(0, 255)) for i in range(200 * 1024))
+        self.options = {'window':16 * 1024}
+        self.serve(body=body)
+        upload = os.urandom(random.randint(100, 300) * 1024)
+        response, data = self.http.request(self.root + '/upload', method='POST', body=upload)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(data, body)
+        self.assertEqual(self.server.requests[0][0]['content-length'], str(len(upload)))
+        self.assertEqual(self.server.requests[0][1], upload)
+
+    def test_streamed_bodies_go_out_a_chunk_at_a_time(self):
+        self.serve()
+        chunks = ['chunk-%d;' % i for i in range(random.randint(5, 10))]
+        response, data = self.http.request(self.root + '/upload', method='POST', body=StreamingBody(iter(chunks)))
+        headers, body, weight = self.server.requests[0]
+        self.assertEqual(body, ''.join(chunks))
+        self.assertFalse('transfer-encoding' in headers)
+
+    def test_deadline_resets_just_its_own_stream(self):
+        self.serve(latency=2)
+        started = time.time()
+        order = Waiter(self.http, deadline=0.1)/self.root
+        self.assertRaises(Deadline.Exceeded, order.__call__)
+        self.assertTrue(time.time() - started < 1)
+        stats = self.http.stats()
+        self.assertEqual((stats['connections'], stats['in_flight']), (1, 0))
+
+class TestOfAsyncWaiter(unittest.TestCase):
+    def test_init_builds_brigade_and_pooled_http(self):
+        waiter = AsyncWaiter()
+        self.assertTrue(isinstance(waiter._http, PooledHttp))
+        self.assertTrue(isinstance(waiter._brigade, Brigade))
+
+    def test_call_returns_ticket_for_consumed_result(self):
+        random_body = { 'rand-%d'%random.randint(1,100): random.randint(1,100) }
+        calls = []
+        class FakeHttp(object):
+            def request(self, **kwargs):
+                calls.append(kwargs)
+                return (None, simplejson.dumps(random_body))
+        brigade = Brigade(cooks=1)
+        waiter = AsyncWaiter(FakeHttp(), brigade=brigade)
+        ticket = waiter/("http://random-%d.com"%random.randint(1,100))/{"a":1}
+        self.assertTrue(isinstance(ticket, Ticket))
+        self.assertEqual(ticket.result(1), random_body)
+        self.assertEqual(calls[0]['method'], 'GET')
+        self.assertEqual(waiter._stack, [])
+        brigade.shutdown()
+
+    def test_cooks_get_their_own_copy_of_unsafe_http(self):
+        used = []
+        class UnsafeHttp(object):
+            def request(self, **kwargs):
+                used.append(self)
+                return (None, '{}')
+        brigade = Brigade(cooks=1)
+        http = UnsafeHttp()
+        waiter = AsyncWaiter(http, brigade=brigade)
+        (waiter/'http://random.com'/{}).result(1)
+        (waiter/'http://random.com'/{}).result(1)
+        self.assertTrue(used[0] is used[1])
+        self.assertFalse(used[0] is http)
+        other = waiter._http = UnsafeHttp()
+        (waiter/'http://random.com'/{}).result(1)
+        self.assertFalse(used[2] in (other, used[0]))
+        brigade.shutdown()
+
 class TestOfMethods(unittest.TestCase):
     def test_method_sets_chef_method(self):
         random_value = random.randint(0,100)
@@ -255,7 +1758,77 @@ class TestOfLaxRecipeChef(unittest.TestCase):
         stack = [random_key]
         chef = LaxRecipeChef('domain', random_dict)
         results = chef.cook_data(stack, {})
-        self.assertEqual(chef.method, random_value)
+        self.assertEqual(results['method'], random_value)
+        self.assertEqual(results['uri'].split('?')[0], 'domain/' + random_key)
+
+    def test_cook_data_leaves_the_chef_alone(self):
+        chef = LaxRecipeChef('domain', {'statuses/update':'POST'})
+        self.assertEqual(chef.cook_data(['statuses/update.json'], {})['method'], 'POST')
+        self.assertEqual(chef.cook_data(['users/show.json'], {})['method'], 'GET')
+        self.assertEqual(chef.method, 'GET')
+
+    def test_cook_data_matches_path_parameters(self):
+        random_id = str(random.randint(1,10000))
+        chef = LaxRecipeChef('domain', {'statuses/destroy/:id':'POST', 'statuses/destroy':'GET'})
+        results = chef.cook_data(['statuses', '/', 'destroy', '/', random_id + '.json'], {'a':1})
+        self.assertEqual((results['method'], results['uri'], results['body']), ('POST', 'domain/statuses/destroy/%s.json' % random_id, 'a=1'))
+        route, extension = chef.route(['statuses/destroy/%s.json' % random_id])
+        self.assertEqual((route.endpoint, route.params, extension), ('statuses/destroy/:id', (('id', random_id),), '.json'))
+
+    def test_cook_data_without_extension(self):
+        chef = LaxRecipeChef('domain', {'trends':'GET'})
+        self.assertEqual(chef.cook_data(['trends'], {})['uri'], 'domain/trends?')
+
+class TestOfRecipeRouter(unittest.TestCase):
+    def test_static_routes_are_prebuilt(self):
+        router = RecipeRouter('https://twitter.com', {'users/show':'GET'})
+        self.assertTrue(router.route('users/show') is router.route('users/show'))
+        self.assertEqual(router.route('users/show'), Route('GET', 'users/show', 'https://twitter.com/users/show', ()))
+        self.assertEqual(router.route('users/missing'), None)
+
+    def test_literal_segments_win_over_parameters(self):
+        router = RecipeRouter('d', {'a/:id/c':'GET', 'a/b/c':'POST', 'a/:id':'PUT'})
+        self.assertEqual(router.route('a/b/c').method, 'POST')
+        self.assertEqual(router.route('a/x/c').params, (('id', 'x'),))
+        self.assertEqual(router.route('a/b').method, 'PUT')
+        self.assertEqual(router.route('a/x/y'), None)
+
+    def test_routes_are_compiled_on_first_use(self):
+        recipe = LazyRecipe("""
+            a/:id - GET
+            b - POST
+        """)
+        router = RecipeRouter('d', recipe)
+        self.assertEqual((recipe._recipe, router.static), (None, None))
+        self.assertEqual(router.route('b').method, 'POST')
+        self.assertEqual(dict(recipe), {'a/:id':'GET', 'b':'POST'})
+        self.assertEqual(router.route('a/1').params, (('id', '1'),))
+
+    def test_routers_compile_once_between_threads(self):
+        started, carry_on = threading.Event(), threading.Event()
+        class SlowRecipe(dict):
+            def items(self):
+                started.set()
+                carry_on.wait(1)
+                return dict.items(self)
+        router = RecipeRouter('d', SlowRecipe({'a/:id':'POST', 'b/:id/c':'PUT', 'd':'GET'}))
+        first = threading.Thread(target=router.compile)
+        first.start()
+        started.wait(1)
+        routed = []
+        second = threading.Thread(target=lambda: routed.append(router.route('b/1/c')))
+        second.start()
+        second.join(0.05)
+        self.assertEqual(routed, [])
+        carry_on.set()
+        first.join()
+        second.join()
+        self.assertEqual(routed[0].method, 'PUT')
+        self.assertEqual(router.route('a/1').method, 'POST')
+
+    def test_twitter_routes_ids(self):
+        self.assertEqual(TWITTER_ROUTER.route('statuses/destroy/12').method, 'POST')
+        self.assertEqual(TWITTER_ROUTER.route('statuses/show/12').method, 'GET')
 
     def test_cook_data_prepends_domain(self):
         random_domain = 'www.google-%d.com' % random.randint(1,100)
@@ -274,6 +1847,869 @@ class TestOfLaxRecipeChef(unittest.TestCase):
         self.assertEqual(random_dict, chef.recipe)
         self.assertEqual(random_domain, chef.domain)
 
+    def test_endpoint_of_strips_domain_slash_and_extension(self):
+        self.assertEqual(endpoint_of('https://twitter.com/users/show.json?screen_name=a'), 'users/show')
+        self.assertEqual(endpoint_of('http://random.com/trends'), 'trends')
+
+class TestOfTokenBucket(unittest.TestCase):
+    def setUp(self):
+        self.now = [0]
+        self.clock = lambda: self.now[0]
+
+    def test_tokens_drip_back_in(self):
+        bucket = TokenBucket(0.5, 2, self.clock)
+        bucket.take()
+        bucket.take()
+        self.assertEqual(bucket.wait_time(), 2)
+        self.now[0] = 1
+        self.assertEqual(bucket.wait_time(), 1)
+        self.now[0] = 10
+        self.assertEqual(bucket.wait_time(), 0)
+        self.assertEqual(bucket.tokens, 2)
+
+    def test_sync_waits_for_reset_when_nothing_remains(self):
+        bucket = TokenBucket(100, 150, self.clock)
+        bucket.sync(150, 0, 30)
+        self.assertEqual(bucket.wait_time(), 30)
+        self.now[0] = 30
+        self.assertEqual(bucket.wait_time(), 0)
+        self.assertEqual(bucket.tokens, 150)
+
+    def test_synced_buckets_hold_their_count_until_reset(self):
+        bucket = TokenBucket(0, 0, self.clock)
+        bucket.sync(180, 2, 900)
+        bucket.take()
+        self.assertEqual(bucket.wait_time(), 0)
+        bucket.take()
+        self.now[0] = 100
+        self.assertEqual(bucket.wait_time(), 800)
+        self.now[0] = 900
+        self.assertEqual(bucket.wait_time(), 0)
+        self.assertEqual(bucket.tokens, 180)
+
+class TestOfRateLimiter(unittest.TestCase):
+    def test_acquire_goes_straight_through_with_tokens(self):
+        limiter = RateLimiter(credential_limit=(1, 5))
+        for i in range(5):
+            limiter.acquire('me', 'users/show')
+        stats = limiter.stats()
+        self.assertEqual((stats['dispatched'], stats['queued'], stats['max_queued']), (5, 0, 1))
+
+    def test_acquire_delays_until_a_token_drips_in(self):
+        limiter = RateLimiter(credential_limit=(50, 1))
+        limiter.acquire('me', 'users/show')
+        start = time.time()
+        limiter.acquire('me', 'users/show')
+        self.assertTrue(time.time() - start >= 0.015)
+        self.assertEqual(limiter.delayed, 1)
+        self.assertTrue(limiter.stats()['mean_wait'] > 0)
+
+    def test_endpoint_limits_are_separate_buckets(self):
+        limiter = RateLimiter(credential_limit=(1, 10), endpoint_limits={'users/show':(0.001, 1)})
+        limiter.acquire('me', 'users/show')
+        self.assertTrue(limiter.buckets_for('me', 'users/show')[1].wait_time() > 0)
+        limiter.acquire('me', 'trends/current')
+        limiter.acquire('you', 'users/show')
+
+    def test_interactive_orders_jump_the_queue(self):
+        limiter = RateLimiter(credential_limit=(5, 1))
+        limiter.acquire('me', 'users/show')
+        order = []
+        def acquire(name, priority):
+            limiter.acquire('me', 'users/show', priority)
+            order.append(name)
+        background = threading.Thread(target=acquire, args=('background', BACKGROUND))
+        background.start()
+        while not limiter.queued:
+            time.sleep(0.001)
+        interactive = threading.Thread(target=acquire, args=('interactive', INTERACTIVE))
+        interactive.start()
+        background.join()
+        interactive.join()
+        self.assertEqual(order, ['interactive', 'background'])
+        self.assertEqual(limiter.max_queued, 2)
+
+    def test_update_syncs_credential_and_endpoint_buckets(self):
+        limiter = RateLimiter()
+        reset = int(time.time()) + 100
+        limiter.update('me', 'users/show', FakeResponse(headers={
+            'x-ratelimit-limit':'350', 'x-ratelimit-remaining':'0', 'x-ratelimit-reset':str(reset),
+            'x-rate-limit-limit':'180', 'x-rate-limit-remaining':'7',
+        }))
+        credential, endpoint = limiter.buckets_for('me', 'users/show')
+        self.assertEqual(credential.capacity, 350)
+        self.assertEqual(credential.resume_at, reset)
+        self.assertEqual((endpoint.capacity, endpoint.tokens), (180, 7))
+
+    def test_endpoint_buckets_from_headers_hold_orders(self):
+        now = [0]
+        limiter = RateLimiter(credential_limit=(1000, 1000), clock=lambda: now[0])
+        limiter.update('me', 'users/show', FakeResponse(headers={
+            'x-rate-limit-limit':'180', 'x-rate-limit-remaining':'2', 'x-rate-limit-reset':'900',
+        }))
+        limiter.acquire('me', 'users/show')
+        limiter.acquire('me', 'users/show')
+        self.assertEqual(limiter.buckets_for('me', 'users/show')[1].wait_time(), 900)
+
+    def test_update_reads_the_header_prefixes_its_given(self):
+        limiter = RateLimiter(headers=('x-app-limit-', None))
+        limiter.update('me', 'users/show', FakeResponse(headers={
+            'x-app-limit-limit':'90', 'x-app-limit-remaining':'12',
+            'x-rate-limit-limit':'180', 'x-rate-limit-remaining':'7',
+        }))
+        buckets = limiter.buckets_for('me', 'users/show')
+        self.assertEqual(len(buckets), 1)
+        self.assertEqual((buckets[0].capacity, buckets[0].tokens), (90, 12))
+
+    def test_sync_status_reads_rate_limit_status(self):
+        limiter = RateLimiter()
+        limiter.sync_status('me', {'remaining_hits':42, 'hourly_limit':350, 'reset_time_in_seconds':0})
+        bucket = limiter.buckets_for('me', 'anything')[0]
+        self.assertEqual((bucket.capacity, int(bucket.tokens)), (350, 42))
+
+    def test_acquire_gives_up_at_the_deadline_without_a_token(self):
+        limiter = RateLimiter(credential_limit=(0.001, 1))
+        limiter.acquire('me', 'users/show')
+        self.assertRaises(Deadline.Exceeded, limiter.acquire, 'me', 'users/show', INTERACTIVE, Deadline(0.02))
+        self.assertEqual((limiter.dispatched, limiter.queued), (1, 0))
+        self.assertEqual(limiter._queues['me'], [])
+
+    def test_cancelling_wakes_a_waiting_order_and_lets_the_next_through(self):
+        limiter = RateLimiter(credential_limit=(0.001, 1))
+        limiter.acquire('me', 'users/show')
+        token = Deadline()
+        raised = []
+        def acquire():
+            try:
+                limiter.acquire('me', 'users/show', INTERACTIVE, token)
+            except Deadline.Cancelled:
+                raised.append(True)
+        waiting = threading.Thread(target=acquire)
+        waiting.start()
+        while not limiter.queued:
+            time.sleep(0.001)
+        started = time.time()
+        token.cancel()
+        waiting.join(5)
+        self.assertEqual(raised, [True])
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(limiter.queued, 0)
+
+class TestOfRateLimitedHttp(unittest.TestCase):
+    def test_request_acquires_then_updates(self):
+        limiter = RateLimiter(credential_limit=(1, 1))
+        http = ScriptedHttp((FakeResponse(headers={'x-ratelimit-remaining':'99', 'x-ratelimit-limit':'100'}), 'ok'))
+        limited = RateLimitedHttp(http, limiter, credential='me')
+        self.assertEqual(limited.request(uri='https://twitter.com/users/show.json', method='GET')[1], 'ok')
+        self.assertEqual(limiter.dispatched, 1)
+        self.assertEqual(int(limiter.buckets_for('me', 'users/show')[0].tokens), 99)
+
+    def test_request_requeues_refused_orders(self):
+        limiter = RateLimiter(credential_limit=(1000, 10))
+        http = ScriptedHttp((FakeResponse(429), 'slow down'), (FakeResponse(), 'ok'))
+        limited = RateLimitedHttp(http, limiter)
+        self.assertEqual(limited.request('https://twitter.com/users/show.json')[1], 'ok')
+        self.assertEqual(limiter.dispatched, 2)
+        self.assertEqual(limited.credential, 'anonymous')
+
+    def test_request_closes_refused_responses(self):
+        refused = ClosingBody('slow down')
+        http = ScriptedHttp((FakeResponse(429), refused), (FakeResponse(), 'ok'))
+        self.assertEqual(RateLimitedHttp(http, RateLimiter(credential_limit=(1000, 10))).request('https://twitter.com/a.json')[1], 'ok')
+        self.assertTrue(refused.closed)
+
+    def test_request_holds_to_the_deadline_for_plain_https(self):
+        limiter = RateLimiter(credential_limit=(0.001, 1))
+        limiter.acquire('me', 'users/show')
+        http = ScriptedHttp((FakeResponse(), 'ok'))
+        limited = DeadlineHttp(RateLimitedHttp(http, limiter, credential='me'), Deadline(0.02))
+        self.assertRaises(Deadline.Exceeded, limited.request, 'https://twitter.com/users/show.json')
+        self.assertEqual((limiter.dispatched, http.requests), (1, []))
+
+    def test_credential_comes_from_oauth_token(self):
+        http = type('FakeClient', (), {'token':type('Token', (), {'key':'rand-key'})()})()
+        self.assertEqual(RateLimitedHttp(http, RateLimiter()).credential, 'rand-key')
+
+    def test_copies_copy_the_wrapped_http(self):
+        import copy
+        http = ScriptedHttp()
+        limited = RateLimitedHttp(http, RateLimiter(), priority=BACKGROUND)
+        copied = copy.copy(limited)
+        self.assertFalse(copied.http is http)
+        self.assertTrue(copied.limiter is limited.limiter)
+        self.assertEqual(copied.priority, BACKGROUND)
+        self.assertTrue(copied.thread_safe)
+
+class FakeClock(object):
+    def __init__(self, now=0):
+        self.now = now
+    def __call__(self):
+        return self.now
+    def sleep(self, seconds):
+        self.now += seconds
+
+class TestOfCircuitBreaker(unittest.TestCase):
+    def test_opens_after_threshold_failures(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('twitter.com', threshold=2, cooldown=10, clock=clock)
+        breaker.failed()
+        breaker.before()
+        breaker.failed()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        self.assertRaises(CircuitBreaker.Open, breaker.before)
+        self.assertEqual(breaker.rejected, 1)
+
+    def test_half_open_trial_closes_or_reopens(self):
+        clock = FakeClock()
+        breaker = CircuitBreaker('twitter.com', threshold=1, cooldown=10, clock=clock)
+        breaker.failed()
+        clock.sleep(10)
+        breaker.before()
+        self.assertEqual(breaker.state, CircuitBreaker.HALF_OPEN)
+        self.assertRaises(CircuitBreaker.Open, breaker.before)
+        breaker.failed()
+        self.assertEqual(breaker.state, CircuitBreaker.OPEN)
+        clock.sleep(10)
+        breaker.before()
+        breaker.succeeded()
+        self.assertEqual((breaker.state, breaker.failures), (CircuitBreaker.CLOSED, 0))
+
+class TestOfRetryPolicy(unittest.TestCase):
+    def test_retries_idempotent_methods_and_endpoints(self):
+        policy = RetryPolicy(idempotent_endpoints=('favorites/create',))
+        self.assertTrue(policy.retries_order('GET', 'https://twitter.com/users/show.json'))
+        self.assertFalse(policy.retries_order('POST', 'https://twitter.com/statuses/update.json'))
+        self.assertTrue(policy.retries_order('POST', 'https://twitter.com/favorites/create.json'))
+
+    def test_delay_backs_off_exponentially_up_to_max(self):
+        policy = RetryPolicy(backoff=1, max_backoff=5, jitter=lambda: 1)
+        self.assertEqual([policy.delay_for(i) for i in range(5)], [1, 2, 4, 5, 5])
+        policy.jitter = lambda: 0.5
+        self.assertEqual(policy.delay_for(1), 1)
+
+    def test_delay_honors_retry_after(self):
+        random_value = random.randint(1,100)
+        policy = RetryPolicy(jitter=lambda: 1)
+        self.assertEqual(policy.delay_for(0, FakeResponse(503, {'retry-after':str(random_value)})), random_value)
+        self.assertEqual(retry_after_seconds(FakeResponse(503, {'retry-after':'Thu, 01 Jan 1970 00:01:40 GMT'}), lambda: 40), 60)
+
+    def test_allows_stops_at_attempts_and_deadline(self):
+        clock = FakeClock()
+        policy = RetryPolicy(attempts=3, deadline=10, clock=clock)
+        self.assertTrue(policy.allows(1, 0, 5))
+        self.assertFalse(policy.allows(2, 0, 0))
+        self.assertFalse(policy.allows(0, 0, 11))
+
+    def test_breaker_for_is_per_host(self):
+        policy = RetryPolicy()
+        self.assertTrue(policy.breaker_for('a') is policy.breaker_for('a'))
+        self.assertFalse(policy.breaker_for('a') is policy.breaker_for('b'))
+
+class FailingHttp(ScriptedHttp):
+    def request(self, **kwargs):
+        response = ScriptedHttp.request(self, **kwargs)
+        if isinstance(response, Exception):
+            raise response
+        return response
+
+class TestOfRetryingHttp(unittest.TestCase):
+    def policy(self, **kwargs):
+        clock = FakeClock()
+        return RetryPolicy(clock=clock, sleep=clock.sleep, jitter=lambda: 1, **kwargs)
+
+    def test_retries_server_errors_then_succeeds(self):
+        http = ScriptedHttp((FakeResponse(503), 'busy'), (FakeResponse(502), 'busy'), (FakeResponse(), 'ok'))
+        policy = self.policy(backoff=1)
+        retrying = RetryingHttp(http, policy)
+        self.assertEqual(retrying.request('https://twitter.com/users/show.json', method='GET')[1], 'ok')
+        self.assertEqual(len(http.requests), 3)
+        self.assertEqual(http.requests[0]['uri'], 'https://twitter.com/users/show.json')
+        self.assertEqual((policy.retries, policy.clock()), (2, 3))
+
+    def test_hands_back_last_response_once_out_of_attempts(self):
+        http = ScriptedHttp((FakeResponse(500), 'one'), (FakeResponse(500), 'two'))
+        retrying = RetryingHttp(http, self.policy(attempts=2))
+        response, data = retrying.request('https://twitter.com/users/show.json', method='GET')
+        self.assertEqual((response.status, data), (500, 'two'))
+
+    def test_retries_connection_errors_and_reraises_the_last(self):
+        http = FailingHttp(socket.error('reset'), (FakeResponse(), 'ok'))
+        self.assertEqual(RetryingHttp(http, self.policy()).request('https://twitter.com/a.json')[1], 'ok')
+        http = FailingHttp(socket.error('one'), socket.error('two'))
+        self.assertRaises(socket.error, RetryingHttp(http, self.policy(attempts=2)).request, 'https://twitter.com/a.json')
+        self.assertEqual(len(http.requests), 2)
+
+    def test_does_not_retry_non_idempotent_orders(self):
+        http = ScriptedHttp((FakeResponse(503), 'busy'))
+        retrying = RetryingHttp(http, self.policy())
+        self.assertEqual(retrying.request('https://twitter.com/statuses/update.json', method='POST')[0].status, 503)
+        self.assertEqual(len(http.requests), 1)
+
+    def test_client_errors_are_not_retried(self):
+        http = ScriptedHttp((FakeResponse(404), 'nope'))
+        self.assertEqual(RetryingHttp(http, self.policy()).request('https://twitter.com/a.json')[0].status, 404)
+
+    def test_open_circuit_fails_fast(self):
+        http = ScriptedHttp(*[(FakeResponse(500), 'down')] * 2)
+        policy = self.policy(attempts=1, breaker_threshold=2)
+        retrying = RetryingHttp(http, policy)
+        retrying.request('https://twitter.com/a.json')
+        retrying.request('https://twitter.com/a.json')
+        self.assertRaises(CircuitBreaker.Open, retrying.request, 'https://twitter.com/a.json')
+        self.assertEqual(len(http.requests), 2)
+        self.assertEqual(policy.stats(), {'retries':0, 'open':['twitter.com'], 'rejected':1})
+
+    def test_any_exception_settles_a_half_open_circuit(self):
+        http = FailingHttp((FakeResponse(500), 'down'), Deadline.Exceeded('too slow'), (FakeResponse(), 'ok'))
+        policy = self.policy(attempts=1, breaker_threshold=1, breaker_cooldown=10)
+        retrying = RetryingHttp(http, policy)
+        retrying.request('https://twitter.com/a.json')
+        policy.clock.sleep(10)
+        self.assertRaises(Deadline.Exceeded, retrying.request, 'https://twitter.com/a.json')
+        self.assertEqual(policy.breaker_for('twitter.com').state, CircuitBreaker.OPEN)
+        self.assertEqual(retrying.request('https://twitter.com/a.json')[1], 'ok')
+        self.assertEqual(policy.breaker_for('twitter.com').state, CircuitBreaker.CLOSED)
+
+    def test_cancelled_orders_dont_count_against_the_host(self):
+        http = FailingHttp(*[Deadline.Cancelled('cancelled')] * 5)
+        policy = self.policy(breaker_threshold=5)
+        retrying = RetryingHttp(http, policy)
+        for i in range(5):
+            self.assertRaises(Deadline.Cancelled, retrying.request, 'https://twitter.com/a.json')
+        breaker = policy.breaker_for('twitter.com')
+        self.assertEqual((breaker.state, breaker.failures), (CircuitBreaker.CLOSED, 0))
+
+    def test_gives_up_rather_than_wait_out_a_long_retry_after(self):
+        http = ScriptedHttp((FakeResponse(503, {'retry-after':'3600'}), 'busy'), (FakeResponse(), 'ok'))
+        policy = self.policy()
+        response, data = RetryingHttp(http, policy).request('https://twitter.com/a.json')
+        self.assertEqual((response.status, len(http.requests), policy.clock()), (503, 1, 0))
+        self.assertEqual(RetryPolicy().deadline, 60)
+
+    def test_closes_responses_it_retries_past(self):
+        busy = ClosingBody('busy')
+        http = ScriptedHttp((FakeResponse(503), busy), (FakeResponse(), 'ok'))
+        self.assertEqual(RetryingHttp(http, self.policy()).request('https://twitter.com/a.json')[1], 'ok')
+        self.assertTrue(busy.closed)
+
+class ClosingBody(str):
+    closed = False
+    def close(self):
+        self.closed = True
+
+class RecordingInstruments(Instruments):
+    def __init__(self):
+        self.calls = []
+    def before(self, stage, order):
+        self.calls.append(('before', stage))
+    def after(self, stage, order, elapsed, error=None):
+        self.calls.append(('after', stage, dict(order), error is not None))
+
+class TestOfAdaptiveLimit(unittest.TestCase):
+    def feed(self, limit, rtt, times, dropped=False, in_flight=None):
+        for i in range(times):
+            limit.sample(rtt, dropped, in_flight if in_flight is not None else limit.limit)
+
+    def test_acquire_waits_for_a_free_slot(self):
+        limit = AIMDLimit(initial=1)
+        started = limit.acquire()
+        acquired = threading.Event()
+        def second():
+            limit.release(limit.acquire())
+            acquired.set()
+        threading.Thread(target=second).start()
+        self.assertFalse(acquired.wait(0.05))
+        limit.release(started)
+        self.assertTrue(acquired.wait(1))
+        self.assertEqual((limit.waits, limit.max_in_flight, limit.in_flight), (1, 1, 0))
+
+    def test_cancelling_wakes_orders_waiting_for_a_slot(self):
+        limit = AIMDLimit(initial=1)
+        limit.acquire()
+        token = Deadline()
+        threading.Timer(0.05, token.cancel).start()
+        started = time.time()
+        self.assertRaises(Deadline.Cancelled, limit.acquire, token)
+        self.assertTrue(time.time() - started < 1)
+        self.assertEqual(limit.in_flight, 1)
+
+    def test_aimd_grows_a_slot_per_window_in_good_time(self):
+        limit = AIMDLimit(initial=4)
+        self.feed(limit, 0.1, 4)
+        self.assertEqual(limit.limit, 5)
+        self.assertEqual(limit.history[-1][1:], (4, 5, 'headroom'))
+
+    def test_limits_only_grow_while_theyre_used(self):
+        limit = AIMDLimit(initial=4)
+        self.feed(limit, 0.1, 20, in_flight=1)
+        self.assertEqual(limit.limit, 4)
+
+    def test_aimd_backs_off_on_drops_once_per_round_trip(self):
+        clock = FakeClock(100)
+        limit = AIMDLimit(initial=20, backoff=0.5, clock=clock)
+        self.feed(limit, 1.0, 1)
+        self.feed(limit, 1.0, 3, dropped=True)
+        self.assertEqual(limit.limit, 10)
+        clock.now += 2
+        self.feed(limit, 1.0, 1, dropped=True)
+        self.assertEqual(limit.limit, 5)
+        self.assertEqual([change[3] for change in limit.history], ['dropped', 'dropped'])
+        self.assertEqual(limit.dropped, 4)
+
+    def test_aimd_backs_off_when_latency_inflates(self):
+        clock = FakeClock(100)
+        limit = AIMDLimit(initial=20, tolerance=2.0, clock=clock)
+        self.feed(limit, 0.1, 1)
+        while limit.rtt <= 0.2:
+            self.feed(limit, 1.0, 1)
+            clock.now += 1
+        self.assertTrue(limit.limit < 20)
+        self.assertEqual(limit.history[-1][3], 'latency')
+
+    def test_vegas_grows_while_latency_is_flat_and_shrinks_when_it_queues(self):
+        limit = VegasLimit(initial=10, probe=0, maximum=100)
+        self.feed(limit, 0.1, 5)
+        grown = limit.limit
+        self.assertTrue(grown > 10)
+        self.feed(limit, 1.0, 50)
+        self.assertTrue(limit.limit < grown)
+        self.assertTrue('queueing' in [change[3] for change in limit.history])
+
+    def test_limit_stays_within_its_bounds(self):
+        limit = VegasLimit(initial=4, minimum=2, maximum=6, probe=0)
+        self.feed(limit, 0.1, 20)
+        self.assertEqual(limit.limit, 6)
+        self.feed(limit, 0.1, 20, dropped=True)
+        self.assertEqual(limit.limit, 2)
+
+    def test_history_is_bounded_and_exported(self):
+        limit = VegasLimit(initial=2, minimum=1, maximum=3, remember=3, probe=0)
+        for i in range(5):
+            self.feed(limit, 0.1, 2)
+            self.feed(limit, 0.1, 2, dropped=True)
+        self.assertEqual(len(limit.stats()['history']), 3)
+        text = limit.prometheus()
+        self.assertTrue('waiter_concurrency_limit %d\n' % limit.limit in text)
+        self.assertTrue('waiter_concurrency_limit_changes_total{direction="down"} %d\n' % limit.decreases in text)
+
+    def test_adaptive_http_counts_5xx_and_exceptions_as_drops(self):
+        limit = AIMDLimit()
+        http = AdaptiveHttp(FailingHttp((FakeResponse(503), ''), socket.error('refused'), (FakeResponse(), '{}')), limit)
+        self.assertEqual(http.request(uri='http://a/b')[0].status, 503)
+        self.assertRaises(socket.error, http.request, uri='http://a/b')
+        http.request(uri='http://a/b')
+        self.assertEqual((limit.samples, limit.dropped, limit.in_flight), (3, 2, 0))
+
+    def test_streamed_bodies_hold_their_slot_until_read(self):
+        class Body(object):
+            def add_done_callback(self, fn):
+                self.done = fn
+        body = Body()
+        limit = AIMDLimit()
+        AdaptiveHttp(ScriptedHttp((FakeResponse(), body)), limit).request(uri='http://a/b')
+        self.assertEqual(limit.in_flight, 1)
+        body.done(body)
+        self.assertEqual(limit.in_flight, 0)
+
+    def test_fan_out_is_held_to_the_limit(self):
+        limit = AIMDLimit(initial=2, maximum=2)
+        class SlowHttp(ScriptedHttp):
+            def request(self, **kwargs):
+                time.sleep(0.01)
+                return FakeResponse(), '{"id": 1}'
+        twitter = Twitter(AdaptiveHttp(SlowHttp(), limit))
+        tickets = twitter.fan_out(['users', 'show.json'], [{'user_id':i} for i in range(10)], concurrency=8)
+        self.assertEqual([ticket.result() for ticket in tickets], [{'id':1}] * 10)
+        self.assertEqual(limit.max_in_flight, 2)
+
+class TestOfInstruments(unittest.TestCase):
+    def test_waiters_call_hooks_around_each_stage(self):
+        instruments = RecordingInstruments()
+        http = ScriptedHttp((FakeResponse(), '{"id":1}'))
+        twitter = Twitter(http, instruments=instruments)
+        self.assertEqual(twitter/"statuses"/"show"/"42.json"/{}, {'id':1})
+        stages = [call[:2] for call in instruments.calls]
+        self.assertEqual(stages, [('before', 'dispatch'), ('after', 'dispatch')] * 4 + [
+            ('before', 'cook'), ('after', 'cook'),
+            ('before', 'order'), ('before', 'request'), ('after', 'request'),
+            ('before', 'consume'), ('after', 'consume'), ('after', 'order')])
+        order = instruments.calls[-1][2]
+        self.assertEqual(order, {'endpoint':'statuses/show/:id', 'method':'GET', 'status':200, 'bytes':8, 'wire_bytes':8})
+        self.assertEqual(instruments.calls[9][2]['endpoint'], 'statuses/show/:id')
+
+    def test_errors_reach_the_after_hooks(self):
+        instruments = RecordingInstruments()
+        twitter = Twitter(ScriptedHttp((FakeResponse(404), '{}')), instruments=instruments)
+        self.assertRaises(TwitterException, twitter.prepare("users", "show.json"))
+        self.assertEqual([call[1] for call in instruments.calls if call[0] == 'after' and call[3]], ['consume', 'order'])
+
+    def test_dispatch_hooks_pair_up_when_the_menu_refuses(self):
+        instruments = RecordingInstruments()
+        waiter = Waiter(ScriptedHttp(), instruments=instruments)
+        self.assertRaises(TypeError, lambda: waiter/object())
+        self.assertEqual(instruments.calls, [('before', 'dispatch'), ('after', 'dispatch', {'endpoint':None}, True)])
+
+    def test_cached_orders_are_still_timed(self):
+        instruments = RecordingInstruments()
+        waiter = Waiter(ScriptedHttp((FakeResponse(), '{}')), cache=ResponseCache(), instruments=instruments)
+        order = waiter.prepare('http://a', 'b.json')
+        order()
+        order()
+        self.assertEqual([call[1] for call in instruments.calls if call[0] == 'after'], ['request', 'consume', 'order', 'order'])
+
+    def test_streamed_bodies_report_wire_bytes_once_read(self):
+        instruments = RecordingInstruments()
+        compressed = compress('[1, 2, 3]')
+        body = ResponseBody(TestOfResponseBody.FakeHTTPResponse(compressed), lambda reusable: None, decompressor=decompressor_for('gzip'))
+        waiter = Waiter(ScriptedHttp((FakeResponse(), body)), consumer=StreamingJSONConsumer(), instruments=instruments)
+        self.assertEqual(list(waiter.prepare('http://a', 'ids.json')()), [1, 2, 3])
+        stage, order = instruments.calls[-1][1:3]
+        self.assertEqual((stage, order['bytes'], order['wire_bytes']), ('decompress', 9, len(compressed)))
+
+class TestOfCollector(unittest.TestCase):
+    def test_histogram_buckets_are_cumulative(self):
+        histogram = Histogram()
+        for value in (0.0001, 0.003, 0.003, 100):
+            histogram.observe(value)
+        buckets = dict(histogram.cumulative())
+        self.assertEqual((buckets[0.0005], buckets[0.005], buckets[10.0], buckets[float('inf')]), (1, 3, 3, 4))
+        self.assertEqual(histogram.count, 4)
+
+    def test_collects_per_endpoint_stats(self):
+        clock = FakeClock()
+        collector = Collector(clock=clock)
+        http = ScriptedHttp((FakeResponse(), '[1,2]'), (FakeResponse(503), '{}'), (FakeResponse(), '[]'))
+        twitter = Twitter(http, consumer=JSONConsumer(), instruments=collector)
+        show = twitter.prepare("statuses", "show", "1.json")
+        show()
+        show()
+        twitter.prepare("users", "show.json")()
+        endpoints = collector.snapshot()['endpoints']
+        self.assertEqual(endpoints['statuses/show/:id'], {'orders':2, 'errors':1, 'bytes':7, 'wire_bytes':7, 'statuses':{200:1, 503:1}, 'error_rate':0.5})
+        self.assertEqual(endpoints['users/show']['orders'], 1)
+        latency = collector.snapshot()['latencies'][('request', 'users/show')]
+        self.assertEqual((latency['count'], latency['sum']), (1, 0))
+
+    def test_prometheus_export(self):
+        collector = Collector()
+        collector.after('request', {'endpoint':'users/show', 'status':200, 'bytes':10}, 0.002)
+        collector.after('order', {'endpoint':'users/show', 'status':200}, 0.003)
+        text = collector.prometheus()
+        self.assertTrue('# TYPE waiter_stage_seconds histogram\n' in text)
+        self.assertTrue('waiter_stage_seconds_bucket{stage="request",endpoint="users/show",le="0.0025"} 1\n' in text)
+        self.assertTrue('waiter_stage_seconds_bucket{stage="order",endpoint="users/show",le="+Inf"} 1\n' in text)
+        self.assertTrue('waiter_stage_seconds_count{stage="order",endpoint="users/show"} 1\n' in text)
+        self.assertTrue('waiter_response_bytes_total{endpoint="users/show"} 10\n' in text)
+        self.assertTrue('waiter_responses_total{endpoint="users/show",status="200"} 1\n' in text)
+        self.assertTrue('waiter_errors_total{endpoint="users/show"} 0\n' in text)
+
+class TestOfCassette(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_records_and_replays_in_order_then_round_again(self):
+        cassette = Cassette()
+        cassette.record('GET', 'http://a/b?x=1', None, FakeResponse(200, {'etag':'"1"'}), 'one')
+        cassette.record('GET', 'http://a/b?x=1', None, FakeResponse(304), '')
+        played = [cassette.play('GET', 'http://a/b?x=1', None) for i in range(3)]
+        self.assertEqual([(response.status, data) for response, data in played], [(200, 'one'), (304, ''), (200, 'one')])
+        self.assertEqual(played[0][0]['etag'], '"1"')
+        self.assertRaises(Cassette.Missing, cassette.play, 'POST', 'http://a/b?x=1', None)
+
+    def test_oauth_noise_is_left_out_of_the_match(self):
+        cassette = Cassette()
+        cassette.record('GET', 'http://a/b?x=1&oauth_nonce=1&oauth_timestamp=2', None, FakeResponse(), 'ok')
+        self.assertEqual(cassette.play('GET', 'http://a/b?oauth_nonce=3&x=1&oauth_timestamp=4', None)[1], 'ok')
+
+    def test_save_and_load_round_trip(self):
+        for name in ('tape.jsonl', 'tape.jsonl.gz'):
+            cassette = Cassette()
+            random_bytes = ''.join(chr(random.randint(0,255)) for i in range(random.randint(1,100)))
+            cassette.record('POST', 'http://a/b', 'x=1', FakeResponse(201), random_bytes)
+            cassette.record('GET', 'http://a/c', None, FakeResponse(), u'caf\xe9'.encode('utf-8'))
+            cassette.save(os.path.join(self.directory, name))
+            loaded = Cassette.load(os.path.join(self.directory, name))
+            self.assertEqual(len(loaded), 2)
+            response, data = loaded.play('POST', 'http://a/b', 'x=1')
+            self.assertEqual((response.status, data), (201, random_bytes))
+            self.assertEqual(loaded.play('GET', 'http://a/c', None)[1], u'caf\xe9'.encode('utf-8'))
+
+    def test_recording_then_replaying_through_twitter(self):
+        cassette = Cassette()
+        http = RecordingHttp(ScriptedHttp((FakeResponse(), '[{"id":1}]')), cassette)
+        self.assertEqual(Twitter(http)/"statuses"/"home_timeline.json"/{'count':1}, [{'id':1}])
+        slept = []
+        replayed = Twitter(ReplayHttp(cassette, latency=0.25, sleep=slept.append))
+        self.assertEqual(replayed/"statuses"/"home_timeline.json"/{'count':1}, [{'id':1}])
+        self.assertEqual(slept, [0.25])
+
+class TestOfJournal(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'writes.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_pending_is_queued_but_not_sent(self):
+        journal = Journal(self.path, sync=False)
+        random_value = str(random.randint(1,100))
+        cooked = [{'uri':'http://random.com/%d' % i, 'method':'POST', 'body':'status=%s' % random_value, 'headers':{'idempotency-key':str(i)}} for i in range(3)]
+        for i, cooked_data in enumerate(cooked):
+            journal.queued(str(i), cooked_data)
+        journal.sent('1')
+        journal.close()
+        self.assertEqual(Journal(self.path).pending(), [('0', cooked[0]), ('2', cooked[2])])
+
+    def test_pending_survives_binary_bodies_and_torn_lines(self):
+        journal = Journal(self.path)
+        body = compress('status=%d' % random.randint(1,100))
+        journal.queued('random', {'uri':'http://random.com/', 'method':'POST', 'body':body})
+        journal.close()
+        handle = open(self.path, 'ab')
+        handle.write('{"key": "torn", "op": "que')
+        handle.close()
+        self.assertEqual(Journal(self.path).pending(), [('random', {'uri':'http://random.com/', 'method':'POST', 'body':body})])
+
+    def test_queued_refuses_streamed_bodies(self):
+        journal = Journal(self.path)
+        self.assertRaises(TypeError, journal.queued, 'random', {'uri':'http://random.com/', 'method':'POST', 'body':MultipartBody({'a':StringIO.StringIO()})})
+
+    def test_compact_keeps_only_pending(self):
+        journal = Journal(self.path)
+        for i in range(random.randint(2,10)):
+            journal.queued(str(i), {'uri':'http://random.com/', 'method':'POST', 'body':None})
+            journal.sent(str(i))
+        journal.queued('last', {'uri':'http://random.com/', 'method':'POST', 'body':None})
+        journal.compact()
+        journal.sent('last')
+        journal.close()
+        self.assertEqual(len(open(self.path).readlines()), 2)
+        self.assertEqual(Journal(self.path).pending(), [])
+
+class TestOfWriteQueue(unittest.TestCase):
+    def test_submit_sends_writes_with_idempotency_keys(self):
+        random_value = random.randint(1,100)
+        http = ScriptedHttp((FakeResponse(200), '{"id": %d}' % random_value))
+        writes = Waiter(http, method='POST').write_behind()
+        ticket = writes.submit('http://random.com/statuses/update.json', {'status':'random'}, key='random-key')
+        self.assertEqual(ticket.result(1), {'id':random_value})
+        self.assertEqual(http.requests[0]['headers'], {'idempotency-key':'random-key'})
+        self.assertEqual(http.requests[0]['body'], 'status=random')
+        writes.close()
+        self.assertEqual(writes.stats(), {'queued':1, 'sent':1, 'failed':0, 'deduplicated':0, 'recovered':0, 'pending':0})
+
+    def test_submit_deduplicates_pending_and_sent_writes(self):
+        started, release = threading.Event(), threading.Event()
+        class SlowHttp(ScriptedHttp):
+            def request(self, **kwargs):
+                started.set()
+                release.wait(1)
+                return super(SlowHttp, self).request(**kwargs)
+        http = SlowHttp((FakeResponse(200), '{}'))
+        writes = Waiter(http, method='POST').write_behind(workers=1)
+        ticket = writes.submit('http://random.com/', {'status':'random'}, key='random-key')
+        started.wait(1)
+        self.assertTrue(writes.submit('http://random.com/', {'status':'random'}, key='random-key') is ticket)
+        release.set()
+        ticket.result(1)
+        self.assertTrue(writes.submit('http://random.com/', {'status':'random'}, key='random-key') is ticket)
+        writes.close()
+        self.assertEqual(len(http.requests), 1)
+        self.assertEqual(writes.stats()['deduplicated'], 2)
+
+    def test_failed_writes_spoil_their_own_tickets(self):
+        http = FailingHttp(socket.error(), (FakeResponse(200), '{}'))
+        writes = Waiter(http, method='POST').write_behind(workers=1)
+        first = writes.submit('http://random.com/', {'a':1})
+        second = writes.submit('http://random.com/', {'a':2})
+        self.assertRaises(socket.error, first.result, 1)
+        self.assertEqual(second.result(1), {})
+        writes.close()
+        self.assertEqual((writes.stats()['failed'], writes.stats()['sent']), (1, 1))
+
+    def test_rate_spaces_writes_out(self):
+        clock, slept = FakeClock(), []
+        def sleep(seconds):
+            slept.append(seconds)
+            clock.sleep(seconds)
+        http = ScriptedHttp(*[(FakeResponse(200), '{}') for i in range(3)])
+        writes = WriteQueue(Waiter(http, method='POST'), workers=1, rate=2, burst=1, clock=clock, sleep=sleep)
+        tickets = [writes.submit('http://random.com/', {'i':i}) for i in range(3)]
+        for ticket in tickets:
+            ticket.result(1)
+        writes.close()
+        self.assertEqual(slept, [0.5, 0.5])
+
+    def test_writes_submitted_from_many_threads_keep_their_bodies(self):
+        threads, writes_each = 8, 25
+        http = ScriptedHttp(*[(FakeResponse(200), '{}')] * (threads * writes_each))
+        writes = Twitter(http, consumer=Consumer()).write_behind(workers=4)
+        def submit(thread):
+            for i in range(writes_each):
+                writes.submit(['statuses', '/', 'update.json'], {'status':'%d-%d' % (thread, i)}, key='%d-%d' % (thread, i))
+        interval = sys.getcheckinterval()
+        sys.setcheckinterval(1)
+        try:
+            submitters = [threading.Thread(target=submit, args=(thread,)) for thread in range(threads)]
+            for submitter in submitters:
+                submitter.start()
+            for submitter in submitters:
+                submitter.join()
+        finally:
+            sys.setcheckinterval(interval)
+        writes.close()
+        self.assertEqual(len(http.requests), threads * writes_each)
+        for request in http.requests:
+            self.assertEqual(request['body'], 'status=' + request['headers']['idempotency-key'])
+
+    def test_journaling_doesnt_hold_up_the_queue(self):
+        syncing, synced = threading.Event(), threading.Event()
+        class SlowJournal(object):
+            def queued(self, key, cooked_data):
+                syncing.set()
+                synced.wait(1)
+            def sent(self, key):
+                pass
+            def pending(self):
+                return []
+            def compact(self):
+                pass
+        writes = WriteQueue(Waiter(ScriptedHttp((FakeResponse(200), '{}')), method='POST'), journal=SlowJournal())
+        submitter = threading.Thread(target=writes.submit, args=('http://random.com/', {'a':1}))
+        submitter.start()
+        syncing.wait(1)
+        stats = []
+        checker = threading.Thread(target=lambda: stats.append(writes.stats()))
+        checker.start()
+        checker.join(0.5)
+        self.assertEqual(len(stats), 1)
+        synced.set()
+        submitter.join()
+        writes.close()
+
+    def test_journaled_writes_survive_a_restart(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'writes.journal')
+            journal = Journal(path)
+            for key in ('first', 'second'):
+                journal.queued(key, {'uri':'http://random.com/', 'method':'POST', 'body':'status=%s' % key, 'headers':{'idempotency-key':key}})
+            journal.sent('first')
+            journal.close()
+
+            random_value = random.randint(1,100)
+            http = ScriptedHttp((FakeResponse(200), '{"id": %d}' % random_value))
+            writes = WriteQueue(Waiter(http, method='POST'), workers=1, journal=Journal(path))
+            self.assertEqual(len(writes.recovered), 1)
+            self.assertEqual(writes.recovered[0].result(1), {'id':random_value})
+            self.assertEqual((http.requests[0]['body'], http.requests[0]['headers']), ('status=second', {'idempotency-key':'second'}))
+            self.assertTrue(writes.submit('http://random.com/', {'status':'second'}, key='second') is writes.recovered[0])
+            writes.close()
+            self.assertEqual(Journal(path).pending(), [])
+        finally:
+            shutil.rmtree(directory)
+
+class TestOfSpecs(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.spec = {
+            'name':'Example',
+            'domain':'https://api-%d.example.com' % random.randint(1,100),
+            'endpoints':{'users/show':'GET', 'users/:id/posts':{'method':'get'}, '/posts':'POST'},
+            'pagination':{'param':'cursor', 'start':-1, 'next':'next_cursor', 'items':['users']},
+            'rate_limit':{'requests':150, 'per':3600, 'credential':'x-app-limit-', 'endpoint':None},
+            'errors':{'statuses':[404], 'key':'error'},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write_spec(self, spec):
+        path = os.path.join(self.directory, 'example.json')
+        handle = open(path, 'wb')
+        handle.write(simplejson.dumps(spec))
+        handle.close()
+        return path
+
+    def test_compiled_routes_are_ready_up_front(self):
+        compiled = compile_spec(self.spec)
+        self.assertEqual(sorted(compiled.router.static), ['posts', 'users/show'])
+        self.assertEqual(compiled.router.route('users/12/posts').params, (('id', '12'),))
+        self.assertEqual(compiled.endpoints['users/:id/posts'], 'GET')
+
+    def test_recipe_strings_work_as_endpoints(self):
+        self.spec['endpoints'] = """
+            users/show - GET
+            posts - POST
+        """
+        self.assertEqual(compile_spec(self.spec).endpoints, {'users/show':'GET', 'posts':'POST'})
+
+    def test_specs_without_the_essentials_are_refused(self):
+        del self.spec[random.choice(['name', 'domain', 'endpoints'])]
+        self.assertRaises(CompiledSpec.Invalid, compile_spec, self.spec)
+        self.assertRaises(CompiledSpec.Invalid, compile_spec, dict(self.spec, name='x', domain='y', endpoints={'a':'GET'}, pagination={'style':'link'}))
+
+    def test_client_cooks_with_the_spec(self):
+        Example = compile_spec(self.spec).client()
+        http = ScriptedHttp((FakeResponse(), simplejson.dumps({'id':1})))
+        self.assertEqual(Example(http)/'posts.json'/{'status':'hi'}, {'id':1})
+        self.assertEqual(http.requests[0]['uri'], self.spec['domain'] + '/posts.json')
+        self.assertEqual(http.requests[0]['method'], 'POST')
+        self.assertTrue(issubclass(Example, Waiter))
+        self.assertEqual(Example.__name__, 'Example')
+
+    def test_consumer_raises_on_the_spec_errors(self):
+        consumer = compile_spec(self.spec).consumer()
+        self.assertRaises(SpecConsumer.Error, consumer.handle, FakeResponse(404), '{}')
+        self.assertRaises(SpecConsumer.Error, consumer.handle, FakeResponse(), '{"error":"nope"}')
+        self.spec['errors']['exception'] = 'waiter.apis.twitter.TwitterException'
+        consumer = compile_spec(self.spec).consumer()
+        self.assertRaises(TwitterException, consumer.handle, FakeResponse(), '{"error":"nope"}')
+
+    def test_paginate_follows_the_spec_cursor(self):
+        Example = compile_spec(self.spec).client()
+        http = ScriptedHttp(
+            (FakeResponse(), simplejson.dumps({'users':[1, 2], 'next_cursor':7})),
+            (FakeResponse(), simplejson.dumps({'users':[3], 'next_cursor':0})))
+        self.assertEqual(list(Example(http).paginate('users/show.json', {})), [1, 2, 3])
+        self.assertTrue('cursor=-1' in http.requests[0]['uri'])
+        self.assertTrue('cursor=7' in http.requests[1]['uri'])
+
+    def test_limiter_is_held_to_the_spec(self):
+        limiter = compile_spec(self.spec).limiter()
+        self.assertEqual(limiter.credential_limit, (150 / 3600.0, 150))
+        self.assertEqual(limiter.headers, ('x-app-limit-', None))
+
+    def test_load_client_reuses_its_artifact_until_the_spec_changes(self):
+        path = self.write_spec(self.spec)
+        first = load_client(path)
+        self.assertTrue(os.path.exists(path + '.compiled'))
+        compiled = []
+        original = specs.compile_spec
+        specs.compile_spec = lambda *args: compiled.append(args) or original(*args)
+        try:
+            second = load_client(path)
+            self.assertEqual(compiled, [])
+            self.assertEqual(second.spec.router.static, first.spec.router.static)
+            self.write_spec(dict(self.spec, endpoints={'trends':'GET'}))
+            third = load_client(path)
+            self.assertEqual(len(compiled), 1)
+            self.assertEqual(third.spec.endpoints, {'trends':'GET'})
+        finally:
+            specs.compile_spec = original
+
+    def test_load_client_writes_artifacts_where_its_told(self):
+        path = self.write_spec(self.spec)
+        cache_dir = os.path.join(self.directory, 'cache')
+        os.mkdir(cache_dir)
+        load_client(path, cache_dir)
+        self.assertEqual(os.listdir(cache_dir), ['example.json.compiled'])
+        self.assertEqual(CompiledSpec.load(os.path.join(cache_dir, 'example.json.compiled')).name, 'Example')
+
 class TestOfTwitterGrabOAuth(unittest.TestCase):
     def test_actually_imports_things(self):
         import math
@@ -288,7 +2724,7 @@ class TestOfTwitterMenu(unittest.TestCase):
         random_value = random.randint(1,100)
         tw = TwitterMenu(random_value, oauth_importer=fake_importer)
         default_menu = Menu(random_value)
-        self.assertEqual(tw.dispatch.keys(), default_menu.dispatch.keys())
+        self.assertEqual(set(tw.dispatch.keys()), set(default_menu.dispatch.keys()))
 
     def test_dispatch_adds_hooks_if_oauth_available(self):
         class FakeOAuth(object):
@@ -299,6 +2735,27 @@ class TestOfTwitterMenu(unittest.TestCase):
         tw = TwitterMenu(random_value, oauth_importer=fake_importer)
         self.assertTrue(FakeOAuth.Client in tw.dispatch.keys())
 
+    def test_dispatch_accepts_pooled_http(self):
+        tw = TwitterMenu(PooledHttp(), oauth_importer=lambda x: None)
+        self.assertEqual(tw.dispatch[PooledHttp], tw.set_waiter_http)
+
+    def test_oauth_is_looked_for_once_and_lazily(self):
+        imported = []
+        class FakeOAuth(object):
+            class Client(object):
+                pass
+        class LazyMenu(TwitterMenu):
+            @classmethod
+            def build_registry(cls):
+                return super(LazyMenu, cls).build_registry(lambda what: imported.append(what) or FakeOAuth)
+        waiter = Waiter(menu_class=LazyMenu)
+        self.assertEqual(imported, [])
+        client = FakeOAuth.Client()
+        for i in range(random.randint(2,10)):
+            waiter/client
+        self.assertEqual(imported, ['oauth2'])
+        self.assertTrue(waiter._http is client)
+
     def test_set_waiter_http_sets_waiter_http(self):
         class FakeOAuth(object):
             class Client(object):
@@ -338,6 +2795,24 @@ class TestOfTwitterConsumer(unittest.TestCase):
         results = consumer.handle(fake_resp, good_json)
         self.assertEqual(results, good_dict)
 
+    def test_check_hooks_split_handle(self):
+        consumer = TwitterConsumer()
+        self.assertRaises(TwitterException, consumer.check_response, FakeResponse(404))
+        self.assertEqual(consumer.check_response(FakeResponse(200)), None)
+        self.assertRaises(TwitterException, consumer.check_parsed, {'error':'x'})
+        self.assertEqual(consumer.check_parsed({'ok':1}), {'ok':1})
+
+    def test_first_page_starts_the_cursor(self):
+        self.assertEqual(TwitterConsumer().first_page({}), {'cursor':-1})
+        self.assertEqual(TwitterConsumer().first_page({'cursor':5}), {'cursor':5})
+
+    def test_next_page_finds_cursored_items(self):
+        consumer = TwitterConsumer()
+        random_ids = [random.randint(1,100) for i in range(random.randint(0,10))]
+        self.assertEqual(consumer.next_page({'ids':random_ids, 'next_cursor':7}), (random_ids, {'cursor':7}))
+        self.assertEqual(consumer.next_page({'users':random_ids, 'next_cursor':0}), (random_ids, None))
+        self.assertEqual(consumer.next_page(random_ids), (random_ids, None))
+
 class TestOfTwitterRecipeChef(unittest.TestCase):
     def test_domain_is_correct(self):
         self.assertEqual(TwitterRecipeChef().domain, 'https://twitter.com')
@@ -352,3 +2827,7 @@ class TestOfTwitter(unittest.TestCase):
         self.assertEqual(twitter._menu_class, TwitterMenu)
         self.assertTrue(isinstance(twitter._consumer, TwitterConsumer))
 
+    def test_consumer_can_be_swapped(self):
+        consumer = TwitterConsumer(decoder='json')
+        self.assertTrue(Twitter(consumer=consumer)._consumer is consumer)
+
@@ -1,26 +1,71 @@
-import httplib2
 import urllib
-import simplejson
+import urlparse
+import threading
+import inspect
+import copy
+
+from waiter.tickets import Ticket, Brigade, as_completed
+from waiter.decoders import get_decoder, default_decoder
+from waiter.compression import compress
+from waiter.uploads import MultipartBody, is_upload
+from waiter.transports import ThreadLocalHttp, PooledHttp, consume
+from waiter.instruments import MeteredHttp, MeteredConsumer, measure
+from waiter.deadlines import Deadline, DeadlineHttp, DeadlineConsumer
 
 class Chef(object):
-    def __init__(self, method):
+    body_encoding = None
+
+    def __init__(self, method, body_encoding=None):
         self.method = method
+        self.body_encoding = body_encoding
         self.errors = []
         self.cooked_data = {}
 
     def cook_data(self, stack, params):
-        uri = ''.join(stack)
+        uri, method = self.prepare(stack)
+        return self.plate(uri, method, params)
+
+    def endpoint_for(self, uri):
+        """
+            What to file a cooked uri under: its path, minus the leading slash
+            and any file extension.
+        """
+        return urlparse.urlparse(uri)[2].lstrip('/').rsplit('.', 1)[0]
+
+    def prepare(self, stack):
+        """
+            The part of an order that doesn't depend on its params: its uri,
+            short of the query string, and its method.
+        """
+        return ''.join(stack), self.method
+
+    def plate(self, uri, method, params):
+        if method == 'POST' and any(is_upload(value) for value in params.values()):
+            body = MultipartBody(params)
+            return {
+                'uri':uri,
+                'body':body,
+                'method':method,
+                'headers':body.headers(),
+            }
         body = None
         urlencoded_params = urllib.urlencode(params)
-        if self.method != 'POST':
+        if method != 'POST':
             uri += '?%s' % urlencoded_params
         else:
             body = urlencoded_params
-        return {
+        cooked_data = {
             'uri':uri,
             'body':body,
-            'method':self.method,
-        } 
+            'method':method,
+        }
+        if body is not None and self.body_encoding:
+            cooked_data['body'] = compress(body, self.body_encoding)
+            cooked_data['headers'] = {
+                'content-type':'application/x-www-form-urlencoded',
+                'content-encoding':self.body_encoding,
+            }
+        return cooked_data
 
     def cooks(self, stack, params):
         self.errors = []
@@ -33,60 +78,380 @@ class Consumer(object):
     def handle(self, response, data):
         return data
 
-class JSONConsumer(object):
-    def __init__(self):
-        pass
+    def first_page(self, params):
+        return params
+
+    def next_page(self, parsed_data):
+        """
+            Split a handled page into the items on it and the params that fetch
+            the page after it -- or None, if this was the last one.
+        """
+        return parsed_data, None
+
+class JSONConsumer(Consumer):
+    def __init__(self, decoder=None):
+        if isinstance(decoder, basestring):
+            decoder = get_decoder(decoder)
+        self.decoder = decoder if decoder else default_decoder()
 
     def handle(self, response, data):
-        return simplejson.loads(data)    
+        return self.decoder(data)
 
 class Menu(object):
-    def __init__(self, value, dispatch_update={}):
+    """
+        Decides what dividing a Waiter by a value means, by the value's type.
+        `handlers` maps types to the names of the methods that handle them;
+        subclasses of those types are handled the same way. Each Menu class
+        works its handlers out once and remembers what it found for every
+        type it's been handed since.
+    """
+    handlers = {
+        str:'accept_str',
+        dict:'accept_dict',
+        PooledHttp:'accept_http',
+    }
+
+    def __init__(self, value, dispatch_update=None, registry=None):
         self.value = value
-        self.dispatch = {
-            str:self.accept_str,
-            dict:self.accept_dict,
-        }
-        self.dispatch.update(dispatch_update)
+        self.dispatch_update = dispatch_update
+        self.registry = registry
+
+    @classmethod
+    def build_registry(cls):
+        return dict(cls.handlers)
+
+    @classmethod
+    def compiled_registry(cls):
+        registry = cls.__dict__.get('_compiled_registry')
+        if registry is None:
+            registry = cls._compiled_registry = cls.build_registry()
+        return registry
+
+    @classmethod
+    def handler_for(cls, value_class):
+        resolved = cls.__dict__.get('_resolved')
+        if resolved is None:
+            resolved = cls._resolved = {}
+        try:
+            return resolved[value_class]
+        except KeyError:
+            name = find_in_mro(cls.compiled_registry(), value_class)
+            resolved[value_class] = name
+            return name
+
+    @property
+    def dispatch(self):
+        registry = self.registry if self.registry is not None else self.compiled_registry()
+        dispatch = dict((klass, getattr(self, name)) for klass, name in registry.items())
+        dispatch.update(self.dispatch_update or {})
+        return dispatch
 
     def accept_str(self, waiter):
-        waiter._stack = waiter._stack + ['/', self.value] if waiter._stack else [self.value]
+        if waiter._stack:
+            waiter._stack.extend(('/', self.value))
+        else:
+            waiter._stack = [self.value]
+        return waiter
+
+    def accept_http(self, waiter):
+        waiter._http = self.value
         return waiter
 
     def accept_dict(self, waiter): 
         return waiter(**self.value)
 
     def accept_waiter(self, waiter):
-        try:
-            return self.dispatch[self.value.__class__](waiter)
-        except KeyError:
-            raise TypeError 
+        if self.dispatch_update or self.registry is not None:
+            handler = find_in_mro(self.dispatch, self.value.__class__)
+        else:
+            name = self.handler_for(self.value.__class__)
+            handler = getattr(self, name) if name else None
+        if handler is None:
+            raise TypeError("The menu doesn't have anything for %r" % self.value.__class__)
+        return handler(waiter)
+
+def find_in_mro(registry, value_class):
+    for klass in inspect.getmro(value_class):
+        if klass in registry:
+            return registry[klass]
+    return None
+
+_cooking = threading.Lock()
+
+def cooks_its_own_way(chef):
+    for klass in inspect.getmro(chef.__class__):
+        if 'cook_data' in klass.__dict__:
+            return klass is not Chef
+    return False
+
+class Order(object):
+    """
+        An order the chef has already prepared, down to everything but its
+        params. Calling it -- or dividing it by a dict -- serves it with
+        those params, without going back through the Menu or the Waiter's
+        stack, so one Order can be kept around and called from any number of
+        threads. Orders can't be changed once taken, and hash by what they'd
+        send.
+
+        A chef with its own `cook_data` -- checking orders, say -- gets to
+        cook every serving from the `stack`, and its errors raise
+        Waiter.Error as usual.
+    """
+    __slots__ = ('waiter', 'uri', 'method', 'stack')
+
+    def __init__(self, waiter, uri, method, stack=None):
+        object.__setattr__(self, 'waiter', waiter)
+        object.__setattr__(self, 'uri', uri)
+        object.__setattr__(self, 'method', method)
+        object.__setattr__(self, 'stack', stack)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("Orders can't be changed once they're taken")
+    __delattr__ = __setattr__
+
+    def __call__(self, **params):
+        waiter = self.waiter
+        if self.stack is None:
+            return waiter.serve(waiter._chef.plate(self.uri, self.method, params))
+        return waiter.serve(waiter._cook(list(self.stack), params))
+
+    def __div__(self, params):
+        return self(**params)
+
+    def __eq__(self, rhs):
+        return isinstance(rhs, Order) and (self.waiter, self.uri, self.method) == (rhs.waiter, rhs.uri, rhs.method)
+
+    def __ne__(self, rhs):
+        return not self == rhs
+
+    def __hash__(self):
+        return hash((id(self.waiter), self.uri, self.method))
+
+    def __repr__(self):
+        return '<Order %s %s>' % (self.method, self.uri)
 
 class Waiter(object):
     class Error(Exception):
         pass
 
-    def __init__(self, http=None, method='GET', chef=None, consumer=None, menu_class=Menu):
+    def __init__(self, http=None, method='GET', chef=None, consumer=None, menu_class=Menu, cache=None, instruments=None, deadline=None):
         self._chef = chef if chef else Chef(method)
         self._consumer = consumer if consumer else JSONConsumer() 
 
         self._menu_class = menu_class
-        self._http = http if http else httplib2.Http()
+        self._http = http if http else PooledHttp()
+        self._cache = cache
+        self._instruments = instruments
+        self._deadline = deadline
+        self._dispatching = None
         self._stack = []
         self._payload = {}
 
     def __div__(self, rhs):
-        handler = getattr(rhs, 'accept_waiter', self._menu_class(rhs).accept_waiter)
-        if hasattr(rhs, 'accept_waiter'):
-            handler = rhs.accept_waiter
-        return handler(self)
+        handler = getattr(rhs, 'accept_waiter', None)
+        if handler is None:
+            handler = self._menu_class(rhs).accept_waiter
+        instruments = self._instruments
+        if instruments is None:
+            return handler(self)
+        order = {'endpoint':None}
+        instruments.before('dispatch', order)
+        self._dispatching = (order, instruments.clock())
+        try:
+            result = handler(self)
+        except Exception as e:
+            self._dispatched(e)
+            raise
+        self._dispatched()
+        return result
+
+    def _dispatched(self, error=None):
+        """
+            Close off the `/` being dispatched, if any -- before the order it
+            serves gets cooked, when it's the one that serves it.
+        """
+        dispatching, self._dispatching = self._dispatching, None
+        if dispatching is not None:
+            order, started = dispatching
+            self._instruments.after('dispatch', order, self._instruments.clock() - started, error)
 
     def __call__(self, *args, **kwargs):
+        if self._dispatching is not None:
+            self._dispatched()
         self._payload.update(kwargs)
-        if self._chef.cooks(self._stack, self._payload):
-            self._stack, self._payload = [], {}
-            httplib_kwargs = self._chef.cooked_data
-            response, data = self._http.request(**httplib_kwargs)
-            return self._consumer.handle(response, data)
-        else:
-            raise Waiter.Error("Invalid waiter stack -> your chef found errors in your order: %s" % self._chef.errors)
+        cooked_data = self._cook(self._stack, self._payload)
+        self._stack, self._payload = [], {}
+        return self.serve(cooked_data)
+
+    def prepare(self, *stack):
+        """
+            Take the order built up so far -- plus any more of its path in
+            `stack` -- as a reusable Order, and clear the stack for the next:
+
+                show = (twitter/"users"/"show.json").prepare()
+                show(screen_name='isntitvacant')
+        """
+        stack = self._stack + [part for value in stack for part in ('/', value)]
+        if not self._stack:
+            stack = stack[1:]
+        self._stack, self._payload = [], {}
+        uri, method = self._chef.prepare(stack)
+        return Order(self, uri, method, tuple(stack) if cooks_its_own_way(self._chef) else None)
+
+    def _order_error(self):
+        return Waiter.Error("Invalid waiter stack -> your chef found errors in your order: %s" % self._chef.errors)
+
+    def _cook(self, stack, payload):
+        """
+            The chef's cooked_data for an order, or Waiter.Error if it found
+            errors. Chefs keep what they cook on themselves, and one chef can
+            be cooking for any number of threads -- Orders, WriteQueues -- so
+            cooking and reading back are done under a lock.
+        """
+        instruments = self._instruments
+        if instruments is not None:
+            order = {'endpoint':None}
+            instruments.before('cook', order)
+            started = instruments.clock()
+        _cooking.acquire()
+        try:
+            cooked = self._chef.cooks(stack, payload)
+            cooked_data, error = (self._chef.cooked_data, None) if cooked else (None, self._order_error())
+        finally:
+            _cooking.release()
+        if instruments is not None:
+            if cooked:
+                order['endpoint'] = self._chef.endpoint_for(cooked_data['uri'])
+            instruments.after('cook', order, instruments.clock() - started, error)
+        if error is not None:
+            raise error
+        return cooked_data
+
+    def _shareable_http(self):
+        if getattr(self._http, 'thread_safe', False):
+            return self._http
+        return ThreadLocalHttp(factory=lambda: copy.copy(self._http))
+
+    def serve(self, cooked_data, http=None):
+        http = http if http else self._http
+        if self._deadline is not None:
+            return self._serve_by(self._deadline, cooked_data, http)
+        if self._instruments is not None:
+            return self._serve_instrumented(cooked_data, http, self._consumer)
+        if self._cache is not None:
+            return self._cache.serve(cooked_data, http, self._consumer)
+        response, data = http.request(**cooked_data)
+        return consume(self._consumer, response, data)
+
+    def _serve_by(self, deadline, cooked_data, http):
+        """
+            Serve an order under a Deadline -- the one it was divided by, or a
+            fresh one for the Waiter's `deadline` in seconds.
+        """
+        if not isinstance(deadline, Deadline):
+            deadline = Deadline(deadline)
+        deadline.check('waiting to be served')
+        http = DeadlineHttp(http, deadline)
+        consumer = DeadlineConsumer(self._consumer, deadline)
+        if self._instruments is not None:
+            return self._serve_instrumented(cooked_data, http, consumer)
+        if self._cache is not None:
+            return self._cache.serve(cooked_data, http, consumer)
+        return self._serve_plain(cooked_data, http, consumer)
+
+    def _serve_instrumented(self, cooked_data, http, consumer):
+        instruments = self._instruments
+        order = {'endpoint':self._chef.endpoint_for(cooked_data['uri']), 'method':cooked_data['method']}
+        http = MeteredHttp(http, instruments, order)
+        consumer = MeteredConsumer(consumer, instruments, order)
+        if self._cache is not None:
+            return measure(instruments, 'order', order, self._cache.serve, cooked_data, http, consumer)
+        return measure(instruments, 'order', order, self._serve_plain, cooked_data, http, consumer)
+
+    def _serve_plain(self, cooked_data, http, consumer):
+        response, data = http.request(**cooked_data)
+        return consume(consumer, response, data)
+
+    def fan_out(self, stack, payloads, concurrency=8, ordered=True):
+        """
+            Cook one order per payload against the same stack, and send them all
+            out at once with at most `concurrency` in flight. Hands back a list of
+            Tickets in payload order, or if `ordered` is False, an iterator of
+            Tickets as each order comes up. A bad order only spoils its own Ticket.
+        """
+        if isinstance(stack, basestring):
+            stack = [stack]
+        http = self._shareable_http()
+        brigade = Brigade(concurrency)
+        tickets = []
+        for payload in payloads:
+            try:
+                cooked_data = self._cook(stack, payload)
+            except Waiter.Error as e:
+                tickets.append(Ticket.failed(e))
+            else:
+                tickets.append(brigade.submit(Waiter.serve, self, cooked_data, http))
+        brigade.shutdown(wait=False)
+        return tickets if ordered else as_completed(tickets)
+
+    def paginate(self, stack, params=None, prefetch=False):
+        """
+            Lazily walk every page of a paged endpoint, yielding the items on
+            each. The Consumer decides where the items are and how to ask for
+            the next page. With `prefetch`, the next page is already on its way
+            while you're still working through the current one.
+        """
+        if isinstance(stack, basestring):
+            stack = [stack]
+        params = self._consumer.first_page(dict(params or {}))
+        brigade = Brigade(1) if prefetch else None
+        http = self._shareable_http() if prefetch else None
+        try:
+            cooked_data = self._cook(stack, params)
+            ticket = brigade.submit(Waiter.serve, self, cooked_data, http) if brigade else None
+            while cooked_data is not None:
+                parsed_data = ticket.result() if ticket else Waiter.serve(self, cooked_data)
+                items, next_params = self._consumer.next_page(parsed_data)
+                cooked_data = ticket = None
+                if next_params is not None:
+                    cooked_data = self._cook(stack, dict(params, **next_params))
+                    ticket = brigade.submit(Waiter.serve, self, cooked_data, http) if brigade else None
+                for item in items:
+                    yield item
+        finally:
+            if brigade:
+                brigade.shutdown(wait=False)
+
+    def write_behind(self, **options):
+        """
+            A WriteQueue for this Waiter's writes -- see waiter.writes:
+
+                writes = twitter.write_behind(rate=1, journal=Journal('writes.journal'))
+                ticket = writes.submit('statuses/update.json', {'status':'soup!'}, key='soup-1')
+        """
+        from waiter.writes import WriteQueue
+        return WriteQueue(self, **options)
+
+class AsyncWaiter(Waiter):
+    """
+        Takes orders just like a Waiter, but rather than standing at the pass
+        until the food is up, he hands you a Ticket and lets the Brigade cook.
+    """
+    def __init__(self, *args, **kwargs):
+        brigade = kwargs.pop('brigade', None)
+        super(AsyncWaiter, self).__init__(*args, **kwargs)
+        self._brigade = brigade if brigade else Brigade()
+        self._shared = None
+
+    def serve(self, cooked_data, http=None):
+        return self._brigade.submit(super(AsyncWaiter, self).serve, cooked_data, http if http else self._shared_http())
+
+    def _shared_http(self):
+        """
+            The http the brigade's cooks share -- worked out again whenever
+            the waiter's http is swapped.
+        """
+        shared = self._shared
+        if shared is None or shared[0] is not self._http:
+            shared = self._shared = (self._http, self._shareable_http())
+        return shared[1]
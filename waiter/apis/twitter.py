@@ -1,5 +1,6 @@
 from waiter import Waiter, Menu, JSONConsumer
-from waiter.chefs import LaxRecipeChef
+from waiter.chefs import LaxRecipeChef, LazyRecipe, RecipeRouter
+from waiter.transports import PooledHttp
 
 def grab_oauth_library(what):
     try:
@@ -11,37 +12,74 @@ class TwitterException(Exception):
     pass
 
 class TwitterMenu(Menu):
+    """
+        Takes an http -- a PooledHttp, or an oauth2 Client if oauth2 is
+        around -- as the waiter's new http. oauth2 is only looked for the
+        first time a TwitterMenu is consulted, unless you hand it an
+        `oauth_importer` of your own.
+    """
+    handlers = dict(Menu.handlers)
+    handlers[PooledHttp] = 'set_waiter_http'
+
     def set_waiter_http(self, waiter):
         waiter._http = self.value
         return waiter
 
-    def __init__(self, value, oauth_importer=grab_oauth_library, *args, **kwargs):
-        dispatch_update = {}
+    @classmethod
+    def build_registry(cls, oauth_importer=grab_oauth_library):
+        registry = super(TwitterMenu, cls).build_registry()
         oauth_library = oauth_importer('oauth2')
         if oauth_library:
-            dispatch_update = {
-                oauth_library.Client:self.set_waiter_http
-            }
-        super(TwitterMenu, self).__init__(value, dispatch_update=dispatch_update, *args, **kwargs)
+            registry[oauth_library.Client] = 'set_waiter_http'
+        return registry
+
+    def __init__(self, value, oauth_importer=None, *args, **kwargs):
+        if oauth_importer is not None:
+            kwargs['registry'] = self.build_registry(oauth_importer)
+        super(TwitterMenu, self).__init__(value, *args, **kwargs)
 
 class TwitterConsumer(JSONConsumer):
-    def handle(self, response, data):
+    def check_response(self, response):
         if response.status in (404, 500, 503):
             raise TwitterException("Got a bad response - %d" % response.status)
-        parsed_data = super(TwitterConsumer, self).handle(response, data)
-        if 'error' in parsed_data.keys():
+
+    def check_parsed(self, parsed_data):
+        if isinstance(parsed_data, dict) and 'error' in parsed_data:
             raise TwitterException("Bad request - %s" % parsed_data['error'])
         return parsed_data
 
+    def handle(self, response, data):
+        self.check_response(response)
+        return self.check_parsed(super(TwitterConsumer, self).handle(response, data))
+
+    def first_page(self, params):
+        params.setdefault('cursor', -1)
+        return params
+
+    def next_page(self, parsed_data):
+        if isinstance(parsed_data, list):
+            return parsed_data, None
+        for key in CURSORED_KEYS:
+            if key in parsed_data:
+                items = parsed_data[key]
+                break
+        else:
+            items = []
+        next_cursor = parsed_data.get('next_cursor', 0)
+        return items, {'cursor':next_cursor} if next_cursor else None
+
 class TwitterRecipeChef(LaxRecipeChef):
     def __init__(self):
-        return super(TwitterRecipeChef, self).__init__('https://twitter.com', TWITTER_ENDPOINTS)
+        return super(TwitterRecipeChef, self).__init__('https://twitter.com', TWITTER_ENDPOINTS, TWITTER_ROUTER)
 
 class Twitter(Waiter):
     def __init__(self, *args, **kwargs):
-        return super(Twitter, self).__init__(menu_class=TwitterMenu, consumer=TwitterConsumer(), chef=TwitterRecipeChef(), *args,**kwargs)
+        kwargs.setdefault('consumer', TwitterConsumer())
+        return super(Twitter, self).__init__(menu_class=TwitterMenu, chef=TwitterRecipeChef(), *args,**kwargs)
 
-TWITTER_ENDPOINTS = LaxRecipeChef.string_recipe_to_dict("""
+CURSORED_KEYS = ('ids', 'users', 'lists')
+
+TWITTER_ENDPOINTS = LazyRecipe("""
     search - GET
     trends - GET
     trends/current - GET
@@ -56,10 +94,14 @@ TWITTER_ENDPOINTS = LaxRecipeChef.string_recipe_to_dict("""
     statuses/retweeted_to_me - GET
     statuses/retweets_of_me - GET
     statuses/show - GET
+    statuses/show/:id - GET
     statuses/update - POST
     statuses/destroy - POST
+    statuses/destroy/:id - POST
     statuses/retweet - POST
+    statuses/retweet/:id - POST
     statuses/retweets - GET
+    statuses/retweets/:id - GET
     users/show - GET
     users/search - GET
     statuses/friends - GET
@@ -68,8 +110,11 @@ TWITTER_ENDPOINTS = LaxRecipeChef.string_recipe_to_dict("""
     direct_messages/sent - GET
     direct_messages/new - POST
     direct_messages/destroy - POST
+    direct_messages/destroy/:id - POST
     friendships/create - POST
+    friendships/create/:id - POST
     friendships/destroy - POST
+    friendships/destroy/:id - POST
     friendships/exists - GET
     friendships/show - GET
     friends/ids - GET
@@ -84,19 +129,25 @@ TWITTER_ENDPOINTS = LaxRecipeChef.string_recipe_to_dict("""
     account/update_profile - POST
     favorites - GET
     favorites/create - POST
+    favorites/create/:id - POST
     favorites/destroy - POST
+    favorites/destroy/:id - POST
     notifications/follow - POST
     notifications/leave - POST
     blocks/create - POST
+    blocks/create/:id - POST
     blocks/destroy - POST
+    blocks/destroy/:id - POST
     blocks/exists - GET
     blocks/blocking - GET
     blocks/blocking/ids - GET
     report_spam - GET
     saved_searches - GET
     saved_searches/show - GET
+    saved_searches/show/:id - GET
     saved_searches/create - POST
     saved_searches/destroy - POST
+    saved_searches/destroy/:id - POST
     oauth/request_token - GET
     oauth/authorize - GET
     oauth/authenticate - GET
@@ -104,3 +155,5 @@ TWITTER_ENDPOINTS = LaxRecipeChef.string_recipe_to_dict("""
     trends/available - GET
     trends/location - GET
 """)
+
+TWITTER_ROUTER = RecipeRouter('https://twitter.com', TWITTER_ENDPOINTS)
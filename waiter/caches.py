@@ -0,0 +1,484 @@
+from waiter.tickets import Ticket
+from waiter.chefs import endpoint_of
+from waiter.transports import consume
+from collections import OrderedDict
+import threading
+import hashlib
+import httplib2
+import cPickle
+import struct
+import fcntl
+import mmap
+import json
+import zlib
+import time
+import os
+
+class CacheEntry(object):
+    def __init__(self, parsed, size, expires, etag=None, last_modified=None):
+        self.parsed = parsed
+        self.size = size
+        self.expires = expires
+        self.etag = etag
+        self.last_modified = last_modified
+
+class MemoryStore(object):
+    """
+        Least-recently-used entries get thrown out once the raw bodies of
+        everything held add up to more than `max_bytes`.
+    """
+    def __init__(self, max_bytes=16*1024*1024):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self._entries[key] = entry
+            return entry
+        finally:
+            self._lock.release()
+
+    def set(self, key, entry):
+        self._lock.acquire()
+        try:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old.size
+            self._entries[key] = entry
+            self.bytes += entry.size
+            while self.bytes > self.max_bytes and self._entries:
+                evicted_key, evicted = self._entries.popitem(last=False)
+                self.bytes -= evicted.size
+                self.evictions += 1
+        finally:
+            self._lock.release()
+
+    def delete(self, key):
+        self._lock.acquire()
+        try:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.bytes -= entry.size
+        finally:
+            self._lock.release()
+
+    def __len__(self):
+        return len(self._entries)
+
+class DiskStore(object):
+    """
+        Pickles each entry into its own file under `directory`, so a cache
+        survives the process that filled it.
+    """
+    def __init__(self, directory):
+        self.directory = directory
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.md5(repr(key)).hexdigest())
+
+    def get(self, key):
+        try:
+            handle = open(self._path(key), 'rb')
+        except IOError:
+            return None
+        try:
+            try:
+                stored_key, entry = cPickle.load(handle)
+            except Exception:
+                return None
+        finally:
+            handle.close()
+        return entry if stored_key == key else None
+
+    def set(self, key, entry):
+        path = self._path(key)
+        temp_path = '%s.%d.%d' % (path, os.getpid(), threading.currentThread().ident)
+        handle = open(temp_path, 'wb')
+        try:
+            cPickle.dump((key, entry), handle, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            handle.close()
+        os.rename(temp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+class ResponseCache(object):
+    """
+        Sits between the Waiter and his http, holding on to what the Consumer
+        made of GET responses. Fresh entries are served without touching the
+        network; stale ones are revalidated with their ETag or Last-Modified,
+        and a 304 hands back the already-consumed result without parsing again.
+
+        `ttls` maps endpoints (the uri path, minus its leading slash and file
+        extension -- 'users/show', 'trends/current') to seconds; anything else
+        gets `default_ttl`. Results are shared between callers, so don't go
+        changing them.
+    """
+    def __init__(self, store=None, ttls=None, default_ttl=60, clock=time.time):
+        self.store = store if store is not None else MemoryStore()
+        self.ttls = ttls if ttls else {}
+        self.default_ttl = default_ttl
+        self._clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.revalidations = 0
+
+    def key(self, cooked_data):
+        return (cooked_data['method'], cooked_data['uri'], cooked_data['body'])
+
+    def ttl_for(self, uri):
+        return self.ttls.get(endpoint_of(uri), self.default_ttl)
+
+    def serve(self, cooked_data, http, consumer):
+        if cooked_data['method'] != 'GET':
+            response, data = http.request(**cooked_data)
+            return consume(consumer, response, data)
+
+        key = self.key(cooked_data)
+        entry = self.store.get(key)
+        if entry is not None and entry.expires > self._clock():
+            self.hits += 1
+            return entry.parsed
+
+        request = dict(cooked_data)
+        if entry is not None:
+            headers = dict(request.get('headers') or {})
+            if entry.etag:
+                headers['if-none-match'] = entry.etag
+            if entry.last_modified:
+                headers['if-modified-since'] = entry.last_modified
+            request['headers'] = headers
+
+        response, data = http.request(**request)
+        ttl = self.ttl_for(cooked_data['uri'])
+        if entry is not None and response.status == 304:
+            if hasattr(data, 'close'):
+                data.close()
+            self.revalidations += 1
+            entry.expires = self._clock() + ttl
+            self.store.set(key, entry)
+            return entry.parsed
+
+        self.misses += 1
+        parsed = consume(consumer, response, data)
+        if response.status == 200:
+            self.store.set(key, CacheEntry(parsed, len(data), self._clock() + ttl,
+                etag=response.get('etag'), last_modified=response.get('last-modified')))
+        return parsed
+
+    def stats(self):
+        return {
+            'hits':self.hits,
+            'misses':self.misses,
+            'revalidations':self.revalidations,
+        }
+
+class SingleFlight(object):
+    """
+        When the same order is already on its way to the kitchen, don't send
+        another -- wait for the first one and share its plate. Orders are the
+        same when their cooked (method, uri, body) match. Put a ResponseCache
+        behind it as the `backend` to coalesce the cache's misses too.
+    """
+    def __init__(self, backend=None, methods=('GET',)):
+        self.backend = backend
+        self.methods = methods
+        self._lock = threading.Lock()
+        self._in_flight = {}
+        self.leaders = 0
+        self.followers = 0
+
+    def _serve(self, cooked_data, http, consumer):
+        if self.backend is not None:
+            return self.backend.serve(cooked_data, http, consumer)
+        response, data = http.request(**cooked_data)
+        return consume(consumer, response, data)
+
+    def serve(self, cooked_data, http, consumer):
+        if cooked_data['method'] not in self.methods:
+            return self._serve(cooked_data, http, consumer)
+
+        key = (cooked_data['method'], cooked_data['uri'], cooked_data['body'])
+        self._lock.acquire()
+        try:
+            ticket = self._in_flight.get(key)
+            if ticket is None:
+                leader = True
+                ticket = self._in_flight[key] = Ticket()
+                self.leaders += 1
+            else:
+                leader = False
+                self.followers += 1
+        finally:
+            self._lock.release()
+
+        if not leader:
+            return ticket.result()
+
+        try:
+            try:
+                result = self._serve(cooked_data, http, consumer)
+            except Exception:
+                ticket.fail()
+                raise
+            ticket.fulfill(result)
+            return result
+        finally:
+            self._lock.acquire()
+            try:
+                del self._in_flight[key]
+            finally:
+                self._lock.release()
+
+    def stats(self):
+        return {
+            'leaders':self.leaders,
+            'followers':self.followers,
+        }
+
+class MappedTable(object):
+    """
+        A fixed-size hash table in a memory-mapped file, so every process on
+        a machine that opens the same `path` sees the same entries. Keys hash
+        to a set of `ways` slots of `slot_size` bytes each; values that don't
+        fit in a slot aren't kept.
+
+        Reads don't lock: each slot carries a version that's odd while it's
+        being written and a checksum of what's in it, and a read that sees
+        either move just looks again. Writes lock their set -- with a byte-range
+        lock on the file, against other processes, and a thread lock within
+        this one. When a set's full, the entry nobody's read since the clock
+        last came round is the one thrown out; expired entries go first.
+    """
+    MAGIC = 'WAITMAP1'
+    HEADER = struct.Struct('<8sIII')
+    SLOT = struct.Struct('<IB3xQdIII')
+    retries = 8
+
+    def __init__(self, path, slots=1024, slot_size=32*1024, ways=8, clock=time.time):
+        self.path = path
+        self.ways = min(ways, slots)
+        self.sets = slots // self.ways
+        self.slots = self.sets * self.ways
+        self.slot_size = slot_size
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.evictions = 0
+        self.oversize = 0
+        self._fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        size = self.HEADER.size + self.slots * slot_size
+        fcntl.lockf(self._fd, fcntl.LOCK_EX, self.HEADER.size, 0)
+        try:
+            header = os.read(self._fd, self.HEADER.size)
+            if len(header) == self.HEADER.size:
+                magic, slots, slot_size, ways = self.HEADER.unpack(header)
+                if (magic, slots, slot_size, ways) != (self.MAGIC, self.slots, self.slot_size, self.ways):
+                    raise ValueError("%s holds a table of %d %d-byte slots in sets of %d" % (path, slots, slot_size, ways))
+            else:
+                os.ftruncate(self._fd, size)
+                os.lseek(self._fd, 0, os.SEEK_SET)
+                os.write(self._fd, self.HEADER.pack(self.MAGIC, self.slots, self.slot_size, self.ways))
+        finally:
+            fcntl.lockf(self._fd, fcntl.LOCK_UN, self.HEADER.size, 0)
+        self._map = mmap.mmap(self._fd, size)
+
+    def _digest(self, key):
+        return struct.unpack('<Q', hashlib.sha1(key).digest()[:8])[0]
+
+    def _offsets(self, digest):
+        first = self.HEADER.size + (digest % self.sets) * self.ways * self.slot_size
+        return [first + way * self.slot_size for way in range(self.ways)]
+
+    def _read(self, offset, key, digest):
+        """
+            The (expires, value) in the slot at `offset`, if it holds `key` --
+            or None. `False` means it was being written; try again.
+        """
+        version, referenced, stored_digest, expires, key_length, value_length, checksum = self.SLOT.unpack_from(self._map, offset)
+        if version % 2:
+            return False
+        if stored_digest != digest or key_length != len(key):
+            return None
+        start = offset + self.SLOT.size
+        record = self._map[start:start + key_length + value_length]
+        if self.SLOT.unpack_from(self._map, offset)[0] != version:
+            return False
+        if zlib.crc32(record) & 0xffffffff != checksum or record[:key_length] != key:
+            return None
+        if not referenced:
+            self._map[offset + 4] = '\x01'
+        return expires, record[key_length:]
+
+    def get(self, key):
+        """
+            What's held under `key`, if it's there and hasn't expired.
+        """
+        digest = self._digest(key)
+        now = self._clock()
+        for offset in self._offsets(digest):
+            for attempt in range(self.retries):
+                found = self._read(offset, key, digest)
+                if found is not False:
+                    break
+            else:
+                found = None
+            if found:
+                expires, value = found
+                return value if expires > now else None
+        return None
+
+    def _victim(self, offsets, digest, key):
+        now = self._clock()
+        slots = [(offset, self.SLOT.unpack_from(self._map, offset)) for offset in offsets]
+        for offset, slot in slots:
+            if slot[2] == digest and slot[4] == len(key):
+                return offset, False
+        for offset, slot in slots:
+            if not slot[4] or slot[3] <= now:
+                return offset, False
+        for sweep in range(2):
+            for offset, slot in slots:
+                if sweep or self._map[offset + 4] != '\x01':
+                    return offset, True
+                self._map[offset + 4] = '\x00'
+
+    def set(self, key, value, expires):
+        if self.SLOT.size + len(key) + len(value) > self.slot_size:
+            self._count('oversize')
+            return False
+        digest = self._digest(key)
+        offsets = self._offsets(digest)
+        lock_at = self.HEADER.size + (digest % self.sets) * self.ways * self.slot_size
+        self._lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, lock_at)
+            try:
+                offset, evicted = self._victim(offsets, digest, key)
+                version = self.SLOT.unpack_from(self._map, offset)[0]
+                record = key + value
+                writing = (version + 1) & 0xffffffff
+                struct.pack_into('<I', self._map, offset, writing)
+                self._map[offset + self.SLOT.size:offset + self.SLOT.size + len(record)] = record
+                self.SLOT.pack_into(self._map, offset, writing, 0, digest, expires, len(key), len(value), zlib.crc32(record) & 0xffffffff)
+                struct.pack_into('<I', self._map, offset, (version + 2) & 0xffffffff)
+                if evicted:
+                    self.evictions += 1
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, lock_at)
+        finally:
+            self._lock.release()
+        return True
+
+    def delete(self, key):
+        digest = self._digest(key)
+        lock_at = self.HEADER.size + (digest % self.sets) * self.ways * self.slot_size
+        self._lock.acquire()
+        try:
+            fcntl.lockf(self._fd, fcntl.LOCK_EX, 1, lock_at)
+            try:
+                for offset in self._offsets(digest):
+                    if self._read(offset, key, digest):
+                        version = self.SLOT.unpack_from(self._map, offset)[0]
+                        self.SLOT.pack_into(self._map, offset, (version + 2) & 0xffffffff, 0, 0, 0.0, 0, 0, 0)
+            finally:
+                fcntl.lockf(self._fd, fcntl.LOCK_UN, 1, lock_at)
+        finally:
+            self._lock.release()
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._map.close()
+        os.close(self._fd)
+
+class SharedCache(object):
+    """
+        A ResponseCache for every process on the machine: the raw bodies and
+        headers of 200 responses to GETs go in a MappedTable at `path` (put it
+        on /dev/shm to keep it off the disk), and whichever process asks for
+        the same order next hands them to its own Consumer rather than going
+        back out. TTLs work as they do for a ResponseCache.
+
+        `stats` are this process's: how often the table had what it asked
+        for, and how many response bytes didn't have to come over the wire.
+    """
+    def __init__(self, path, ttls=None, default_ttl=60, clock=time.time, **table_options):
+        self.table = path if isinstance(path, MappedTable) else MappedTable(path, clock=clock, **table_options)
+        self.ttls = ttls if ttls else {}
+        self.default_ttl = default_ttl
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.bytes_saved = 0
+
+    def key(self, cooked_data):
+        return '%s %s' % (cooked_data['method'], cooked_data['uri'])
+
+    def ttl_for(self, uri):
+        return self.ttls.get(endpoint_of(uri), self.default_ttl)
+
+    def _count(self, hit, saved=0):
+        self._lock.acquire()
+        try:
+            if hit:
+                self.hits += 1
+                self.bytes_saved += saved
+            else:
+                self.misses += 1
+        finally:
+            self._lock.release()
+
+    def serve(self, cooked_data, http, consumer):
+        if cooked_data['method'] != 'GET':
+            response, data = http.request(**cooked_data)
+            return consume(consumer, response, data)
+
+        key = self.key(cooked_data)
+        value = self.table.get(key)
+        if value is not None:
+            length = struct.unpack_from('<I', value)[0]
+            headers = dict((name.encode('utf-8'), header.encode('utf-8')) for name, header in json.loads(value[4:4 + length]).items())
+            data = value[4 + length:]
+            self._count(True, len(data))
+            return consumer.handle(httplib2.Response(headers), data)
+
+        self._count(False)
+        response, data = http.request(**cooked_data)
+        parsed = consume(consumer, response, data)
+        if response.status == 200 and isinstance(data, str):
+            headers = json.dumps(dict(response, status=str(response.status)))
+            self.table.set(key, struct.pack('<I', len(headers)) + headers + data, self._clock() + self.ttl_for(cooked_data['uri']))
+        return parsed
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            lookups = self.hits + self.misses
+            return {
+                'hits':self.hits,
+                'misses':self.misses,
+                'hit_ratio':float(self.hits) / lookups if lookups else 0.0,
+                'bytes_saved':self.bytes_saved,
+                'evictions':self.table.evictions,
+                'oversize':self.table.oversize,
+            }
+        finally:
+            self._lock.release()
@@ -0,0 +1,142 @@
+from waiter.transports import HttpWrapper
+import threading
+import urlparse
+import urllib
+import base64
+import httplib2
+import gzip
+import json
+import time
+
+class Cassette(object):
+    """
+        A recorded session: what was asked for and what came back, in order.
+        Saved as one JSON object per line -- gzipped when `path` ends in .gz --
+        so cassettes diff, grep and compress well.
+
+        Requests are matched on their method, uri and body. Query params named
+        in `ignore_params` (oauth's nonce, timestamp and signature, by default)
+        are left out of the match, since they never come out the same twice.
+    """
+    class Missing(KeyError):
+        pass
+
+    def __init__(self, path=None, ignore_params=('oauth_nonce', 'oauth_timestamp', 'oauth_signature')):
+        self.path = path
+        self.ignore_params = frozenset(ignore_params)
+        self.interactions = []
+        self._lock = threading.Lock()
+        self._index = None
+        self._plays = {}
+
+    def key(self, method, uri, body):
+        if self.ignore_params and '?' in uri:
+            base, query = uri.split('?', 1)
+            params = [(k, v) for k, v in urlparse.parse_qsl(query, True) if k not in self.ignore_params]
+            uri = '%s?%s' % (base, urllib.urlencode(sorted(params)))
+        return (method, uri, body)
+
+    def record(self, method, uri, body, response, data):
+        interaction = {
+            'method':method,
+            'uri':uri,
+            'body':body,
+            'status':response.status,
+            'headers':dict((k, v) for k, v in response.items() if k != 'status'),
+        }
+        try:
+            interaction['data'] = data.decode('utf-8')
+        except UnicodeDecodeError:
+            interaction['data64'] = base64.b64encode(data)
+        self._lock.acquire()
+        try:
+            self.interactions.append(interaction)
+            self._index = None
+        finally:
+            self._lock.release()
+
+    def play(self, method, uri, body):
+        """
+            The next recorded (response, data) for this request. Requests made
+            more often than they were recorded go round the recordings again.
+        """
+        key = self.key(method, uri, body)
+        self._lock.acquire()
+        try:
+            if self._index is None:
+                self._index = {}
+                for interaction in self.interactions:
+                    self._index.setdefault(self.key(interaction['method'], interaction['uri'], interaction['body']), []).append(interaction)
+            recorded = self._index.get(key)
+            if not recorded:
+                raise Cassette.Missing("Nothing recorded for %s %s" % (method, uri))
+            plays = self._plays.get(key, 0)
+            self._plays[key] = plays + 1
+            interaction = recorded[plays % len(recorded)]
+        finally:
+            self._lock.release()
+        headers = dict(interaction['headers'], status=str(interaction['status']))
+        if 'data64' in interaction:
+            data = base64.b64decode(interaction['data64'])
+        else:
+            data = interaction['data'].encode('utf-8')
+        return httplib2.Response(headers), data
+
+    def _open(self, mode):
+        if self.path.endswith('.gz'):
+            return gzip.open(self.path, mode)
+        return open(self.path, mode)
+
+    def save(self, path=None):
+        self.path = path if path else self.path
+        handle = self._open('wb')
+        try:
+            for interaction in self.interactions:
+                handle.write(json.dumps(interaction, sort_keys=True) + '\n')
+        finally:
+            handle.close()
+
+    @classmethod
+    def load(cls, path, **kwargs):
+        cassette = cls(path, **kwargs)
+        handle = cassette._open('rb')
+        try:
+            cassette.interactions = [json.loads(line) for line in handle if line.strip()]
+        finally:
+            handle.close()
+        return cassette
+
+    def __len__(self):
+        return len(self.interactions)
+
+class RecordingHttp(HttpWrapper):
+    """
+        Sends requests on through the wrapped http, recording each one and
+        its response onto a Cassette.
+    """
+    def __init__(self, http, cassette):
+        super(RecordingHttp, self).__init__(http)
+        self.cassette = cassette
+
+    def request(self, uri, method='GET', body=None, **kwargs):
+        response, data = self.http.request(uri=uri, method=method, body=body, **kwargs)
+        self.cassette.record(method, uri, body, response, data)
+        return response, data
+
+class ReplayHttp(object):
+    """
+        Stands in for an http, answering from a Cassette without going near
+        the network. Give it a `latency` to make each response take that long,
+        as if it had.
+    """
+    thread_safe = True
+
+    def __init__(self, cassette, latency=0, sleep=time.sleep):
+        self.cassette = cassette
+        self.latency = latency
+        self._sleep = sleep
+
+    def request(self, uri, method='GET', body=None, **kwargs):
+        if self.latency:
+            self._sleep(self.latency)
+        return self.cassette.play(method, uri, body)
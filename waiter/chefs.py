@@ -1,17 +1,161 @@
 from waiter import Chef
+from collections import namedtuple
+import collections
+import threading
+import urlparse
 
-class LaxRecipeChef(Chef):
+def endpoint_of(uri):
+    """
+        The recipe name for a cooked uri -- its path, minus the leading slash
+        and any file extension: 'https://twitter.com/users/show.json?a=b'
+        is 'users/show'.
+    """
+    return urlparse.urlparse(uri)[2].lstrip('/').rsplit('.', 1)[0]
+
+class Route(namedtuple('Route', 'method endpoint prefix params')):
+    """
+        Where an order is going: its HTTP method, the recipe endpoint it
+        matched (None if it matched nothing), the uri up to its file extension,
+        and any path parameters captured along the way as (name, value) pairs.
+    """
+    __slots__ = ()
+
+_compiling = threading.Lock()
+
+class RecipeRouter(object):
+    """
+        Compiles a recipe -- endpoint to method, as from
+        `LaxRecipeChef.string_recipe_to_dict` -- the first time it routes
+        anything (or when told to `compile`). Plain endpoints resolve to a
+        prebuilt Route with a single dict lookup; templates with path
+        parameters, like 'statuses/show/:id', are matched a segment at a time
+        against a trie. Threads that route while it's compiling wait for it
+        to finish. A compiled router pickles with its routes.
+    """
     def __init__(self, domain, recipe):
+        self.domain = domain
+        self.recipe = recipe
+        self.static = None
+        self.trie = None
+
+    def compile(self):
+        if self.static is not None:
+            return self
+        _compiling.acquire()
+        try:
+            if self.static is None:
+                static, trie = {}, None
+                for endpoint, method in self.recipe.items():
+                    segments = endpoint.split('/')
+                    if any(segment.startswith(':') for segment in segments):
+                        trie = trie if trie else [{}, None, None]
+                        self._insert(trie, segments, endpoint, method)
+                    else:
+                        static[endpoint] = Route(method, endpoint, '%s/%s' % (self.domain, endpoint), ())
+                self.trie = trie
+                self.static = static
+        finally:
+            _compiling.release()
+        return self
+
+    def _insert(self, node, segments, endpoint, method):
+        for segment in segments:
+            if segment.startswith(':'):
+                if node[1] is None:
+                    node[1] = (segment[1:], [{}, None, None])
+                node = node[1][1]
+            else:
+                node = node[0].setdefault(segment, [{}, None, None])
+        node[2] = (endpoint, method)
+
+    def _match(self, node, segments, i, captured):
+        if i == len(segments):
+            return node[2], captured
+        child = node[0].get(segments[i])
+        if child is not None:
+            found = self._match(child, segments, i + 1, captured)
+            if found[0] is not None:
+                return found
+        if node[1] is not None:
+            name, child = node[1]
+            return self._match(child, segments, i + 1, captured + ((name, segments[i]),))
+        return None, ()
+
+    def route(self, path):
+        """
+            The Route for `path` (no leading slash, no extension), or None if
+            no endpoint in the recipe matches it.
+        """
+        if self.static is None:
+            self.compile()
+        route = self.static.get(path)
+        if route is not None or self.trie is None:
+            return route
+        target, captured = self._match(self.trie, path.split('/'), 0, ())
+        if target is None:
+            return None
+        return Route(target[1], target[0], '%s/%s' % (self.domain, path), captured)
+
+class LazyRecipe(collections.Mapping):
+    """
+        A recipe string, left unparsed until something looks at it.
+    """
+    def __init__(self, string):
+        self.string = string
+        self._recipe = None
+
+    def _parsed(self):
+        if self._recipe is None:
+            self._recipe = LaxRecipeChef.string_recipe_to_dict(self.string)
+        return self._recipe
+
+    def __getitem__(self, endpoint):
+        return self._parsed()[endpoint]
+
+    def __iter__(self):
+        return iter(self._parsed())
+
+    def __len__(self):
+        return len(self._parsed())
+
+class LaxRecipeChef(Chef):
+    """
+        Looks each order up in its recipe to pick the HTTP method; orders for
+        endpoints the recipe doesn't know go out with the chef's own `method`.
+        The chef is never changed by cooking, so one can serve many threads.
+    """
+    def __init__(self, domain, recipe, router=None, body_encoding=None):
         self.recipe = recipe
         self.domain = domain
         self.method = 'GET'
+        self.body_encoding = body_encoding
+        self.router = router if router else RecipeRouter(domain, recipe)
 
-    def cook_data(self, stack, params):
+    def route(self, stack):
         uri = ''.join(stack)
-        endpoint, format = uri.rsplit('.', 1)
-        if endpoint in self.recipe:
-            self.method = self.recipe[endpoint]
-        return super(LaxRecipeChef, self).cook_data([self.domain,'/']+stack, params)
+        path, dot, format = uri.rpartition('.')
+        if not dot:
+            path, format = uri, None
+        route = self.router.route(path)
+        if route is None:
+            route = Route(self.method, None, '%s/%s' % (self.domain, path), ())
+        return route, ('.' + format if format is not None else '')
+
+    def endpoint_for(self, uri):
+        """
+            The recipe endpoint a cooked uri was routed to -- the template, for
+            uris with path parameters -- or its bare path if it matched none.
+        """
+        path = endpoint_of(uri)
+        prefix = urlparse.urlparse(self.domain)[2].strip('/')
+        if prefix and path.startswith(prefix + '/'):
+            path = path[len(prefix) + 1:]
+        route = self.router.route(path)
+        return route.endpoint if route is not None else path
+
+    def prepare(self, stack):
+        route, extension = self.route(stack)
+        return route.prefix + extension, route.method
 
     @classmethod
     def string_recipe_to_dict(cls, string):
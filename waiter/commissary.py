@@ -0,0 +1,219 @@
+"""
+    Parsing off the request threads. A Commissary is a pool of worker
+    processes that decode response bodies -- and run the Consumer's checks
+    on what comes out -- so that a big fan-out isn't held to one core by
+    the GIL. Bodies are handed to the workers through an anonymous shared
+    memory arena they inherit when they're forked, rather than pickled down
+    a pipe; only the parsed result comes back pickled.
+"""
+from waiter import Consumer
+from waiter.tickets import Ticket
+import multiprocessing
+import threading
+import time
+import cPickle
+import httplib2
+import Queue
+import mmap
+
+_arena = None
+_slot_size = None
+
+def _open_arena(arena, slot_size):
+    global _arena, _slot_size
+    _arena, _slot_size = arena, slot_size
+
+def _prepare(consumer, status, headers, slot, length, data):
+    if data is None:
+        offset = slot * _slot_size
+        data = _arena[offset:offset + length]
+    response = httplib2.Response(dict(headers, status=str(status)))
+    try:
+        result = consumer.handle(response, data)
+    except Exception as e:
+        try:
+            cPickle.dumps(e, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            e = Commissary.Error('%s: %s' % (e.__class__.__name__, e))
+        return False, e
+    try:
+        return True, cPickle.dumps(result, cPickle.HIGHEST_PROTOCOL)
+    except Exception as e:
+        return False, Commissary.Error("Can't send back a %s: %s" % (result.__class__.__name__, e))
+
+class Commissary(object):
+    """
+        `processes` workers (one per core, by default) sharing `slots` buffers
+        of `slot_size` bytes. A body waits for a free slot before it's sent
+        over, which keeps the workers from being buried; bodies too big for a
+        slot are pickled over instead. Create one before starting threads
+        of your own, since the workers are forked. A body that isn't handled
+        within `timeout` seconds (say, because its worker died) fails with
+        Commissary.Error.
+
+        Results come back to a single collector thread, which frees their
+        slots and settles their Tickets, and looks over the bodies still out
+        every `check_every` seconds for ones that failed or ran out of time.
+    """
+    class Error(Exception):
+        pass
+
+    check_every = 0.05
+    _closing = object()
+
+    def __init__(self, processes=None, slots=None, slot_size=4*1024*1024, timeout=None):
+        processes = processes if processes else multiprocessing.cpu_count()
+        slots = slots if slots else processes * 2
+        self.slot_size = slot_size
+        self.timeout = timeout
+        self._arena = mmap.mmap(-1, slots * slot_size)
+        self._free = Queue.Queue()
+        for slot in range(slots):
+            self._free.put(slot)
+        self._pool = multiprocessing.Pool(processes, _open_arena, (self._arena, slot_size))
+        self._lock = threading.Lock()
+        self._orders = {}
+        self._sequence = 0
+        self._done = Queue.Queue()
+        self._collector = threading.Thread(target=self._collect)
+        self._collector.setDaemon(True)
+        self._collector.start()
+        self.shared = 0
+        self.pickled = 0
+
+    def submit(self, consumer, response, data):
+        """
+            Have `consumer` handle `response` and `data` in a worker, handing
+            back a Ticket for what it returns (or raises).
+        """
+        ticket = Ticket()
+        slot = self._free.get() if len(data) <= self.slot_size else None
+        if slot is not None:
+            offset = slot * self.slot_size
+            self._arena[offset:offset + len(data)] = data
+            args = (consumer, response.status, dict(response), slot, len(data), None)
+        else:
+            args = (consumer, response.status, dict(response), None, None, data)
+
+        due = time.time() + self.timeout if self.timeout is not None else None
+        order = [ticket, slot, due, None]
+        self._lock.acquire()
+        try:
+            if slot is not None:
+                self.shared += 1
+            else:
+                self.pickled += 1
+            self._sequence += 1
+            key = self._sequence
+            self._orders[key] = order
+            first = len(self._orders) == 1
+        finally:
+            self._lock.release()
+        if first:
+            self._done.put(None)
+        order[3] = self._pool.apply_async(_prepare, args, callback=lambda result: self._done.put((key, result)))
+        return ticket
+
+    def _collect(self):
+        while True:
+            self._lock.acquire()
+            try:
+                idle = not self._orders
+            finally:
+                self._lock.release()
+            try:
+                done = self._done.get(True, None if idle else self.check_every)
+            except Queue.Empty:
+                done = None
+            if done is self._closing:
+                self._check()
+                return
+            if done is not None:
+                self._settle(*done)
+            self._check()
+
+    def _check(self):
+        now = time.time()
+        self._lock.acquire()
+        try:
+            orders = self._orders.items()
+        finally:
+            self._lock.release()
+        for key, (ticket, slot, due, pending) in orders:
+            if pending is None:
+                continue
+            if pending.ready() and not pending.successful():
+                try:
+                    pending.get(0)
+                except Exception as e:
+                    self._settle(key, (False, Commissary.Error('%s: %s' % (e.__class__.__name__, e))))
+            elif due is not None and now >= due and not pending.ready():
+                self._settle(key, (False, Commissary.Error("Not handled within %s seconds" % self.timeout)))
+
+    def _settle(self, key, result):
+        self._lock.acquire()
+        try:
+            order = self._orders.pop(key, None)
+        finally:
+            self._lock.release()
+        if order is None:
+            return
+        ticket, slot = order[0], order[1]
+        if slot is not None:
+            self._free.put(slot)
+        succeeded, value = result
+        if succeeded:
+            try:
+                value = cPickle.loads(value)
+            except Exception as e:
+                succeeded, value = False, Commissary.Error('%s: %s' % (e.__class__.__name__, e))
+        try:
+            if succeeded:
+                ticket.fulfill(value)
+            else:
+                ticket.fail((value.__class__, value, None))
+        except Exception:
+            pass
+
+    def close(self):
+        self._pool.close()
+        self._pool.join()
+        self._done.put(self._closing)
+        self._collector.join()
+        self._arena.close()
+
+    def stats(self):
+        return {
+            'shared':self.shared,
+            'pickled':self.pickled,
+            'free_slots':self._free.qsize(),
+        }
+
+class CommissaryConsumer(Consumer):
+    """
+        Sends bodies of `threshold` bytes or more off to a Commissary to be
+        handled by `consumer`, and handles smaller ones right here, where
+        it's cheaper. Either way you get a Ticket back -- so it's no use
+        behind a DiskStore, which would have to pickle it. Paging is left
+        to `consumer`, once the page is in.
+    """
+    def __init__(self, consumer, commissary, threshold=64*1024):
+        self.consumer = consumer
+        self.commissary = commissary
+        self.threshold = threshold
+
+    def handle(self, response, data):
+        if isinstance(data, str) and len(data) >= self.threshold:
+            return self.commissary.submit(self.consumer, response, data)
+        ticket = Ticket()
+        try:
+            ticket.fulfill(self.consumer.handle(response, data))
+        except Exception:
+            ticket.fail()
+        return ticket
+
+    def first_page(self, params):
+        return self.consumer.first_page(params)
+
+    def next_page(self, parsed_data):
+        return self.consumer.next_page(parsed_data.result())
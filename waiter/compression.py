@@ -0,0 +1,128 @@
+"""
+    Content-Encodings waiter can take apart a chunk at a time, and put
+    together for request bodies. gzip and deflate come with zlib; br needs
+    the brotli package, and is only offered when it's installed.
+"""
+import zlib
+import time
+
+def _gzip():
+    return zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+def _deflate():
+    return DeflateDecompressor()
+
+def _brotli():
+    import brotli
+    return BrotliDecompressor(brotli.Decompressor())
+
+DECOMPRESSORS = {
+    'gzip':_gzip,
+    'x-gzip':_gzip,
+    'deflate':_deflate,
+    'br':_brotli,
+}
+
+PREFERENCE = ('gzip', 'deflate', 'br')
+
+class DeflateDecompressor(object):
+    """
+        'deflate' is meant to be zlib-wrapped, but plenty of servers send a
+        raw deflate stream instead; take whichever turns up.
+    """
+    def __init__(self):
+        self._decompressor = zlib.decompressobj()
+        self._started = False
+
+    def decompress(self, chunk):
+        if not self._started and chunk:
+            self._started = True
+            try:
+                return self._decompressor.decompress(chunk)
+            except zlib.error:
+                self._decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        return self._decompressor.decompress(chunk)
+
+    def flush(self):
+        return self._decompressor.flush()
+
+class BrotliDecompressor(object):
+    def __init__(self, decompressor):
+        self._decompressor = decompressor
+
+    def decompress(self, chunk):
+        if hasattr(self._decompressor, 'process'):
+            return self._decompressor.process(chunk)
+        return self._decompressor.decompress(chunk)
+
+    def flush(self):
+        return ''
+
+def available_encodings():
+    available = []
+    for name in PREFERENCE:
+        try:
+            DECOMPRESSORS[name]()
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+_accept_encoding = None
+
+def accept_encoding():
+    global _accept_encoding
+    if _accept_encoding is None:
+        _accept_encoding = ', '.join(available_encodings())
+    return _accept_encoding
+
+class Decompressor(object):
+    """
+        Inflates a body one chunk at a time, keeping count of the bytes that
+        went in and came out, and the time spent doing it.
+    """
+    def __init__(self, encoding):
+        self.encoding = encoding
+        self._decompressor = DECOMPRESSORS[encoding]()
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.seconds = 0.0
+
+    def decompress(self, chunk):
+        started = time.time()
+        data = self._decompressor.decompress(chunk)
+        self.seconds += time.time() - started
+        self.bytes_in += len(chunk)
+        self.bytes_out += len(data)
+        return data
+
+    def flush(self):
+        started = time.time()
+        data = self._decompressor.flush()
+        self.seconds += time.time() - started
+        self.bytes_out += len(data)
+        return data
+
+def decompressor_for(encoding):
+    """
+        A Decompressor for a response's Content-Encoding, or None if it isn't
+        encoded (or is encoded in a way we can't undo).
+    """
+    encoding = (encoding or '').strip().lower()
+    if encoding not in DECOMPRESSORS:
+        return None
+    try:
+        return Decompressor(encoding)
+    except ImportError:
+        return None
+
+def compress(data, encoding='gzip', level=6):
+    if encoding == 'gzip':
+        compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+    if encoding == 'deflate':
+        return zlib.compress(data, level)
+    if encoding == 'br':
+        import brotli
+        return brotli.compress(data)
+    raise ValueError("Don't know how to compress with %r" % encoding)
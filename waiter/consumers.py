@@ -0,0 +1,264 @@
+from waiter import Consumer, JSONConsumer
+from waiter.decoders import default_decoder
+import collections
+import types
+import copy
+import re
+
+STRUCTURE = re.compile(r'[\[\]{},:"\\]')
+
+class ItemScanner(object):
+    """
+        Feed it a JSON document a chunk at a time, and it'll hand back the
+        elements of the array found at `path` -- a sequence of object keys from
+        the root; empty for a root array -- that each chunk completes. Only the
+        elements of the chunk being scanned are ever held in memory. Scalar members
+        of a root object (next_cursor, error, ...) are collected in `extras`.
+    """
+    def __init__(self, path=(), loads=None):
+        self.path = list(path)
+        self.loads = loads if loads else default_decoder()
+        self.extras = {}
+        self._frames = []
+        self._target = None
+        self._in_string = False
+        self._skip = 0
+        self._span = None
+        self._pieces = []
+
+    def _open(self, span):
+        self._span, self._pieces = span, []
+
+    def _close(self, chunk, start, end):
+        self._pieces.append(chunk[start:end])
+        text = ''.join(self._pieces).strip()
+        self._span, self._pieces = None, []
+        return text
+
+    def _batch(self, text, items):
+        if text:
+            items.extend(self.loads('[%s]' % text))
+
+    def feed(self, chunk):
+        items = []
+        start = 0
+        last_comma = None
+        skip, self._skip = self._skip, 0
+        for match in STRUCTURE.finditer(chunk):
+            i = match.start()
+            if i < skip:
+                continue
+            char = match.group()
+            if self._in_string:
+                if char == '\\':
+                    skip = i + 2
+                elif char == '"':
+                    self._in_string = False
+                    if self._span == 'key':
+                        self._frames[-1][1] = self.loads(self._close(chunk, start, i + 1))
+                continue
+
+            depth = len(self._frames)
+            frame = self._frames[-1] if self._frames else None
+            if self._target is not None:
+                if char == '"':
+                    self._in_string = True
+                elif char in '[{':
+                    self._frames.append([char, None, False])
+                elif depth > self._target:
+                    if char in ']}':
+                        self._frames.pop()
+                elif char == ',':
+                    last_comma = i
+                elif char == ']':
+                    self._batch(self._close(chunk, start, i), items)
+                    self._frames.pop()
+                    self._target, last_comma = None, None
+                continue
+
+            if char == '"':
+                self._in_string = True
+                if frame and frame[0] == '{' and not frame[2]:
+                    self._open('key')
+                    start = i
+            elif char == ':':
+                frame[2] = True
+                if depth == 1:
+                    self._open('value')
+                    start = i + 1
+            elif char == ',':
+                if self._span == 'value':
+                    self._extra(self._close(chunk, start, i))
+                if frame[0] == '{':
+                    frame[1], frame[2] = None, False
+            elif char in '[{':
+                if self._span == 'value':
+                    self._span, self._pieces = None, []
+                self._frames.append([char, None, False])
+                if char == '[' and [f[1] for f in self._frames[:-1]] == self.path:
+                    self._target = depth + 1
+                    self._open('item')
+                    start = i + 1
+            elif char in ']}':
+                if self._span == 'value':
+                    self._extra(self._close(chunk, start, i))
+                self._frames.pop()
+
+        self._skip = max(skip - len(chunk), 0)
+        if last_comma is not None:
+            self._batch(self._close(chunk, start, last_comma), items)
+            self._open('item')
+            start = last_comma + 1
+        if self._span is not None:
+            self._pieces.append(chunk[start:])
+        return items
+
+    def _extra(self, text):
+        if text:
+            self.extras[self._frames[0][1]] = self.loads(text)
+
+class StreamingJSONConsumer(JSONConsumer):
+    """
+        Rather than one big parsed structure, hands back a generator over the
+        elements of the array at `path`, parsed as their bytes arrive. `data`
+        can be a string, a file-like object, or any iterable of chunks -- like
+        the body a StreamingHttp hands back.
+
+        Give it a `checker` -- a TwitterConsumer, say -- and its
+        `check_response` runs before anything is read, and `check_parsed` runs
+        on the root object's scalar members once the stream is done.
+
+        The body is closed once the generator's done with it, whether it was
+        read to the end, abandoned part way, or refused by the checker.
+    """
+    def __init__(self, path=(), checker=None, chunk_size=64*1024, decoder=None):
+        super(StreamingJSONConsumer, self).__init__(decoder)
+        self.path = path
+        self.checker = checker
+        self.chunk_size = chunk_size
+
+    def chunks(self, data):
+        if isinstance(data, basestring):
+            for i in range(0, len(data), self.chunk_size):
+                yield data[i:i + self.chunk_size]
+        elif hasattr(data, 'read'):
+            chunk = data.read(self.chunk_size)
+            while chunk:
+                yield chunk
+                chunk = data.read(self.chunk_size)
+        else:
+            for chunk in data:
+                yield chunk
+
+    def handle(self, response, data):
+        if self.checker is not None:
+            self.checker.check_response(response)
+        return self.items(data)
+
+    def items(self, data):
+        scanner = ItemScanner(self.path, self.decoder)
+        try:
+            for chunk in self.chunks(data):
+                for item in scanner.feed(chunk):
+                    yield item
+        finally:
+            if hasattr(data, 'close'):
+                data.close()
+        if self.checker is not None:
+            self.checker.check_parsed(scanner.extras)
+
+_record_types = {}
+
+def record_type(fields):
+    """
+        The tuple-backed record class for `fields`, made the first time it's
+        asked for. Dotted fields get underscores in their attribute names.
+        Records pickle by their fields, so they can come back from a
+        Commissary.
+    """
+    fields = tuple(fields)
+    record = _record_types.get(fields)
+    if record is None:
+        base = collections.namedtuple('Record', [field.replace('.', '_') for field in fields], rename=True)
+        record = type('Record', (base,), {
+            '__slots__':(),
+            '__reduce__':lambda self: (make_record, (fields, tuple(self))),
+        })
+        record = _record_types.setdefault(fields, record)
+    return record
+
+def make_record(fields, values):
+    return record_type(fields)(*values)
+
+def pluck(value, path):
+    for key in path:
+        if not isinstance(value, dict):
+            return None
+        value = value.get(key)
+    return value
+
+class Projection(object):
+    """
+        Just the `fields` you're after -- 'id', or 'user.screen_name' for
+        one a level down -- as compact records instead of whole objects.
+        Divide an order by one and it's served through a ProjectingConsumer:
+
+            twitter/'statuses'/'home_timeline.json'/Projection('id', 'user.screen_name')/{'count':200}
+
+        Objects become records and lists (or streams) of them lists (or
+        streams) of records; fields an object doesn't have come out None.
+        Given `within`, a dict response keeps its shape and only the list
+        under that key is projected -- for cursored endpoints like
+        followers/list.
+    """
+    def __init__(self, *fields, **options):
+        self.fields = fields
+        self.within = options.pop('within', None)
+        if options:
+            raise TypeError("Projection doesn't take %s" % ', '.join(options))
+        self.record = record_type(fields)
+        self._paths = [tuple(field.split('.')) for field in fields]
+
+    def project_one(self, value):
+        if not isinstance(value, dict):
+            return value
+        return self.record(*[pluck(value, path) for path in self._paths])
+
+    def project(self, value):
+        if isinstance(value, dict):
+            if self.within is None:
+                return self.project_one(value)
+            if self.within in value:
+                value = dict(value)
+                value[self.within] = self.project(value[self.within])
+            return value
+        if isinstance(value, list):
+            return [self.project_one(item) for item in value]
+        if isinstance(value, types.GeneratorType):
+            return (self.project_one(item) for item in value)
+        return value
+
+    def accept_waiter(self, waiter):
+        projected = copy.copy(waiter)
+        projected._consumer = ProjectingConsumer(waiter._consumer, self)
+        waiter._stack, waiter._payload = [], {}
+        return projected
+
+class ProjectingConsumer(Consumer):
+    """
+        Projects whatever `consumer` hands back, so the full objects can be
+        let go as soon as the fields have been picked out of them. Paging
+        is left to `consumer`.
+    """
+    def __init__(self, consumer, projection):
+        self.consumer = consumer
+        self.projection = projection if isinstance(projection, Projection) else Projection(*projection)
+
+    def handle(self, response, data):
+        return self.projection.project(self.consumer.handle(response, data))
+
+    def first_page(self, params):
+        return self.consumer.first_page(params)
+
+    def next_page(self, parsed_data):
+        return self.consumer.next_page(parsed_data)
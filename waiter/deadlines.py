@@ -0,0 +1,214 @@
+"""
+    How long an order has to get done -- connecting, sending, waiting for
+    the first byte, reading the body and handing it to the Consumer -- and a
+    way to call it off early. Transports that take deadlines (`takes_deadlines
+    = True`) cut their socket timeouts down to what's left, and register an
+    abort with the Deadline so a socket still going when time runs out (or
+    the order's cancelled) is shut down and its connection thrown away.
+"""
+from waiter.transports import HttpWrapper
+import threading
+import heapq
+import types
+import copy
+import time
+
+class Deadline(object):
+    """
+        Done within `seconds` of being made, or whenever, if None -- which
+        still makes a handy cancellation token. Divide an order by one to hold
+        just that order to it:
+
+            waiter/'users'/'show.json'/Deadline(0.5)/{'screen_name':'isntitvacant'}
+
+        and call `cancel` from any thread to stop it where it is.
+    """
+    class Exceeded(Exception):
+        pass
+
+    class Cancelled(Exception):
+        pass
+
+    def __init__(self, seconds=None, clock=time.time):
+        self.seconds = seconds
+        self._clock = clock
+        self.expires = clock() + seconds if seconds is not None else None
+        self._lock = threading.Lock()
+        self._aborts = []
+        self._armed = False
+        self.cancelled = False
+
+    def remaining(self):
+        if self.expires is None:
+            return None
+        return max(0.0, self.expires - self._clock())
+
+    def stopped(self):
+        return self.cancelled or (self.expires is not None and self._clock() >= self.expires)
+
+    def check(self, stage='serving'):
+        if self.cancelled:
+            raise Deadline.Cancelled("Order was cancelled while %s" % stage)
+        if self.expires is not None and self._clock() >= self.expires:
+            raise Deadline.Exceeded("Order ran past its %ss deadline while %s" % (self.seconds, stage))
+
+    def timeout(self, default=None, stage='connecting'):
+        """
+            A socket timeout that won't outlast the deadline: what's left of
+            it, or `default` if that's sooner (or there's no expiry).
+        """
+        self.check(stage)
+        remaining = self.remaining()
+        if remaining is None:
+            return default
+        return remaining if default is None else min(default, remaining)
+
+    def on_abort(self, fn):
+        """
+            Call `fn` if the order is cancelled or runs out of time before the
+            function handed back is called to take it off again.
+        """
+        self._lock.acquire()
+        try:
+            stopped = self.cancelled
+            if not stopped:
+                self._aborts.append(fn)
+                arm, self._armed = self.expires is not None and not self._armed, True
+        finally:
+            self._lock.release()
+        if stopped:
+            fn()
+            return lambda: None
+        if arm:
+            alarm().arm(self)
+        def remove():
+            self._lock.acquire()
+            try:
+                if fn in self._aborts:
+                    self._aborts.remove(fn)
+            finally:
+                self._lock.release()
+        return remove
+
+    def _abort(self):
+        self._lock.acquire()
+        try:
+            aborts, self._aborts = self._aborts, []
+        finally:
+            self._lock.release()
+        for fn in aborts:
+            try:
+                fn()
+            except Exception:
+                pass
+
+    def cancel(self):
+        self.cancelled = True
+        self._abort()
+
+    def accept_waiter(self, waiter):
+        held = copy.copy(waiter)
+        held._deadline = self
+        waiter._stack, waiter._payload = [], {}
+        return held
+
+class Alarm(object):
+    """
+        One thread that aborts whatever's still running when each armed
+        Deadline comes due, so no order needs a timer of its own.
+    """
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._heap = []
+        self._sequence = 0
+        self._thread = None
+
+    def arm(self, deadline):
+        self._condition.acquire()
+        try:
+            self._sequence += 1
+            heapq.heappush(self._heap, (time.time() + deadline.remaining(), self._sequence, deadline))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.setDaemon(True)
+                self._thread.start()
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def _run(self):
+        while True:
+            self._condition.acquire()
+            try:
+                while not self._heap or self._heap[0][0] > time.time():
+                    self._condition.wait(self._heap[0][0] - time.time() if self._heap else None)
+                due, sequence, deadline = heapq.heappop(self._heap)
+            finally:
+                self._condition.release()
+            deadline._abort()
+
+_alarm = None
+_alarm_lock = threading.Lock()
+
+def alarm():
+    global _alarm
+    _alarm_lock.acquire()
+    try:
+        if _alarm is None:
+            _alarm = Alarm()
+        return _alarm
+    finally:
+        _alarm_lock.release()
+
+class DeadlineHttp(HttpWrapper):
+    """
+        Holds the requests an http makes for a single order to its Deadline:
+        passed down to transports that take one, and checked before and
+        after the request for those that don't.
+    """
+    def __init__(self, http, deadline):
+        super(DeadlineHttp, self).__init__(http)
+        self.deadline = deadline
+
+    def request(self, uri, **kwargs):
+        deadline = self.deadline
+        deadline.check('sending')
+        if self.takes_deadlines:
+            kwargs['deadline'] = deadline
+        try:
+            response, data = self.http.request(uri=uri, **kwargs)
+        except Exception:
+            if deadline.stopped():
+                deadline.check('waiting on the response')
+            raise
+        if deadline.stopped():
+            if hasattr(data, 'close'):
+                data.close()
+            deadline.check('waiting on the response')
+        return response, data
+
+class DeadlineConsumer(object):
+    """
+        Holds a Consumer's `handle` to a Deadline. Parsing can't be stopped
+        halfway, so the deadline's checked on either side of it -- and
+        between items, when it hands back a stream of them.
+    """
+    def __init__(self, consumer, deadline):
+        self.consumer = consumer
+        self.deadline = deadline
+
+    def handle(self, response, data):
+        self.deadline.check('consuming')
+        parsed = self.consumer.handle(response, data)
+        self.deadline.check('consuming')
+        if isinstance(parsed, types.GeneratorType):
+            return self.items(parsed)
+        return parsed
+
+    def items(self, parsed):
+        for item in parsed:
+            self.deadline.check('consuming')
+            yield item
+
+    def __getattr__(self, name):
+        return getattr(self.consumer, name)
@@ -0,0 +1,58 @@
+"""
+    JSON decoding backends for JSONConsumer. Each backend is a function that
+    takes the response body just as it came off the wire and returns Python
+    data structures. `default_decoder` picks the fastest one installed.
+"""
+
+def _orjson():
+    import orjson
+    return orjson.loads
+
+def _ujson():
+    import ujson
+    return ujson.loads
+
+def _simplejson():
+    import simplejson
+    return simplejson.loads
+
+def _simplejson_speedups():
+    import simplejson.scanner
+    if simplejson.scanner.c_make_scanner is None:
+        raise ImportError("simplejson was built without its C speedups")
+    return _simplejson()
+
+def _json():
+    import json
+    return json.loads
+
+BACKENDS = {
+    'orjson':_orjson,
+    'ujson':_ujson,
+    'simplejson':_simplejson,
+    'simplejson-speedups':_simplejson_speedups,
+    'json':_json,
+}
+
+PREFERENCE = ('orjson', 'ujson', 'simplejson-speedups', 'json', 'simplejson')
+
+def get_decoder(name):
+    return BACKENDS[name]()
+
+def available_decoders():
+    available = []
+    for name in PREFERENCE:
+        try:
+            get_decoder(name)
+        except ImportError:
+            continue
+        available.append(name)
+    return available
+
+_default = None
+
+def default_decoder():
+    global _default
+    if _default is None:
+        _default = get_decoder(available_decoders()[0])
+    return _default
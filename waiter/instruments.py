@@ -0,0 +1,218 @@
+from waiter.transports import HttpWrapper
+import threading
+import bisect
+import time
+
+STAGES = ('dispatch', 'cook', 'request', 'consume', 'decompress', 'order')
+
+class Instruments(object):
+    """
+        Hooks a Waiter calls around every stage of an order: 'dispatch' (each
+        `/` that builds it up, and the one that serves it, up until the Chef
+        starts cooking), 'cook' (the Chef), 'request' (the http),
+        'consume' (the Consumer), and 'order', around request and consume
+        together -- or around the cache, when there is one. Streamed bodies
+        get an `after` for 'decompress' once they've been read, with the time
+        spent inflating them.
+
+        `order` is a dict describing what's being timed. By the time `after`
+        is called it holds the `endpoint` the Chef resolved and, once the
+        response is in, its `status`, the `bytes` of its body and the
+        `wire_bytes` it took to send them (None when the http inflated the
+        body out of our sight). Subclass and override what you care about;
+        these do nothing.
+    """
+    clock = staticmethod(time.time)
+
+    def before(self, stage, order):
+        pass
+
+    def after(self, stage, order, elapsed, error=None):
+        pass
+
+class MeteredHttp(HttpWrapper):
+    """
+        Times the requests an http makes on behalf of a single order, and notes
+        down the status and size of what came back.
+    """
+    def __init__(self, http, instruments, order):
+        super(MeteredHttp, self).__init__(http)
+        self.instruments = instruments
+        self.order = order
+
+    def request(self, uri, **kwargs):
+        instruments, order = self.instruments, self.order
+        instruments.before('request', order)
+        started = instruments.clock()
+        try:
+            response, data = self.http.request(uri=uri, **kwargs)
+        except Exception as e:
+            instruments.after('request', order, instruments.clock() - started, e)
+            raise
+        order['status'] = response.status
+        if isinstance(data, basestring):
+            order['bytes'] = len(data)
+            order['wire_bytes'] = None if '-content-encoding' in response else len(data)
+        else:
+            order['bytes'] = order['wire_bytes'] = None
+            if hasattr(data, 'add_done_callback'):
+                data.add_done_callback(self.body_done)
+        instruments.after('request', order, instruments.clock() - started)
+        return response, data
+
+    def body_done(self, body):
+        self.order['bytes'] = body.bytes_decoded
+        self.order['wire_bytes'] = body.bytes_read
+        self.instruments.after('decompress', self.order, body.decompress_seconds)
+
+class MeteredConsumer(object):
+    """
+        Times a Consumer's `handle` for a single order; everything else is
+        passed straight through.
+    """
+    def __init__(self, consumer, instruments, order):
+        self.consumer = consumer
+        self.instruments = instruments
+        self.order = order
+
+    def handle(self, response, data):
+        return measure(self.instruments, 'consume', self.order, self.consumer.handle, response, data)
+
+    def __getattr__(self, name):
+        return getattr(self.consumer, name)
+
+def measure(instruments, stage, order, fn, *args, **kwargs):
+    instruments.before(stage, order)
+    started = instruments.clock()
+    try:
+        result = fn(*args, **kwargs)
+    except Exception as e:
+        instruments.after(stage, order, instruments.clock() - started, e)
+        raise
+    instruments.after(stage, order, instruments.clock() - started)
+    return result
+
+class Histogram(object):
+    """
+        Cumulative-bucket latency histogram, in seconds.
+    """
+    buckets = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        total, pairs = 0, []
+        for bound, count in zip(self.buckets + (float('inf'),), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+class Collector(Instruments):
+    """
+        Keeps latency histograms per stage and endpoint, and per endpoint the
+        orders served, bytes received, responses by status and errors --
+        exceptions, or statuses of 400 and up. `snapshot` hands it all back as
+        plain data; `prometheus` in the Prometheus text exposition format.
+    """
+    def __init__(self, clock=time.time):
+        self.clock = clock
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.endpoints = {}
+
+    def _endpoint(self, endpoint):
+        stats = self.endpoints.get(endpoint)
+        if stats is None:
+            stats = self.endpoints[endpoint] = {'orders':0, 'errors':0, 'bytes':0, 'wire_bytes':0, 'statuses':{}}
+        return stats
+
+    def after(self, stage, order, elapsed, error=None):
+        endpoint = order.get('endpoint')
+        self._lock.acquire()
+        try:
+            histogram = self.histograms.get((stage, endpoint))
+            if histogram is None:
+                histogram = self.histograms[(stage, endpoint)] = Histogram()
+            histogram.observe(elapsed)
+            if stage == 'request' and error is None:
+                stats = self._endpoint(endpoint)
+                stats['bytes'] += order.get('bytes') or 0
+                stats['wire_bytes'] += order.get('wire_bytes') or 0
+                stats['statuses'][order['status']] = stats['statuses'].get(order['status'], 0) + 1
+            elif stage == 'decompress':
+                stats = self._endpoint(endpoint)
+                stats['bytes'] += order['bytes']
+                stats['wire_bytes'] += order['wire_bytes']
+            elif stage == 'order':
+                stats = self._endpoint(endpoint)
+                stats['orders'] += 1
+                if error is not None or order.get('status', 0) >= 400:
+                    stats['errors'] += 1
+        finally:
+            self._lock.release()
+
+    def snapshot(self):
+        self._lock.acquire()
+        try:
+            endpoints = {}
+            for endpoint, stats in self.endpoints.items():
+                endpoints[endpoint] = dict(stats,
+                    statuses=dict(stats['statuses']),
+                    error_rate=float(stats['errors']) / stats['orders'] if stats['orders'] else 0.0)
+            latencies = {}
+            for (stage, endpoint), histogram in self.histograms.items():
+                latencies[(stage, endpoint)] = {
+                    'count':histogram.count,
+                    'sum':histogram.sum,
+                    'buckets':histogram.cumulative(),
+                }
+            return {'endpoints':endpoints, 'latencies':latencies}
+        finally:
+            self._lock.release()
+
+    def prometheus(self, prefix='waiter'):
+        snapshot = self.snapshot()
+        lines = [
+            '# HELP %s_stage_seconds Time spent in each stage of an order.' % prefix,
+            '# TYPE %s_stage_seconds histogram' % prefix,
+        ]
+        for (stage, endpoint), latency in sorted(snapshot['latencies'].items()):
+            labels = 'stage="%s",endpoint="%s"' % (stage, escape_label(endpoint))
+            for bound, count in latency['buckets']:
+                lines.append('%s_stage_seconds_bucket{%s,le="%s"} %d' % (prefix, labels, format_bound(bound), count))
+            lines.append('%s_stage_seconds_sum{%s} %r' % (prefix, labels, latency['sum']))
+            lines.append('%s_stage_seconds_count{%s} %d' % (prefix, labels, latency['count']))
+
+        endpoints = sorted(snapshot['endpoints'].items())
+        for name, key, help in (
+                ('orders_total', 'orders', 'Orders served.'),
+                ('errors_total', 'errors', 'Orders that raised or got a 4xx/5xx back.'),
+                ('response_bytes_total', 'bytes', 'Response body bytes received, once decoded.'),
+                ('wire_bytes_total', 'wire_bytes', 'Response body bytes received over the wire.')):
+            lines.append('# HELP %s_%s %s' % (prefix, name, help))
+            lines.append('# TYPE %s_%s counter' % (prefix, name))
+            for endpoint, stats in endpoints:
+                lines.append('%s_%s{endpoint="%s"} %d' % (prefix, name, escape_label(endpoint), stats[key]))
+
+        lines.append('# HELP %s_responses_total Responses received, by status.' % prefix)
+        lines.append('# TYPE %s_responses_total counter' % prefix)
+        for endpoint, stats in endpoints:
+            for status, count in sorted(stats['statuses'].items()):
+                lines.append('%s_responses_total{endpoint="%s",status="%s"} %d' % (prefix, escape_label(endpoint), status, count))
+        return '\n'.join(lines) + '\n'
+
+def escape_label(value):
+    if value is None:
+        return ''
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def format_bound(bound):
+    return '+Inf' if bound == float('inf') else repr(bound)
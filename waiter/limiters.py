@@ -0,0 +1,480 @@
+from waiter.transports import HttpWrapper
+from waiter.chefs import endpoint_of
+import collections
+import threading
+import heapq
+import math
+import time
+
+INTERACTIVE = 0
+BACKGROUND = 1
+
+class TokenBucket(object):
+    """
+        Holds up to `capacity` tokens, dripping back in at `rate` a second.
+        When the upstream tells us how many requests we've got left and when
+        its window resets, `sync` takes its word over our own arithmetic:
+        nothing drips back in until the reset, when the bucket fills up.
+    """
+    def __init__(self, rate, capacity, clock=time.time):
+        self.rate = float(rate)
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.resume_at = None
+        self._clock = clock
+        self._updated = clock()
+
+    def _refill(self, now):
+        if self.resume_at is not None:
+            if now < self.resume_at:
+                self._updated = now
+                return
+            self.tokens, self.resume_at = float(self.capacity), None
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def wait_time(self):
+        now = self._clock()
+        self._refill(now)
+        if self.tokens >= 1:
+            return 0
+        if self.resume_at is not None:
+            return self.resume_at - now
+        return (1 - self.tokens) / self.rate if self.rate else 0
+
+    def take(self):
+        self._refill(self._clock())
+        self.tokens -= 1
+
+    def sync(self, limit, remaining, reset_at=None):
+        now = self._clock()
+        self._refill(now)
+        if limit is not None:
+            self.capacity = limit
+        self.tokens = float(remaining)
+        self.resume_at = reset_at if reset_at is not None and reset_at > now else None
+
+class RateLimiter(object):
+    """
+        Holds orders back until both their credential's bucket and their
+        endpoint's bucket have a token to spare, rather than letting them go
+        out to be refused. Orders for the same credential go out strictly by
+        priority -- INTERACTIVE ahead of BACKGROUND -- and then first come,
+        first served.
+
+        `credential_limit` and each of `endpoint_limits` are (rate per second,
+        burst) pairs; endpoints without one are only held to their credential's.
+        Buckets are corrected from rate limit headers as responses come back;
+        `headers` are the prefixes of the credential's and the endpoint's
+        (either can be None, if the upstream doesn't send them).
+    """
+    def __init__(self, credential_limit=(150/3600.0, 150), endpoint_limits=None, clock=time.time, headers=('x-ratelimit-', 'x-rate-limit-')):
+        self.credential_limit = credential_limit
+        self.headers = headers
+        self.endpoint_limits = endpoint_limits if endpoint_limits else {}
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._buckets = {}
+        self._queues = {}
+        self._sequence = 0
+        self.queued = 0
+        self.max_queued = 0
+        self.delayed = 0
+        self.dispatched = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _bucket(self, key, limit):
+        bucket = self._buckets.get(key)
+        if bucket is None and limit is not None:
+            bucket = self._buckets[key] = TokenBucket(limit[0], limit[1], self._clock)
+        return bucket
+
+    def buckets_for(self, credential, endpoint):
+        buckets = [self._bucket(('credential', credential), self.credential_limit)]
+        endpoint_bucket = self._bucket(('endpoint', credential, endpoint), self.endpoint_limits.get(endpoint))
+        if endpoint_bucket is not None:
+            buckets.append(endpoint_bucket)
+        return [bucket for bucket in buckets if bucket is not None]
+
+    def acquire(self, credential, endpoint, priority=INTERACTIVE, deadline=None):
+        """
+            Wait for the order's turn and its tokens, and take them. With a
+            `deadline`, gives up -- without spending a token -- once it runs
+            out or is cancelled.
+        """
+        forget_abort = deadline.on_abort(self._wake) if deadline is not None else None
+        self._condition.acquire()
+        try:
+            self._sequence += 1
+            entry = (priority, self._sequence)
+            queue = self._queues.setdefault(credential, [])
+            heapq.heappush(queue, entry)
+            self.queued += 1
+            self.max_queued = max(self.max_queued, self.queued)
+            started = self._clock()
+            buckets = self.buckets_for(credential, endpoint)
+            held = False
+            try:
+                while True:
+                    if queue[0] == entry:
+                        waits = [bucket.wait_time() for bucket in buckets]
+                        wait = max(waits) if waits else 0
+                        if wait <= 0:
+                            break
+                    else:
+                        wait = None
+                    self._condition.wait(deadline.timeout(wait, 'waiting for its turn') if deadline is not None else wait)
+                    held = True
+            except Exception:
+                queue.remove(entry)
+                heapq.heapify(queue)
+                self.queued -= 1
+                self._condition.notifyAll()
+                raise
+            heapq.heappop(queue)
+            for bucket in buckets:
+                bucket.take()
+            waited = self._clock() - started
+            self.queued -= 1
+            self.dispatched += 1
+            if held:
+                self.delayed += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+            if forget_abort is not None:
+                forget_abort()
+
+    def _wake(self):
+        self._condition.acquire()
+        try:
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def update(self, credential, endpoint, response):
+        """
+            Sync buckets from rate limit headers: X-RateLimit-* describes the
+            credential's overall limit, X-Rate-Limit-* the endpoint's, unless
+            `headers` says otherwise.
+        """
+        credential_prefix, endpoint_prefix = self.headers
+        for prefix, key, limit in (
+                (credential_prefix, ('credential', credential), self.credential_limit),
+                (endpoint_prefix, ('endpoint', credential, endpoint), self.endpoint_limits.get(endpoint, (0, 0)))):
+            if prefix is None:
+                continue
+            remaining = response.get(prefix + 'remaining')
+            if remaining is None:
+                continue
+            reset, maximum = response.get(prefix + 'reset'), response.get(prefix + 'limit')
+            self._condition.acquire()
+            try:
+                self._bucket(key, limit).sync(
+                    int(maximum) if maximum is not None else None,
+                    int(remaining),
+                    float(reset) if reset is not None else None)
+                self._condition.notifyAll()
+            finally:
+                self._condition.release()
+
+    def sync_status(self, credential, status):
+        """
+            Sync a credential's bucket from a parsed account/rate_limit_status.
+        """
+        self._condition.acquire()
+        try:
+            self._bucket(('credential', credential), self.credential_limit).sync(
+                status.get('hourly_limit'), status['remaining_hits'], status.get('reset_time_in_seconds'))
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def stats(self):
+        self._condition.acquire()
+        try:
+            return {
+                'queued':self.queued,
+                'max_queued':self.max_queued,
+                'dispatched':self.dispatched,
+                'delayed':self.delayed,
+                'total_wait':self.total_wait,
+                'max_wait':self.max_wait,
+                'mean_wait':self.total_wait / self.delayed if self.delayed else 0.0,
+            }
+        finally:
+            self._condition.release()
+
+class RateLimitedHttp(HttpWrapper):
+    """
+        Wraps an http so that every request waits its turn with a RateLimiter
+        first. Give interactive and background Waiters their own wrappers
+        around the same limiter, with the appropriate `priority`. Responses the
+        upstream refuses for being over the limit are queued up and sent again,
+        up to `requeues` times. Orders wait their turn no longer than their
+        deadline allows.
+    """
+    limited_statuses = (420, 429)
+    takes_deadlines = True
+
+    def __init__(self, http, limiter, credential=None, priority=INTERACTIVE, requeues=1):
+        super(RateLimitedHttp, self).__init__(http)
+        self.limiter = limiter
+        if credential is None:
+            credential = getattr(getattr(http, 'token', None), 'key', 'anonymous')
+        self.credential = credential
+        self.priority = priority
+        self.requeues = requeues
+
+    def request(self, uri, **kwargs):
+        endpoint = endpoint_of(uri)
+        requeues = self.requeues
+        deadline = kwargs.get('deadline')
+        if deadline is not None and not getattr(self.http, 'takes_deadlines', False):
+            del kwargs['deadline']
+        while True:
+            self.limiter.acquire(self.credential, endpoint, self.priority, deadline)
+            response, data = self.http.request(uri=uri, **kwargs)
+            self.limiter.update(self.credential, endpoint, response)
+            if requeues and self.is_limited(response):
+                requeues -= 1
+                if hasattr(data, 'close'):
+                    data.close()
+                continue
+            return response, data
+
+    def is_limited(self, response):
+        if response.status in self.limited_statuses:
+            return True
+        return response.status == 400 and response.get('x-ratelimit-remaining') == '0'
+
+class AdaptiveLimit(object):
+    """
+        How many orders may be in flight at once, worked out from how they
+        come back rather than fixed up front. Orders `acquire` a slot before
+        they go out (waiting while all `limit` are taken) and `release` it
+        with whether they were dropped -- a 5xx, or an exception; the time
+        they took and that go to `update`, which subclasses fill in.
+
+        The limit stays between `minimum` and `maximum`, and only grows while
+        at least half of it is in use. Every change is kept in `history`, as
+        (time, old limit, new limit, why), for the last `remember` changes.
+    """
+    def __init__(self, initial=8, minimum=1, maximum=200, remember=100, clock=time.time):
+        self.minimum = minimum
+        self.maximum = maximum
+        self._estimate = float(initial)
+        self.limit = int(initial)
+        self._clock = clock
+        self._condition = threading.Condition()
+        self.history = collections.deque(maxlen=remember)
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.samples = 0
+        self.dropped = 0
+        self.waits = 0
+        self.increases = 0
+        self.decreases = 0
+        self.min_rtt = None
+        self.rtt = None
+
+    def acquire(self, deadline=None):
+        """
+            Wait for a slot, and take it; hands back when it was taken, for
+            `release`. Gives up with the `deadline` when it runs out or is
+            cancelled.
+        """
+        forget_abort = deadline.on_abort(self._wake) if deadline is not None else None
+        self._condition.acquire()
+        try:
+            if self.in_flight >= self.limit:
+                self.waits += 1
+            while self.in_flight >= self.limit:
+                self._condition.wait(deadline.timeout(None, 'waiting for a slot') if deadline is not None else None)
+            self.in_flight += 1
+            self.max_in_flight = max(self.max_in_flight, self.in_flight)
+            return self._clock()
+        finally:
+            self._condition.release()
+            if forget_abort is not None:
+                forget_abort()
+
+    def _wake(self):
+        self._condition.acquire()
+        try:
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def release(self, started, dropped=False):
+        self._condition.acquire()
+        try:
+            rtt = self._clock() - started
+            in_flight, self.in_flight = self.in_flight, self.in_flight - 1
+            self.sample(rtt, dropped, in_flight)
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def sample(self, rtt, dropped=False, in_flight=None):
+        """
+            Fold one order's round trip into the limit; call with the lock
+            held, or from a single thread.
+        """
+        in_flight = in_flight if in_flight is not None else self.in_flight
+        self.samples += 1
+        if dropped:
+            self.dropped += 1
+        else:
+            self.min_rtt = rtt if self.min_rtt is None else min(self.min_rtt, rtt)
+            self.rtt = rtt if self.rtt is None else self.rtt * 0.9 + rtt * 0.1
+        estimate, reason = self.update(self._estimate, rtt, dropped)
+        if estimate > self._estimate and in_flight * 2 < self.limit:
+            return
+        self._estimate = max(self.minimum, min(self.maximum, estimate))
+        limit = int(self._estimate)
+        if limit != self.limit:
+            if limit > self.limit:
+                self.increases += 1
+            else:
+                self.decreases += 1
+            self.history.append((self._clock(), self.limit, limit, reason))
+            self.limit = limit
+
+    def update(self, estimate, rtt, dropped):
+        """
+            The new (fractional) limit and why, given the current one and an
+            order's round trip.
+        """
+        return estimate, None
+
+    def stats(self):
+        self._condition.acquire()
+        try:
+            return {
+                'limit':self.limit,
+                'in_flight':self.in_flight,
+                'max_in_flight':self.max_in_flight,
+                'samples':self.samples,
+                'dropped':self.dropped,
+                'waits':self.waits,
+                'increases':self.increases,
+                'decreases':self.decreases,
+                'min_rtt':self.min_rtt,
+                'rtt':self.rtt,
+                'history':list(self.history),
+            }
+        finally:
+            self._condition.release()
+
+    def prometheus(self, prefix='waiter'):
+        stats = self.stats()
+        return '\n'.join([
+            '# HELP %s_concurrency_limit Orders allowed in flight at once.' % prefix,
+            '# TYPE %s_concurrency_limit gauge' % prefix,
+            '%s_concurrency_limit %d' % (prefix, stats['limit']),
+            '# HELP %s_in_flight Orders in flight.' % prefix,
+            '# TYPE %s_in_flight gauge' % prefix,
+            '%s_in_flight %d' % (prefix, stats['in_flight']),
+            '# HELP %s_concurrency_limit_changes_total Times the limit was moved, by direction.' % prefix,
+            '# TYPE %s_concurrency_limit_changes_total counter' % prefix,
+            '%s_concurrency_limit_changes_total{direction="up"} %d' % (prefix, stats['increases']),
+            '%s_concurrency_limit_changes_total{direction="down"} %d' % (prefix, stats['decreases']),
+        ]) + '\n'
+
+class AIMDLimit(AdaptiveLimit):
+    """
+        Additive increase, multiplicative decrease: one more slot for every
+        `limit` orders that come back in good time, and the limit cut by
+        `backoff` when one's dropped or takes more than `tolerance` times the
+        quickest round trip seen. It's cut at most once per round trip, so
+        a burst of failures only counts once.
+    """
+    def __init__(self, initial=8, backoff=0.9, tolerance=2.0, **kwargs):
+        super(AIMDLimit, self).__init__(initial, **kwargs)
+        self.backoff = backoff
+        self.tolerance = tolerance
+        self._cut_at = None
+        self._good = 0
+
+    def update(self, estimate, rtt, dropped):
+        slow = not dropped and self.min_rtt is not None and self.rtt > self.min_rtt * self.tolerance
+        if dropped or slow:
+            now = self._clock()
+            if self._cut_at is not None and now - self._cut_at < (self.rtt or 0):
+                return estimate, None
+            self._cut_at, self._good = now, 0
+            return estimate * self.backoff, 'dropped' if dropped else 'latency'
+        self._good += 1
+        if self._good < estimate:
+            return estimate, None
+        self._good = 0
+        return estimate + 1, 'headroom'
+
+class VegasLimit(AdaptiveLimit):
+    """
+        Like TCP Vegas, estimates how many orders are queued up at the other
+        end from how much slower they're coming back than the quickest round
+        trip seen -- `limit * (1 - min_rtt / rtt)` -- and grows the limit while
+        that's below `alpha`, shrinks it above `beta` (both scaled by log10 of
+        the limit). A drop cuts it by `backoff`. The quickest round trip is
+        forgotten every `probe` orders, in case the upstream's got slower.
+    """
+    def __init__(self, initial=8, alpha=3, beta=6, backoff=0.9, smoothing=1.0, probe=1000, **kwargs):
+        super(VegasLimit, self).__init__(initial, **kwargs)
+        self.alpha = alpha
+        self.beta = beta
+        self.backoff = backoff
+        self.smoothing = smoothing
+        self.probe = probe
+
+    def update(self, estimate, rtt, dropped):
+        if dropped:
+            return estimate * self.backoff, 'dropped'
+        if self.probe and self.samples % self.probe == 0:
+            self.min_rtt = rtt
+        scale = max(1.0, math.log10(estimate))
+        queued = estimate * (1 - self.min_rtt / self.rtt) if self.rtt else 0
+        if queued <= scale:
+            target, reason = estimate + self.beta * scale, 'headroom'
+        elif queued < self.alpha * scale:
+            target, reason = estimate + scale, 'headroom'
+        elif queued > self.beta * scale:
+            target, reason = estimate - scale, 'queueing'
+        else:
+            return estimate, None
+        return (1 - self.smoothing) * estimate + self.smoothing * target, reason
+
+class AdaptiveHttp(HttpWrapper):
+    """
+        Holds an http's requests to an AdaptiveLimit: each waits for a slot
+        and gives it back when its response is in -- or, for a streamed body,
+        once that's been read, closed or dropped -- counting 5xx responses
+        and exceptions as drops. Every way of sending orders goes through the http, so one
+        wrapper covers `__call__`, `fan_out`, an AsyncWaiter's brigade and a
+        WriteQueue alike; give fan_out a `concurrency` of the limit's
+        `maximum` and let the limit decide how many actually go out.
+    """
+    def __init__(self, http, limit=None):
+        super(AdaptiveHttp, self).__init__(http)
+        self.limit = limit if limit is not None else VegasLimit()
+
+    def request(self, uri, **kwargs):
+        started = self.limit.acquire(kwargs.get('deadline'))
+        try:
+            response, data = self.http.request(uri=uri, **kwargs)
+        except Exception:
+            self.limit.release(started, True)
+            raise
+        dropped = response.status >= 500
+        if hasattr(data, 'add_done_callback'):
+            data.add_done_callback(lambda body: self.limit.release(started, dropped))
+        else:
+            self.limit.release(started, dropped)
+        return response, data
+
+    def stats(self):
+        return self.limit.stats()
@@ -0,0 +1,387 @@
+"""
+    HTTP/2 for waiter. A MultiplexedHttp carries every order in flight to a
+    host over one connection, each as a stream of its own, rather than
+    tying up a connection per order -- so a wide fan-out to one API needs
+    one socket (and one TLS handshake) instead of thirty-two. It needs the
+    h2 package, and raises ImportError without it.
+"""
+from waiter.compression import accept_encoding, decompressor_for
+import threading
+import httplib2
+import httplib
+import socket
+import ssl
+
+def _h2():
+    import h2.config
+    import h2.connection
+    import h2.events
+    import h2.errors
+    import h2.exceptions
+    import h2.settings
+    return h2
+
+class Stream(object):
+    """
+        One request's share of a connection: the response headers and body
+        as they come in, and an Event set once it's over, one way or another.
+    """
+    def __init__(self):
+        self.headers = None
+        self.chunks = []
+        self.error = None
+        self.done = threading.Event()
+
+    def fail(self, error):
+        if not self.done.is_set():
+            self.error = error
+            self.done.set()
+
+class Http2Connection(object):
+    """
+        A single HTTP/2 connection and the thread that reads it. Any number
+        of threads can `request` on it at once, up to what the server allows
+        in MAX_CONCURRENT_STREAMS; frames go out under one lock, and the
+        reader hands each stream its headers and data as they arrive.
+        `settings` are the SETTINGS we send, and `window` is added to the
+        connection's receive window up front. No stream is opened until the
+        server's SETTINGS are in, so its limits are known from the first.
+
+        Plain http is spoken with prior knowledge (h2c), https over TLS,
+        negotiated with ALPN.
+    """
+    def __init__(self, scheme, authority, timeout=None, settings=None, window=None):
+        h2 = _h2()
+        self._h2 = h2
+        self.authority = authority
+        host, port = authority, 443 if scheme == 'https' else 80
+        if ':' in authority:
+            host, port = authority.rsplit(':', 1)
+            port = int(port)
+        sock = socket.create_connection((host, port), timeout)
+        if scheme == 'https':
+            context = ssl.create_default_context()
+            context.set_alpn_protocols(['h2'])
+            sock = context.wrap_socket(sock, server_hostname=host)
+            if sock.selected_alpn_protocol() != 'h2':
+                sock.close()
+                raise MultiplexedHttp.NotSupported("%s won't speak HTTP/2" % authority)
+        sock.settimeout(None)
+        self._sock = sock
+        self._condition = threading.Condition()
+        self._streams = {}
+        self.closed = False
+        self.streams = 0
+        self._settled = threading.Event()
+        self._conn = h2.connection.H2Connection(h2.config.H2Configuration(client_side=True, header_encoding=None))
+        self._conn.initiate_connection()
+        if settings:
+            self._conn.update_settings(settings)
+        if window:
+            self._conn.increment_flow_control_window(window)
+        self._flush()
+        self._reader = threading.Thread(target=self._read)
+        self._reader.setDaemon(True)
+        self._reader.start()
+        if not self._settled.wait(timeout):
+            self.close(socket.timeout("%s never sent its SETTINGS" % authority))
+        if self.closed:
+            raise socket.error("Couldn't speak HTTP/2 with %s" % authority)
+
+    def has_room(self):
+        self._condition.acquire()
+        try:
+            return not self.closed and len(self._streams) < self._conn.remote_settings.max_concurrent_streams
+        finally:
+            self._condition.release()
+
+    def in_flight(self):
+        return len(self._streams)
+
+    def _flush(self):
+        data = self._conn.data_to_send()
+        if data:
+            self._sock.sendall(data)
+
+    def open(self, headers, end_stream, weight=None):
+        """
+            Start a stream with `headers`, handing back its id and Stream --
+            or None, if the connection's already carrying all it's allowed.
+        """
+        stream = Stream()
+        self._condition.acquire()
+        try:
+            if self.closed:
+                raise socket.error("Connection to %s is closed" % self.authority)
+            if self._conn.open_outbound_streams >= self._conn.remote_settings.max_concurrent_streams:
+                return None
+            stream_id = self._conn.get_next_available_stream_id()
+            self._streams[stream_id] = stream
+            self.streams += 1
+            self._conn.send_headers(stream_id, headers, end_stream=end_stream, priority_weight=weight)
+            self._flush()
+        finally:
+            self._condition.release()
+        return stream_id, stream
+
+    def send(self, stream_id, stream, chunks):
+        """
+            Send a body a frame at a time, waiting on the server's WINDOW_UPDATEs
+            whenever its flow-control window is used up.
+        """
+        for chunk in chunks:
+            chunk = str(chunk)
+            while chunk:
+                self._condition.acquire()
+                try:
+                    if stream.done.is_set():
+                        return
+                    window = min(self._conn.local_flow_control_window(stream_id), self._conn.max_outbound_frame_size)
+                    if window <= 0:
+                        self._condition.wait()
+                        continue
+                    self._conn.send_data(stream_id, chunk[:window])
+                    self._flush()
+                    chunk = chunk[window:]
+                finally:
+                    self._condition.release()
+        self._condition.acquire()
+        try:
+            if not stream.done.is_set():
+                self._conn.end_stream(stream_id)
+                self._flush()
+        finally:
+            self._condition.release()
+
+    def cancel(self, stream_id, error):
+        self._condition.acquire()
+        try:
+            stream = self._streams.pop(stream_id, None)
+            if stream is None:
+                return
+            stream.fail(error)
+            if not self.closed:
+                try:
+                    self._conn.reset_stream(stream_id, self._h2.errors.ErrorCodes.CANCEL)
+                    self._flush()
+                except (self._h2.exceptions.StreamClosedError, socket.error):
+                    pass
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+
+    def _read(self):
+        try:
+            while True:
+                data = self._sock.recv(65535)
+                if not data:
+                    raise socket.error("%s closed the connection" % self.authority)
+                self._condition.acquire()
+                try:
+                    for event in self._conn.receive_data(data):
+                        self._handle(event)
+                    self._flush()
+                    self._condition.notifyAll()
+                finally:
+                    self._condition.release()
+        except Exception as e:
+            self.close(e if isinstance(e, socket.error) else socket.error(str(e)))
+
+    def _handle(self, event):
+        events = self._h2.events
+        stream = self._streams.get(getattr(event, 'stream_id', None))
+        if isinstance(event, events.RemoteSettingsChanged):
+            self._settled.set()
+        elif isinstance(event, events.ResponseReceived) and stream is not None:
+            stream.headers = event.headers
+        elif isinstance(event, events.DataReceived):
+            if stream is not None:
+                stream.chunks.append(event.data)
+            if event.flow_controlled_length:
+                try:
+                    self._conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                except self._h2.exceptions.StreamClosedError:
+                    pass
+        elif isinstance(event, events.StreamEnded) and stream is not None:
+            del self._streams[event.stream_id]
+            stream.done.set()
+        elif isinstance(event, events.StreamReset) and stream is not None:
+            del self._streams[event.stream_id]
+            stream.fail(MultiplexedHttp.Reset("%s reset the stream (error %s)" % (self.authority, event.error_code)))
+        elif isinstance(event, events.ConnectionTerminated):
+            raise socket.error("%s went away (error %s)" % (self.authority, event.error_code))
+
+    def close(self, error=None):
+        self._condition.acquire()
+        try:
+            if self.closed:
+                return
+            self.closed = True
+            streams, self._streams = self._streams, {}
+            for stream in streams.values():
+                stream.fail(error or socket.error("Connection to %s was closed" % self.authority))
+            self._condition.notifyAll()
+        finally:
+            self._condition.release()
+        self._settled.set()
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except socket.error:
+            pass
+        self._sock.close()
+
+class MultiplexedHttp(object):
+    """
+        An http object that speaks HTTP/2, sharing a connection per host
+        between every thread that uses it -- another is only opened once a
+        connection has as many streams open as the server allows.
+
+        Streams go out with priority `weight` (1-256), or the weight in
+        `weights` for their endpoint ('statuses/update', say), so the server
+        knows what to get to first when they're all waiting. `window` is the
+        flow-control window to give each stream (and the connection) for
+        response bodies, `max_frame_size` the largest frame we'll take, and
+        `max_concurrent_streams` how many pushed streams we'd take (waiter
+        doesn't want any). Requests take deadlines: a stream that runs out
+        of time, or is cancelled, is reset on its own, and the connection
+        carries on.
+    """
+    thread_safe = True
+    takes_deadlines = True
+
+    class Reset(httplib.HTTPException):
+        pass
+
+    class NotSupported(httplib.HTTPException):
+        pass
+
+    def __init__(self, timeout=None, weight=16, weights=None, window=1024*1024, max_frame_size=None, max_concurrent_streams=0, decompress=True):
+        h2 = _h2()
+        self.timeout = timeout
+        self.weight = weight
+        self.weights = dict(weights or {})
+        self.window = window
+        self.decompress = decompress
+        self.settings = {h2.settings.SettingCodes.ENABLE_PUSH:0}
+        if window:
+            self.settings[h2.settings.SettingCodes.INITIAL_WINDOW_SIZE] = window
+        if max_frame_size:
+            self.settings[h2.settings.SettingCodes.MAX_FRAME_SIZE] = max_frame_size
+        if max_concurrent_streams is not None:
+            self.settings[h2.settings.SettingCodes.MAX_CONCURRENT_STREAMS] = max_concurrent_streams
+        self._lock = threading.Lock()
+        self._connections = {}
+        self._opening = {}
+        self.opened = 0
+
+    def _connection(self, scheme, authority, timeout):
+        key = scheme + ':' + authority
+        self._lock.acquire()
+        try:
+            opening = self._opening.setdefault(key, threading.Lock())
+        finally:
+            self._lock.release()
+        opening.acquire()
+        try:
+            self._lock.acquire()
+            try:
+                connections = self._connections.setdefault(key, [])
+                connections[:] = [conn for conn in connections if not conn.closed]
+                for conn in connections:
+                    if conn.has_room():
+                        return conn
+            finally:
+                self._lock.release()
+            conn = Http2Connection(scheme, authority, timeout, self.settings, max(0, (self.window or 0) - 65535))
+            self._lock.acquire()
+            try:
+                self._connections.setdefault(key, []).append(conn)
+                self.opened += 1
+            finally:
+                self._lock.release()
+            return conn
+        finally:
+            opening.release()
+
+    def weight_for(self, request_uri):
+        path = request_uri.split('?', 1)[0].strip('/')
+        for endpoint, weight in self.weights.items():
+            if path == endpoint or path.startswith(endpoint + '.'):
+                return weight
+        return self.weight
+
+    def request(self, uri, method='GET', body=None, headers=None, deadline=None):
+        scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(httplib2.iri2uri(uri))
+        timeout = deadline.timeout(self.timeout) if deadline is not None else self.timeout
+
+        headers = dict((name.lower(), value) for name, value in (headers or {}).items())
+        if hasattr(body, 'chunks'):
+            headers.update(body.headers())
+        headers.pop('transfer-encoding', None)
+        headers.pop('connection', None)
+        headers.pop('host', None)
+        if self.decompress and 'accept-encoding' not in headers:
+            headers['accept-encoding'] = accept_encoding()
+        if isinstance(body, str) and 'content-length' not in headers:
+            headers['content-length'] = str(len(body))
+        pseudo = [(':method', method), (':scheme', scheme), (':authority', authority), (':path', request_uri)]
+
+        opened = None
+        while opened is None:
+            conn = self._connection(scheme, authority, timeout)
+            opened = conn.open(pseudo + headers.items(), body is None, self.weight_for(request_uri))
+        stream_id, stream = opened
+        forget_abort = None
+        if deadline is not None:
+            forget_abort = deadline.on_abort(lambda: conn.cancel(stream_id, socket.error("Order was stopped")))
+        try:
+            if body is not None:
+                conn.send(stream_id, stream, body.chunks() if hasattr(body, 'chunks') else [body])
+            wait = deadline.timeout(self.timeout, 'waiting on %s' % authority) if deadline is not None else self.timeout
+            if not stream.done.wait(wait):
+                conn.cancel(stream_id, socket.timeout("Timed out waiting on %s" % authority))
+        finally:
+            if forget_abort is not None:
+                forget_abort()
+        if stream.error is not None:
+            if deadline is not None and deadline.stopped():
+                deadline.check('waiting on %s' % authority)
+            raise stream.error
+        return self._response(stream)
+
+    def _response(self, stream):
+        info = {}
+        for name, value in stream.headers or []:
+            if name == ':status':
+                info['status'] = value
+            elif not name.startswith(':'):
+                info[name] = info[name] + ', ' + value if name in info else value
+        data = ''.join(stream.chunks)
+        decompressor = decompressor_for(info.get('content-encoding')) if self.decompress else None
+        if decompressor is not None:
+            data = decompressor.decompress(data) + decompressor.flush()
+            info['-content-encoding'] = info.pop('content-encoding')
+        return httplib2.Response(info), data
+
+    def close(self):
+        self._lock.acquire()
+        try:
+            connections, self._connections = self._connections, {}
+        finally:
+            self._lock.release()
+        for conns in connections.values():
+            for conn in conns:
+                conn.close()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            connections = [conn for conns in self._connections.values() for conn in conns if not conn.closed]
+            return {
+                'opened':self.opened,
+                'connections':len(connections),
+                'streams':sum(conn.streams for conn in connections),
+                'in_flight':sum(conn.in_flight() for conn in connections),
+            }
+        finally:
+            self._lock.release()
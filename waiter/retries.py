@@ -0,0 +1,206 @@
+from waiter.transports import HttpWrapper
+from waiter.chefs import endpoint_of
+import email.utils
+import threading
+import urlparse
+import httplib2
+import httplib
+import random
+import socket
+import time
+
+class CircuitBreaker(object):
+    """
+        Counts consecutive failures talking to one host. After `threshold` of
+        them the circuit opens, and orders fail fast with CircuitBreaker.Open
+        for `cooldown` seconds. Then a single trial order is let through: if
+        it comes back fine the circuit closes again, otherwise it reopens.
+    """
+    class Open(Exception):
+        pass
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, host, threshold=5, cooldown=30, clock=time.time):
+        self.host = host
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self._clock = clock
+        self._lock = threading.Lock()
+        self.state = CircuitBreaker.CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.rejected = 0
+
+    def before(self):
+        self._lock.acquire()
+        try:
+            if self.state == CircuitBreaker.CLOSED:
+                return
+            if self.state == CircuitBreaker.OPEN and self._clock() - self.opened_at >= self.cooldown:
+                self.state = CircuitBreaker.HALF_OPEN
+                return
+            self.rejected += 1
+        finally:
+            self._lock.release()
+        raise CircuitBreaker.Open("Circuit to %s is open -- not sending any orders for now" % self.host)
+
+    def succeeded(self):
+        self._lock.acquire()
+        try:
+            self.state, self.failures, self.opened_at = CircuitBreaker.CLOSED, 0, None
+        finally:
+            self._lock.release()
+
+    def abandoned(self):
+        """
+            An order that ended without telling us anything about the host --
+            it was cancelled, say. If it was the trial, the next order gets to
+            be one instead.
+        """
+        self._lock.acquire()
+        try:
+            if self.state == CircuitBreaker.HALF_OPEN:
+                self.state = CircuitBreaker.OPEN
+        finally:
+            self._lock.release()
+
+    def failed(self):
+        self._lock.acquire()
+        try:
+            self.failures += 1
+            if self.state == CircuitBreaker.HALF_OPEN or self.failures >= self.threshold:
+                self.state, self.opened_at = CircuitBreaker.OPEN, self._clock()
+        finally:
+            self._lock.release()
+
+class RetryPolicy(object):
+    """
+        Decides which orders get sent again, and how long to wait in between:
+        exponential backoff from `backoff` seconds up to `max_backoff`, with
+        full jitter, unless the response says Retry-After -- and if that's
+        longer than `max_backoff`, the order isn't retried at all. No order is
+        tried more than `attempts` times, or retried past `deadline` seconds
+        after it first went out.
+
+        Only orders that are safe to repeat are retried: those using one of
+        `methods`, or going to one of `idempotent_endpoints` (say, a POST to
+        'favorites/create'). Keeps a CircuitBreaker per host.
+    """
+    retry_statuses = (500, 502, 503, 504)
+    retry_exceptions = (socket.error, httplib.HTTPException, httplib2.HttpLib2Error)
+
+    def __init__(self, attempts=3, backoff=0.5, max_backoff=30, deadline=60,
+            methods=('GET', 'HEAD', 'PUT', 'DELETE', 'OPTIONS'), idempotent_endpoints=(),
+            breaker_threshold=5, breaker_cooldown=30, clock=time.time, sleep=time.sleep, jitter=random.random):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.methods = methods
+        self.idempotent_endpoints = idempotent_endpoints
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.clock = clock
+        self.sleep = sleep
+        self.jitter = jitter
+        self._breakers = {}
+        self._lock = threading.Lock()
+        self.retries = 0
+
+    def breaker_for(self, host):
+        self._lock.acquire()
+        try:
+            breaker = self._breakers.get(host)
+            if breaker is None:
+                breaker = self._breakers[host] = CircuitBreaker(host, self.breaker_threshold, self.breaker_cooldown, self.clock)
+            return breaker
+        finally:
+            self._lock.release()
+
+    def retries_order(self, method, uri):
+        return method in self.methods or endpoint_of(uri) in self.idempotent_endpoints
+
+    def delay_for(self, attempt, response=None):
+        retry_after = retry_after_seconds(response, self.clock) if response is not None else None
+        if retry_after is not None:
+            return retry_after
+        return self.jitter() * min(self.max_backoff, self.backoff * (2 ** attempt))
+
+    def allows(self, attempt, started, delay):
+        if attempt + 1 >= self.attempts or delay > self.max_backoff:
+            return False
+        if self.deadline is not None and self.clock() + delay - started > self.deadline:
+            return False
+        return True
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            breakers = list(self._breakers.values())
+        finally:
+            self._lock.release()
+        return {
+            'retries':self.retries,
+            'open':sorted(b.host for b in breakers if b.state != CircuitBreaker.CLOSED),
+            'rejected':sum(b.rejected for b in breakers),
+        }
+
+def retry_after_seconds(response, clock=time.time):
+    value = response.get('retry-after')
+    if not value:
+        return None
+    try:
+        return max(0, int(value))
+    except ValueError:
+        parsed = email.utils.parsedate_tz(value)
+        return max(0, email.utils.mktime_tz(parsed) - clock()) if parsed else None
+
+def outlasts(deadline, delay):
+    remaining = deadline.remaining() if deadline is not None else None
+    return remaining is not None and remaining <= delay
+
+class RetryingHttp(HttpWrapper):
+    """
+        Wraps an http so transient failures -- connection errors and 5xx
+        responses -- are retried according to a RetryPolicy. Once the policy
+        gives up, the last response goes on to the Consumer as usual (or the
+        last exception is raised), so a TwitterConsumer still complains. It
+        also gives up rather than wait out a backoff its order's deadline
+        won't see the end of.
+    """
+    def __init__(self, http, policy=None):
+        super(RetryingHttp, self).__init__(http)
+        self.policy = policy if policy else RetryPolicy()
+
+    def request(self, uri, **kwargs):
+        policy = self.policy
+        breaker = policy.breaker_for(urlparse.urlparse(uri)[1])
+        retries = policy.retries_order(kwargs.get('method', 'GET'), uri)
+        deadline = kwargs.get('deadline')
+        started, attempt = policy.clock(), 0
+        while True:
+            breaker.before()
+            try:
+                response, data = self.http.request(uri=uri, **kwargs)
+            except policy.retry_exceptions:
+                breaker.failed()
+                delay = policy.delay_for(attempt)
+                if not retries or not policy.allows(attempt, started, delay) or outlasts(deadline, delay):
+                    raise
+            except BaseException:
+                breaker.abandoned()
+                raise
+            else:
+                if response.status not in policy.retry_statuses:
+                    breaker.succeeded()
+                    return response, data
+                breaker.failed()
+                delay = policy.delay_for(attempt, response)
+                if not retries or not policy.allows(attempt, started, delay) or outlasts(deadline, delay):
+                    return response, data
+                if hasattr(data, 'close'):
+                    data.close()
+            policy.retries += 1
+            policy.sleep(delay)
+            attempt += 1
@@ -0,0 +1,218 @@
+"""
+    Clients from a declarative spec, rather than a hand-written Menu,
+    Consumer and Chef. A spec is a dict, or a JSON file holding one:
+
+        {
+            "name": "Example",
+            "domain": "https://api.example.com",
+            "endpoints": {"users/show": "GET", "users/:id/posts": "GET", "posts": "POST"},
+            "pagination": {"style": "cursor", "param": "cursor", "start": -1,
+                           "next": "next_cursor", "items": ["users", "posts"]},
+            "rate_limit": {"requests": 150, "per": 3600,
+                           "credential": "x-ratelimit-", "endpoint": "x-rate-limit-"},
+            "errors": {"statuses": [404, 500, 503], "key": "error"}
+        }
+
+    `endpoints` can be a recipe string, too. `compile_spec` turns a spec
+    into a CompiledSpec, with its routes compiled up front, and its
+    `client()` is a Waiter subclass for the API. CompiledSpecs pickle, so
+    `load_client` keeps one beside the spec and only reads and compiles the
+    spec again when it changes.
+"""
+from waiter import Waiter, JSONConsumer
+from waiter.chefs import LaxRecipeChef, RecipeRouter
+from waiter.limiters import RateLimiter
+import hashlib
+import cPickle
+import json
+import os
+
+ARTIFACT_VERSION = 1
+
+class SpecConsumer(JSONConsumer):
+    """
+        Raises on the error statuses and error key a spec lists -- with its
+        `exception`, if it names one -- and follows its cursor from page to
+        page.
+    """
+    class Error(Exception):
+        pass
+
+    def __init__(self, spec, decoder=None):
+        super(SpecConsumer, self).__init__(decoder)
+        self.spec = spec
+
+    def error(self, message):
+        return self.spec.exception()(message)
+
+    def handle(self, response, data):
+        errors = self.spec.errors
+        if response.status in errors.get('statuses', ()):
+            raise self.error("Got a bad response - %d" % response.status)
+        parsed = super(SpecConsumer, self).handle(response, data)
+        key = errors.get('key')
+        if key and isinstance(parsed, dict) and key in parsed:
+            raise self.error("Bad request - %s" % parsed[key])
+        return parsed
+
+    def first_page(self, params):
+        pagination = self.spec.pagination
+        if pagination is not None and pagination['start'] is not None:
+            params.setdefault(pagination['param'], pagination['start'])
+        return params
+
+    def next_page(self, parsed_data):
+        pagination = self.spec.pagination
+        if pagination is None or isinstance(parsed_data, list):
+            return parsed_data, None
+        for key in pagination.get('items', ()):
+            if key in parsed_data:
+                items = parsed_data[key]
+                break
+        else:
+            items = []
+        next_cursor = parsed_data.get(pagination['next'])
+        return items, {pagination['param']:next_cursor} if next_cursor else None
+
+class CompiledSpec(object):
+    """
+        Everything a client needs from its spec, worked out once: the recipe,
+        a compiled RecipeRouter, and the pagination, rate limit and error
+        settings, checked.
+    """
+    class Invalid(ValueError):
+        pass
+
+    def __init__(self, name, domain, endpoints, pagination=None, rate_limit=None, errors=None, digest=None):
+        self.name = name
+        self.domain = domain
+        self.endpoints = endpoints
+        self.router = RecipeRouter(domain, endpoints).compile()
+        self.pagination = pagination
+        self.rate_limit = rate_limit
+        self.errors = errors if errors else {}
+        self.digest = digest
+        self._exception = None
+
+    def exception(self):
+        if self._exception is None:
+            path = self.errors.get('exception')
+            if path:
+                module, name = str(path).rsplit('.', 1)
+                self._exception = getattr(__import__(module, fromlist=[name]), name)
+            else:
+                self._exception = SpecConsumer.Error
+        return self._exception
+
+    def chef(self):
+        return LaxRecipeChef(self.domain, self.endpoints, self.router)
+
+    def consumer(self, decoder=None):
+        return SpecConsumer(self, decoder)
+
+    def limiter(self, **kwargs):
+        """
+            A RateLimiter held to the spec's limit, and synced from its headers.
+        """
+        rate_limit = self.rate_limit or {}
+        if 'requests' in rate_limit:
+            kwargs.setdefault('credential_limit', (float(rate_limit['requests']) / rate_limit.get('per', 1), rate_limit['requests']))
+        kwargs.setdefault('headers', (rate_limit.get('credential', 'x-ratelimit-'), rate_limit.get('endpoint', 'x-rate-limit-')))
+        return RateLimiter(**kwargs)
+
+    def client(self):
+        """
+            A Waiter subclass that cooks with this spec's chef and hands
+            responses to its consumer, unless it's given others.
+        """
+        spec = self
+        def __init__(self, *args, **kwargs):
+            kwargs.setdefault('consumer', spec.consumer())
+            kwargs.setdefault('chef', spec.chef())
+            Waiter.__init__(self, *args, **kwargs)
+        return type(str(self.name), (Waiter,), {'__init__':__init__, 'spec':self})
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_exception'] = None
+        return state
+
+    def save(self, path):
+        """
+            Pickle to `path`, by way of a temporary file, so a reader never
+            sees half an artifact.
+        """
+        partial = '%s.%d.partial' % (path, os.getpid())
+        handle = open(partial, 'wb')
+        try:
+            cPickle.dump((ARTIFACT_VERSION, self), handle, cPickle.HIGHEST_PROTOCOL)
+        finally:
+            handle.close()
+        os.rename(partial, path)
+
+    @classmethod
+    def load(cls, path):
+        handle = open(path, 'rb')
+        try:
+            version, spec = cPickle.load(handle)
+        finally:
+            handle.close()
+        if version != ARTIFACT_VERSION:
+            raise cls.Invalid("%s was written by another version of waiter" % path)
+        return spec
+
+def compile_spec(spec, digest=None):
+    """
+        Check a spec dict and compile it.
+    """
+    for key in ('name', 'domain', 'endpoints'):
+        if not spec.get(key):
+            raise CompiledSpec.Invalid("A spec needs a %r" % key)
+    endpoints = spec['endpoints']
+    if isinstance(endpoints, basestring):
+        endpoints = LaxRecipeChef.string_recipe_to_dict(endpoints)
+    recipe = {}
+    for endpoint, method in endpoints.items():
+        if isinstance(method, dict):
+            method = method.get('method', 'GET')
+        recipe[str(endpoint).strip('/')] = str(method).upper()
+
+    pagination = spec.get('pagination')
+    if pagination is not None:
+        if pagination.get('style', 'cursor') != 'cursor':
+            raise CompiledSpec.Invalid("Don't know how to page by %r" % pagination['style'])
+        pagination = {
+            'param':str(pagination.get('param', 'cursor')),
+            'start':pagination.get('start'),
+            'next':str(pagination.get('next', 'next_' + pagination.get('param', 'cursor'))),
+            'items':tuple(str(key) for key in pagination.get('items', ())),
+        }
+    errors = dict(spec.get('errors') or {})
+    errors['statuses'] = tuple(int(status) for status in errors.get('statuses', ()))
+    return CompiledSpec(str(spec['name']), str(spec['domain']), recipe, pagination, spec.get('rate_limit'), errors, digest)
+
+def load_client(path, cache_dir=None):
+    """
+        The client for the spec at `path`, from its compiled artifact in
+        `cache_dir` (beside the spec, by default) when the spec hasn't changed
+        since it was written -- and written afresh when it has.
+    """
+    handle = open(path, 'rb')
+    try:
+        source = handle.read()
+    finally:
+        handle.close()
+    digest = hashlib.sha1(source).hexdigest()
+    cache_dir = cache_dir if cache_dir else os.path.dirname(os.path.abspath(path))
+    artifact = os.path.join(cache_dir, os.path.basename(path) + '.compiled')
+    try:
+        spec = CompiledSpec.load(artifact)
+    except Exception:
+        spec = None
+    if spec is None or spec.digest != digest:
+        spec = compile_spec(json.loads(source), digest)
+        try:
+            spec.save(artifact)
+        except (IOError, OSError):
+            pass
+    return spec.client()
@@ -0,0 +1,125 @@
+import threading
+import Queue
+import sys
+
+# Python 2's three-argument raise, spelled so Python 3 can still compile this module.
+exec("def reraise(exc_info):\n    raise exc_info[0], exc_info[1], exc_info[2]\n")
+
+class Ticket(object):
+    """
+        A ticket is what the kitchen hands back when an order goes in -- it's
+        not your food yet, but you can wait on it, or ask to be told when it's up.
+    """
+    class Timeout(Exception):
+        pass
+
+    @classmethod
+    def failed(cls, exception):
+        ticket = cls()
+        ticket.fail((exception.__class__, exception, None))
+        return ticket
+
+    def __init__(self):
+        self._ready = threading.Event()
+        self._lock = threading.Lock()
+        self._result = None
+        self._exc_info = None
+        self._callbacks = []
+
+    def fulfill(self, result):
+        self._result = result
+        self._settle()
+
+    def fail(self, exc_info=None):
+        self._exc_info = exc_info if exc_info else sys.exc_info()
+        self._settle()
+
+    def _settle(self):
+        self._lock.acquire()
+        try:
+            self._ready.set()
+            callbacks, self._callbacks = self._callbacks, []
+        finally:
+            self._lock.release()
+        for callback in callbacks:
+            callback(self)
+
+    def add_done_callback(self, callback):
+        self._lock.acquire()
+        try:
+            if not self._ready.isSet():
+                self._callbacks.append(callback)
+                return
+        finally:
+            self._lock.release()
+        callback(self)
+
+    def done(self):
+        return self._ready.isSet()
+
+    def exception(self, timeout=None):
+        self._wait(timeout)
+        return self._exc_info[1] if self._exc_info else None
+
+    def result(self, timeout=None):
+        self._wait(timeout)
+        if self._exc_info:
+            reraise(self._exc_info)
+        return self._result
+
+    def _wait(self, timeout):
+        self._ready.wait(timeout)
+        if not self._ready.isSet():
+            raise Ticket.Timeout("Order wasn't up within %s seconds" % timeout)
+
+class Brigade(object):
+    """
+        A fixed crew of worker threads that cook whatever is submitted to them,
+        handing back a Ticket for each submission.
+    """
+    def __init__(self, cooks=8):
+        self._queue = Queue.Queue()
+        self._cooks = []
+        for i in range(cooks):
+            cook = threading.Thread(target=self._work)
+            cook.setDaemon(True)
+            cook.start()
+            self._cooks.append(cook)
+
+    def submit(self, fn, *args, **kwargs):
+        ticket = Ticket()
+        self._queue.put((ticket, fn, args, kwargs))
+        return ticket
+
+    def _work(self):
+        while True:
+            order = self._queue.get()
+            if order is None:
+                return
+            ticket, fn, args, kwargs = order
+            try:
+                result = fn(*args, **kwargs)
+            except Exception:
+                ticket.fail()
+            else:
+                ticket.fulfill(result)
+
+    def shutdown(self, wait=True):
+        for cook in self._cooks:
+            self._queue.put(None)
+        if wait:
+            for cook in self._cooks:
+                cook.join()
+        self._cooks = []
+
+def as_completed(tickets):
+    """
+        Yield each ticket as soon as its order is up, regardless of the order
+        the tickets were handed out in.
+    """
+    ready = Queue.Queue()
+    tickets = list(tickets)
+    for ticket in tickets:
+        ticket.add_done_callback(ready.put)
+    for i in range(len(tickets)):
+        yield ready.get()
@@ -0,0 +1,480 @@
+from waiter.compression import accept_encoding, decompressor_for
+from waiter.tickets import reraise
+import threading
+import copy
+import httplib2
+import httplib
+import socket
+import time
+import sys
+
+class ThreadLocalHttp(object):
+    """
+        httplib2.Http isn't safe to share between threads, so hand each thread
+        its own -- built by `factory` the first time that thread makes a request.
+    """
+    thread_safe = True
+
+    def __init__(self, factory=httplib2.Http):
+        self._factory = factory
+        self._local = threading.local()
+
+    def _get_http(self):
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = self._local.http = self._factory()
+        return http
+
+    @property
+    def takes_deadlines(self):
+        return getattr(self._get_http(), 'takes_deadlines', False)
+
+    def request(self, *args, **kwargs):
+        return self._get_http().request(*args, **kwargs)
+
+def consume(consumer, response, data):
+    """
+        `consumer.handle(response, data)`, closing `data` if the consumer
+        raises -- a streamed body nobody's going to read would otherwise
+        keep its connection checked out.
+    """
+    try:
+        return consumer.handle(response, data)
+    except Exception:
+        exc_info = sys.exc_info()
+        if hasattr(data, 'close'):
+            data.close()
+        reraise(exc_info)
+
+class HttpWrapper(object):
+    """
+        Base for transports that wrap another http. Thread-safe exactly when
+        the wrapped http is, and copying one copies the wrapped http along
+        with it.
+    """
+    def __init__(self, http):
+        self.http = http
+
+    @property
+    def thread_safe(self):
+        return getattr(self.http, 'thread_safe', False)
+
+    @property
+    def takes_deadlines(self):
+        return getattr(self.http, 'takes_deadlines', False)
+
+    def __copy__(self):
+        copied = self.__class__.__new__(self.__class__)
+        copied.__dict__.update(self.__dict__)
+        copied.http = copy.copy(self.http)
+        return copied
+
+    def request(self, uri, **kwargs):
+        return self.http.request(uri=uri, **kwargs)
+
+class ConnectionPool(object):
+    """
+        Keeps idle keep-alive connections around per host so that any number of
+        Http objects, on any number of threads, can pick them back up. At most
+        `max_per_host` connections to a host are out at once; anybody else waits
+        their turn. Connections left idle longer than `idle_timeout` get closed.
+    """
+    def __init__(self, max_per_host=10, idle_timeout=60, clock=time.time):
+        self.max_per_host = max_per_host
+        self.idle_timeout = idle_timeout
+        self._clock = clock
+        self._condition = threading.Condition()
+        self._idle = {}
+        self._busy = {}
+        self.hits = 0
+        self.misses = 0
+        self.waits = 0
+        self.expired = 0
+
+    def checkout(self, key):
+        self._condition.acquire()
+        try:
+            while True:
+                idle = self._idle.get(key)
+                while idle:
+                    conn, last_used = idle.pop()
+                    if self._clock() - last_used > self.idle_timeout:
+                        self.expired += 1
+                        conn.close()
+                        continue
+                    self.hits += 1
+                    self._busy[key] = self._busy.get(key, 0) + 1
+                    return conn
+                if self._busy.get(key, 0) < self.max_per_host:
+                    self.misses += 1
+                    self._busy[key] = self._busy.get(key, 0) + 1
+                    return None
+                self.waits += 1
+                self._condition.wait()
+        finally:
+            self._condition.release()
+
+    def checkin(self, key, conn):
+        self._condition.acquire()
+        try:
+            self._busy[key] -= 1
+            if conn is not None:
+                self._idle.setdefault(key, []).append((conn, self._clock()))
+            self._condition.notify()
+        finally:
+            self._condition.release()
+
+    def discard(self, key, conn):
+        if conn is not None:
+            conn.close()
+        self.checkin(key, None)
+
+    def close(self):
+        self._condition.acquire()
+        try:
+            idle, self._idle = self._idle, {}
+        finally:
+            self._condition.release()
+        for conns in idle.values():
+            for conn, last_used in conns:
+                conn.close()
+
+    def stats(self):
+        self._condition.acquire()
+        try:
+            return {
+                'hits':self.hits,
+                'misses':self.misses,
+                'waits':self.waits,
+                'expired':self.expired,
+                'idle':sum([len(conns) for conns in self._idle.values()]),
+                'busy':sum(self._busy.values()),
+            }
+        finally:
+            self._condition.release()
+
+_shared_pool = None
+_shared_pool_lock = threading.Lock()
+
+def shared_pool():
+    global _shared_pool
+    _shared_pool_lock.acquire()
+    try:
+        if _shared_pool is None:
+            _shared_pool = ConnectionPool()
+        return _shared_pool
+    finally:
+        _shared_pool_lock.release()
+
+ABORTED_TIMEOUT = 1e-6
+
+def abort_connections(connections):
+    """
+        Shut down the sockets of connections that are in the middle of
+        something, and leave them a timeout too short to reconnect with.
+    """
+    for conn in list(connections.values()):
+        conn.timeout = ABORTED_TIMEOUT
+        sock = getattr(conn, 'sock', None)
+        if sock is not None:
+            try:
+                sock.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+class PooledMixin(object):
+    """
+        Mix in ahead of httplib2.Http (or a subclass of it, like oauth2.Client)
+        to borrow connections from a ConnectionPool instead of keeping them on
+        the instance. Each thread sees its own `connections`, holding only what
+        it has checked out, so a single instance can be shared between threads.
+
+        Requests made with a `deadline` get socket timeouts no longer than
+        what's left of it, and have their connection shut down if it runs
+        out -- or is cancelled -- while they're still going.
+
+        Connections are only handed on to instances that would have opened
+        them the same way -- with the same certificates, proxy and timeout.
+    """
+    thread_safe = True
+    takes_deadlines = True
+
+    def __init__(self, *args, **kwargs):
+        self._pool = kwargs.pop('pool', None) or shared_pool()
+        self._local = threading.local()
+        super(PooledMixin, self).__init__(*args, **kwargs)
+
+    def _get_connections(self):
+        connections = getattr(self._local, 'connections', None)
+        if connections is None:
+            connections = self._local.connections = {}
+        return connections
+
+    def _set_connections(self, connections):
+        self._local.connections = connections
+
+    connections = property(_get_connections, _set_connections)
+
+    def _get_timeout(self):
+        deadline = getattr(self._local, 'deadline', None)
+        if deadline is None:
+            return self._timeout
+        return deadline.timeout(self._timeout)
+
+    def _set_timeout(self, timeout):
+        self._timeout = timeout
+
+    timeout = property(_get_timeout, _set_timeout)
+
+    def pool_key(self, scheme, authority):
+        """
+            What connections to `authority` are filed under in the pool: the
+            host, and every setting that goes into opening a connection to it.
+        """
+        proxy_info = getattr(self, 'proxy_info', None)
+        if callable(proxy_info):
+            proxy_info = proxy_info(scheme)
+        certificates = getattr(self, 'certificates', None)
+        return (
+            scheme + ':' + authority,
+            getattr(self, 'disable_ssl_certificate_validation', False),
+            getattr(self, 'ca_certs', None),
+            getattr(self, 'ssl_version', None),
+            tuple(certificates.iter(authority)) if certificates is not None else (),
+            repr(proxy_info.astuple()) if proxy_info is not None else None,
+            getattr(self, '_timeout', None),
+        )
+
+    def request(self, uri, *args, **kwargs):
+        if getattr(self._local, 'serving', False):
+            # httplib2 following a redirect: carry on with the connections
+            # this thread already has out.
+            kwargs.pop('deadline', None)
+            return super(PooledMixin, self).request(uri, *args, **kwargs)
+        deadline = kwargs.pop('deadline', None)
+        scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(httplib2.iri2uri(uri))
+        key = scheme + ':' + authority
+        pool_key = self.pool_key(scheme, authority)
+        conn = self._pool.checkout(pool_key)
+        self.connections = {key:conn} if conn is not None else {}
+        self._local.serving = True
+        served = False
+        if deadline is not None:
+            self._local.deadline = deadline
+            connections = self.connections
+            forget_abort = deadline.on_abort(lambda: abort_connections(connections))
+        try:
+            if deadline is not None and conn is not None and conn.sock is not None:
+                conn.sock.settimeout(self.timeout)
+            result = super(PooledMixin, self).request(uri, *args, **kwargs)
+            served = True
+            return result
+        except Exception:
+            if deadline is not None and deadline.stopped():
+                deadline.check('waiting on %s' % authority)
+            raise
+        finally:
+            self._local.serving = False
+            if deadline is not None:
+                forget_abort()
+                self._local.deadline = None
+                served = served and not deadline.stopped()
+            leftovers, self.connections = self.connections, {}
+            conn = leftovers.pop(key, None)
+            if served:
+                if deadline is not None and conn is not None and conn.sock is not None:
+                    conn.sock.settimeout(self._timeout)
+                self._pool.checkin(pool_key, conn)
+            else:
+                self._pool.discard(pool_key, conn)
+            for other in leftovers.values():
+                other.close()
+
+    def pool_stats(self):
+        return self._pool.stats()
+
+    def __getstate__(self):
+        state = super(PooledMixin, self).__getstate__()
+        state.pop('_local', None)
+        return state
+
+    def __setstate__(self, state):
+        self._local = threading.local()
+        super(PooledMixin, self).__setstate__(state)
+
+class PooledHttp(PooledMixin, httplib2.Http):
+    pass
+
+class StreamedResponse(dict):
+    """
+        Looks enough like an httplib2.Response -- a dict of lowercased headers
+        with a `status` and `reason` -- for Consumers not to care.
+    """
+    def __init__(self, response):
+        super(StreamedResponse, self).__init__([(key.lower(), value) for key, value in response.getheaders()])
+        self.status = response.status
+        self.reason = response.reason
+
+class ResponseBody(object):
+    """
+        The body of a streamed response, read off the socket `chunk_size` at a
+        time -- and inflated as it goes, given a `decompressor`. The connection
+        goes back to the pool once the body has been read to the end, and gets
+        thrown out if it's closed -- or dropped -- before then.
+
+        `bytes_read` counts what came over the wire, `bytes_decoded` what was
+        handed back, and `decompress_seconds` the time spent inflating. With
+        a `deadline`, reading stops once it's passed.
+    """
+    def __init__(self, response, release, chunk_size=64*1024, decompressor=None, deadline=None):
+        self._response = response
+        self._release = release
+        self._decompressor = decompressor
+        self._deadline = deadline
+        self._callbacks = []
+        self.chunk_size = chunk_size
+        self.bytes_read = 0
+        self.bytes_decoded = 0
+
+    @property
+    def decompress_seconds(self):
+        return self._decompressor.seconds if self._decompressor is not None else 0.0
+
+    def read(self, size=None):
+        while self._release is not None:
+            try:
+                if self._deadline is not None:
+                    self._deadline.check('reading the body')
+                chunk = self._response.read(size) if size else self._response.read()
+            except Exception:
+                self._finish(False)
+                if self._deadline is not None and self._deadline.stopped():
+                    self._deadline.check('reading the body')
+                raise
+            self.bytes_read += len(chunk)
+            done = not chunk or not size
+            data = chunk
+            if self._decompressor is not None:
+                data = self._decompressor.decompress(chunk) if chunk else ''
+                if done:
+                    data += self._decompressor.flush()
+            self.bytes_decoded += len(data)
+            if done:
+                self._finish(not self._response.will_close)
+            if data or done:
+                return data
+        return ''
+
+    def __iter__(self):
+        chunk = self.read(self.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = self.read(self.chunk_size)
+
+    def add_done_callback(self, fn):
+        """
+            Call `fn` with this body once it's been read to the end or closed.
+        """
+        if self._release is None:
+            fn(self)
+        else:
+            self._callbacks.append(fn)
+
+    def _finish(self, reusable):
+        release, self._release = self._release, None
+        if release is not None:
+            release(reusable)
+            for callback in self._callbacks:
+                callback(self)
+
+    def close(self):
+        self._finish(False)
+
+    def __del__(self):
+        self._finish(False)
+
+class StreamingHttp(object):
+    """
+        Hands back the response body unread, as a ResponseBody, so a streaming
+        Consumer can parse it as it comes off the socket. Connections are
+        borrowed from a ConnectionPool, just like a PooledHttp's, and take
+        deadlines the same way -- the body stays under its order's deadline
+        until it's been read.
+    """
+    thread_safe = True
+    takes_deadlines = True
+    connection_types = {
+        'http':httplib.HTTPConnection,
+        'https':httplib.HTTPSConnection,
+    }
+
+    def __init__(self, pool=None, timeout=None, chunk_size=64*1024, decompress=True):
+        self._pool = pool if pool else shared_pool()
+        self.timeout = timeout
+        self.chunk_size = chunk_size
+        self.decompress = decompress
+
+    def request(self, uri, method='GET', body=None, headers=None, deadline=None):
+        scheme, authority, request_uri, defrag_uri = httplib2.urlnorm(httplib2.iri2uri(uri))
+        key = ('stream:%s:%s' % (scheme, authority), self.timeout)
+        headers = dict(headers or {})
+        if self.decompress and 'accept-encoding' not in [name.lower() for name in headers]:
+            headers['accept-encoding'] = accept_encoding()
+        while True:
+            timeout = deadline.timeout(self.timeout) if deadline is not None else self.timeout
+            conn = self._pool.checkout(key)
+            reused = conn is not None
+            if not reused:
+                conn = self.connection_types[scheme](authority, timeout=timeout)
+            elif deadline is not None and conn.sock is not None:
+                conn.sock.settimeout(timeout)
+            release = self._releaser(key, conn, deadline)
+            try:
+                if hasattr(body, 'framed_chunks'):
+                    self._send_streamed(conn, method, request_uri, body, headers)
+                else:
+                    conn.request(method, request_uri, body, headers)
+                response = conn.getresponse()
+            except Exception as e:
+                release(False)
+                if deadline is not None and deadline.stopped():
+                    deadline.check('waiting on %s' % authority)
+                if reused and isinstance(e, (socket.error, httplib.HTTPException)):
+                    continue
+                raise
+            streamed = StreamedResponse(response)
+            decompressor = decompressor_for(streamed.get('content-encoding')) if self.decompress else None
+            if decompressor is not None:
+                streamed['-content-encoding'] = streamed.pop('content-encoding')
+            return streamed, ResponseBody(response, release, self.chunk_size, decompressor, deadline)
+
+    def _send_streamed(self, conn, method, request_uri, body, headers):
+        """
+            Send a RequestBody's chunks to the socket as they come -- slices of
+            a memory-mapped file go out without being copied first.
+        """
+        headers = dict(headers, **body.headers())
+        names = [name.lower() for name in headers]
+        conn.putrequest(method, request_uri, skip_host='host' in names, skip_accept_encoding='accept-encoding' in names)
+        for name, value in headers.items():
+            conn.putheader(name, value)
+        conn.endheaders()
+        for chunk in body.framed_chunks():
+            conn.send(chunk)
+
+    def _releaser(self, key, conn, deadline=None):
+        forget_abort = deadline.on_abort(lambda: abort_connections({key:conn})) if deadline is not None else None
+        def release(reusable):
+            if forget_abort is not None:
+                forget_abort()
+                reusable = reusable and not deadline.stopped()
+                if reusable and conn.sock is not None:
+                    conn.sock.settimeout(self.timeout)
+            if reusable:
+                self._pool.checkin(key, conn)
+            else:
+                self._pool.discard(key, conn)
+        return release
+
+    def pool_stats(self):
+        return self._pool.stats()
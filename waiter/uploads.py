@@ -0,0 +1,234 @@
+"""
+    Request bodies that are sent as they're read rather than cooked into one
+    big string. Each body yields its bytes from `chunks()` -- straight out of
+    a memory-mapped file where it can, so a large upload costs the same
+    memory as a small one -- and can also be `read()` like a file, which is
+    how httplib (and so httplib2) sends anything that isn't a string.
+    Bodies whose length can't be known up front are sent chunked.
+"""
+import mimetypes
+import binascii
+import types
+import mmap
+import os
+
+CHUNK_SIZE = 64 * 1024
+
+def _open_mmap(fileobj):
+    try:
+        fileno = fileobj.fileno()
+        start = fileobj.tell()
+        size = os.fstat(fileno).st_size
+        if size <= start:
+            return None, start, 0
+        return mmap.mmap(fileno, 0, access=mmap.ACCESS_READ), start, size - start
+    except (AttributeError, EnvironmentError, ValueError):
+        return None, None, None
+
+class Upload(object):
+    """
+        A file to send: an open file object, a path to open, or any iterable
+        of byte strings (a generator, say). `filename` and `content_type` are
+        guessed from the file when not given.
+
+        The slices `chunks()` yields from a mapped file are only good until
+        it's run to the end; copy them (`str(chunk)`) to keep them longer.
+    """
+    def __init__(self, source, filename=None, content_type=None, chunk_size=CHUNK_SIZE):
+        self.source = source
+        if filename is None:
+            filename = source if isinstance(source, basestring) else getattr(source, 'name', None)
+            filename = os.path.basename(filename) if isinstance(filename, basestring) and not filename.startswith('<') else None
+        self.filename = filename
+        if content_type is None:
+            content_type = (mimetypes.guess_type(filename)[0] if filename else None) or 'application/octet-stream'
+        self.content_type = content_type
+        self.chunk_size = chunk_size
+
+    @property
+    def length(self):
+        if isinstance(self.source, basestring):
+            return os.path.getsize(self.source)
+        if not hasattr(self.source, 'read'):
+            return None
+        try:
+            return os.fstat(self.source.fileno()).st_size - self.source.tell()
+        except (AttributeError, EnvironmentError, ValueError):
+            pass
+        try:
+            start = self.source.tell()
+            self.source.seek(0, 2)
+            end = self.source.tell()
+            self.source.seek(start)
+            return end - start
+        except (AttributeError, EnvironmentError, ValueError):
+            return None
+
+    def chunks(self):
+        if isinstance(self.source, basestring):
+            fileobj = open(self.source, 'rb')
+            try:
+                for chunk in self._file_chunks(fileobj):
+                    yield chunk
+            finally:
+                fileobj.close()
+        elif hasattr(self.source, 'read'):
+            for chunk in self._file_chunks(self.source):
+                yield chunk
+        else:
+            for chunk in self.source:
+                yield chunk
+
+    def _file_chunks(self, fileobj):
+        mapped, start, length = _open_mmap(fileobj)
+        if mapped is not None:
+            try:
+                for offset in range(start, start + length, self.chunk_size):
+                    yield buffer(mapped, offset, min(self.chunk_size, start + length - offset))
+            finally:
+                mapped.close()
+            return
+        if length == 0:
+            return
+        try:
+            start = fileobj.tell()
+        except (AttributeError, EnvironmentError):
+            start = None
+        chunk = fileobj.read(self.chunk_size)
+        while chunk:
+            yield chunk
+            chunk = fileobj.read(self.chunk_size)
+        if start is not None:
+            fileobj.seek(start)
+
+def is_upload(value):
+    return isinstance(value, (Upload, types.GeneratorType)) or hasattr(value, 'read')
+
+class RequestBody(object):
+    """
+        Base for streamed bodies. Subclasses provide `chunks()`, `length` (None
+        when unknown) and `content_type`.
+    """
+    content_type = 'application/octet-stream'
+    _reader = None
+    _pending = ''
+
+    def headers(self):
+        headers = {'content-type':self.content_type}
+        if self.length is None:
+            headers['transfer-encoding'] = 'chunked'
+        else:
+            headers['content-length'] = str(self.length)
+        return headers
+
+    def __len__(self):
+        length = self.length
+        if length is None:
+            raise TypeError("This body's length isn't known until it's been sent")
+        return length
+
+    def framed_chunks(self):
+        """
+            `chunks()`, framed for chunked transfer-encoding when the length
+            isn't known.
+        """
+        if self.length is not None:
+            for chunk in self.chunks():
+                yield chunk
+            return
+        for chunk in self.chunks():
+            if len(chunk):
+                yield '%x\r\n' % len(chunk)
+                yield chunk
+                yield '\r\n'
+        yield '0\r\n\r\n'
+
+    def read(self, size=-1):
+        if self._reader is None:
+            self._reader, self._pending = self.framed_chunks(), ''
+        pieces, have = [self._pending], len(self._pending)
+        while size < 0 or have < size:
+            chunk = next(self._reader, None)
+            if chunk is None:
+                break
+            chunk = str(chunk)
+            pieces.append(chunk)
+            have += len(chunk)
+        data = ''.join(pieces)
+        if size < 0:
+            self._pending = ''
+            return data
+        self._pending = data[size:]
+        return data[:size]
+
+    def rewind(self):
+        self._reader = None
+
+class StreamingBody(RequestBody):
+    """
+        Sends an Upload's bytes as the whole body.
+    """
+    def __init__(self, source, content_type=None, length=None):
+        self.upload = source if isinstance(source, Upload) else Upload(source, content_type=content_type)
+        self.content_type = self.upload.content_type
+        self._length = length
+
+    @property
+    def length(self):
+        return self._length if self._length is not None else self.upload.length
+
+    def chunks(self):
+        return self.upload.chunks()
+
+class MultipartBody(RequestBody):
+    """
+        multipart/form-data, for endpoints that take file uploads. Values that
+        are Uploads, open files or generators go in as file parts; everything
+        else as a plain field.
+    """
+    def __init__(self, params, boundary=None):
+        self.boundary = boundary if boundary else binascii.hexlify(os.urandom(16))
+        self.parts = []
+        for name, value in sorted(params.items()):
+            if is_upload(value) and not isinstance(value, Upload):
+                value = Upload(value)
+            self.parts.append((name, value))
+
+    @property
+    def content_type(self):
+        return 'multipart/form-data; boundary=%s' % self.boundary
+
+    def _head(self, name, value):
+        if isinstance(value, Upload):
+            filename = (value.filename or name).replace('"', '\\"')
+            return '--%s\r\nContent-Disposition: form-data; name="%s"; filename="%s"\r\nContent-Type: %s\r\n\r\n' % (
+                self.boundary, name, filename, value.content_type)
+        return '--%s\r\nContent-Disposition: form-data; name="%s"\r\n\r\n' % (self.boundary, name)
+
+    def _field(self, value):
+        return value.encode('utf-8') if isinstance(value, unicode) else str(value)
+
+    @property
+    def length(self):
+        total = len('--%s--\r\n' % self.boundary)
+        for name, value in self.parts:
+            total += len(self._head(name, value)) + 2
+            if isinstance(value, Upload):
+                length = value.length
+                if length is None:
+                    return None
+                total += length
+            else:
+                total += len(self._field(value))
+        return total
+
+    def chunks(self):
+        for name, value in self.parts:
+            if isinstance(value, Upload):
+                yield self._head(name, value)
+                for chunk in value.chunks():
+                    yield chunk
+                yield '\r\n'
+            else:
+                yield self._head(name, value) + self._field(value) + '\r\n'
+        yield '--%s--\r\n' % self.boundary
@@ -0,0 +1,262 @@
+"""
+    Write-behind for POST endpoints. Rather than standing at the pass while
+    a status update goes out, queue it on a WriteQueue and carry on: you get
+    a Ticket back, and a few workers send the queue along at a steady rate.
+    Every write carries an idempotency key, so queueing the same write twice
+    only sends it once, and a Journal keeps the queue on disk so that writes
+    still waiting when the process dies go out when it comes back.
+"""
+from waiter.tickets import Ticket, Brigade
+from waiter.limiters import TokenBucket
+import collections
+import base64
+import threading
+import json
+import time
+import uuid
+import os
+
+class Journal(object):
+    """
+        An append-only log of queued writes, one JSON object per line: each
+        write is logged when it's queued and again once it's been sent (or
+        tried -- a write that raised may well have got there).
+        `pending` is everything queued but never sent -- a line torn by a
+        crash is skipped. With `sync`, every line is fsynced before the
+        write is queued.
+    """
+    def __init__(self, path, sync=True):
+        self.path = path
+        self.sync = sync
+        self._lock = threading.Lock()
+        self._handle = open(path, 'ab')
+
+    def _append(self, line):
+        self._lock.acquire()
+        try:
+            self._handle.write(line)
+            self._handle.flush()
+            if self.sync:
+                os.fsync(self._handle.fileno())
+        finally:
+            self._lock.release()
+
+    def queued(self, key, cooked_data):
+        body = cooked_data['body']
+        if not isinstance(body, (str, type(None))):
+            raise TypeError("Only string bodies can be journaled, not %r" % body.__class__)
+        self._append(self._line(key, cooked_data))
+
+    def _line(self, key, cooked_data):
+        body = cooked_data['body']
+        entry = dict(cooked_data, key=key, op='queued')
+        if body is not None:
+            try:
+                body.decode('utf-8')
+            except UnicodeDecodeError:
+                entry['body'], entry['body64'] = None, base64.b64encode(body)
+        return json.dumps(entry, sort_keys=True) + '\n'
+
+    def _cooked(self, entry):
+        def encode(value):
+            return value.encode('utf-8') if isinstance(value, unicode) else value
+        cooked_data = {
+            'uri':encode(entry['uri']),
+            'method':encode(entry['method']),
+            'body':base64.b64decode(entry['body64']) if 'body64' in entry else encode(entry['body']),
+        }
+        if entry.get('headers'):
+            cooked_data['headers'] = dict((encode(k), encode(v)) for k, v in entry['headers'].items())
+        return cooked_data
+
+    def sent(self, key):
+        self._append(json.dumps({'key':key, 'op':'sent'}) + '\n')
+
+    def pending(self):
+        pending = collections.OrderedDict()
+        handle = open(self.path, 'rb')
+        try:
+            for line in handle:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry['op'] == 'queued':
+                    pending[entry['key'].encode('utf-8')] = entry
+                else:
+                    pending.pop(entry['key'].encode('utf-8'), None)
+        finally:
+            handle.close()
+        return [(key, self._cooked(entry)) for key, entry in pending.items()]
+
+    def compact(self):
+        """
+            Rewrite the journal with only the writes still pending.
+        """
+        self._lock.acquire()
+        try:
+            self._handle.close()
+            pending = self.pending()
+            handle = open(self.path + '.compacting', 'wb')
+            try:
+                for key, cooked_data in pending:
+                    handle.write(self._line(key, cooked_data))
+                handle.flush()
+                os.fsync(handle.fileno())
+            finally:
+                handle.close()
+            os.rename(self.path + '.compacting', self.path)
+            self._handle = open(self.path, 'ab')
+        finally:
+            self._lock.release()
+
+    def close(self):
+        self._handle.close()
+
+class WriteQueue(object):
+    """
+        Sends `waiter`'s writes from `workers` threads, no faster than `rate`
+        a second (in bursts of up to `burst`) if you give it one. Each write
+        is sent with an Idempotency-Key header, and the last `remember` keys
+        are kept, so queueing a write under a key that's already pending --
+        or was sent -- hands back the Ticket it already has.
+
+        With a `journal`, writes left pending by an earlier run are queued
+        again straight away; their Tickets are in `recovered`.
+    """
+    header = 'idempotency-key'
+
+    def __init__(self, waiter, workers=2, rate=None, burst=1, journal=None, remember=10000, clock=time.time, sleep=time.sleep):
+        self.waiter = waiter
+        self.journal = journal
+        self.remember = remember
+        self._http = waiter._shareable_http()
+        self._bucket = TokenBucket(rate, burst, clock) if rate else None
+        self._sleep = sleep
+        self._lock = threading.Lock()
+        self._tickets = collections.OrderedDict()
+        self._brigade = Brigade(workers)
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.deduplicated = 0
+        self.recovered = []
+        if journal is not None:
+            for key, cooked_data in journal.pending():
+                self.recovered.append(self._queue(key, cooked_data, journaled=True))
+
+    def submit(self, stack, params=None, key=None):
+        """
+            Cook a write and queue it, handing back a Ticket for what the
+            Consumer makes of the response.
+        """
+        if isinstance(stack, basestring):
+            stack = [stack]
+        key = key if key is not None else uuid.uuid4().hex
+        self._lock.acquire()
+        try:
+            ticket = self._tickets.get(key)
+            if ticket is not None:
+                self.deduplicated += 1
+                return ticket
+        finally:
+            self._lock.release()
+        try:
+            cooked_data = self.waiter._cook(stack, dict(params or {}))
+        except Exception as e:
+            return Ticket.failed(e)
+        return self._queue(key, cooked_data)
+
+    def _queue(self, key, cooked_data, journaled=False):
+        cooked_data = dict(cooked_data, headers=dict(cooked_data.get('headers') or {}))
+        cooked_data['headers'][self.header] = key
+        self._lock.acquire()
+        try:
+            ticket = self._tickets.get(key)
+            if ticket is not None:
+                self.deduplicated += 1
+                return ticket
+            ticket = self._tickets[key] = Ticket()
+            while len(self._tickets) > self.remember:
+                self._tickets.popitem(last=False)
+        finally:
+            self._lock.release()
+        if self.journal is not None and not journaled:
+            try:
+                self.journal.queued(key, cooked_data)
+            except Exception:
+                self._lock.acquire()
+                try:
+                    if self._tickets.get(key) is ticket:
+                        del self._tickets[key]
+                finally:
+                    self._lock.release()
+                ticket.fail()
+                return ticket
+        self._count('queued')
+        self._brigade.submit(self._fill, ticket, key, cooked_data)
+        return ticket
+
+    def _fill(self, ticket, key, cooked_data):
+        try:
+            result = self._send(key, cooked_data)
+        except Exception:
+            ticket.fail()
+        else:
+            ticket.fulfill(result)
+
+    def _wait_turn(self):
+        while self._bucket is not None:
+            self._lock.acquire()
+            try:
+                wait = self._bucket.wait_time()
+                if wait <= 0:
+                    self._bucket.take()
+                    return
+            finally:
+                self._lock.release()
+            self._sleep(wait)
+
+    def _send(self, key, cooked_data):
+        self._wait_turn()
+        try:
+            result = self.waiter.serve(cooked_data, self._http)
+        except Exception:
+            self._count('failed')
+            raise
+        else:
+            self._count('sent')
+            return result
+        finally:
+            if self.journal is not None:
+                self.journal.sent(key)
+
+    def _count(self, name):
+        self._lock.acquire()
+        try:
+            setattr(self, name, getattr(self, name) + 1)
+        finally:
+            self._lock.release()
+
+    def close(self, wait=True):
+        """
+            Stop taking writes; with `wait`, send everything still queued
+            first, and compact the journal.
+        """
+        self._brigade.shutdown(wait)
+        if self.journal is not None and wait:
+            self.journal.compact()
+
+    def stats(self):
+        self._lock.acquire()
+        try:
+            return {
+                'queued':self.queued,
+                'sent':self.sent,
+                'failed':self.failed,
+                'deduplicated':self.deduplicated,
+                'recovered':len(self.recovered),
+                'pending':self.queued - self.sent - self.failed,
+            }
+        finally:
+            self._lock.release()